@@ -0,0 +1,293 @@
+""" Contains asyncio versions of the extract and plot functions, for use in
+    asynchronous services.  The blocking work runs on bounded executors so that
+    the event loop is never blocked: reads of NetCDF-3 files in a pool of threads
+    (they only read a memory map, see the classic module), reads of NetCDF-4
+    files in a pool of worker processes (the HDF5 library is not thread-safe, so
+    threads would have to take turns and one slow read would hold up all the
+    others), and rendering with matplotlib (which is not thread-safe) in a pool
+    of worker processes that save the plots to image files.
+
+    Every call accepts a timeout in seconds.  When it expires (or the calling task
+    is cancelled), the call raises asyncio.TimeoutError (or CancelledError) at once
+    and a request still waiting in its executor's queue is dropped.  A read or
+    render that has already started cannot be interrupted; it runs to completion
+    in the background and its result is discarded, so it occupies one worker
+    until then.
+
+    Usage:
+        data, lon_vals, lat_vals = await async_api.extract_map_data(
+            filename, 'analysed_sst', 0, 0, timeout=30)
+        await async_api.plot_map(filename, 'analysed_sst', 0, 0, 'sst.png', timeout=60) """
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import threading
+import numpy as np
+import cache
+import classic
+import expression
+import extract
+import netcdf_utils as nu
+
+# Number of threads reading NetCDF-3 data
+IO_WORKERS = 4
+# Number of processes reading NetCDF-4 data
+READ_WORKERS = 4
+# Number of processes rendering plots
+RENDER_WORKERS = 2
+
+_executors = {}
+_lock = threading.Lock()
+
+
+def configure(io_workers=None, render_workers=None, read_workers=None):
+    """
+    Sets the sizes of the executors.  Executors already running are shut down
+    (after finishing their work) and replaced when they are next used.
+    :param io_workers: optional - the number of threads reading NetCDF-3 data
+    :param render_workers: optional - the number of processes rendering plots
+    :param read_workers: optional - the number of processes reading NetCDF-4 data
+    :return: no return
+    """
+    global IO_WORKERS, RENDER_WORKERS, READ_WORKERS
+    if io_workers is not None:
+        IO_WORKERS = io_workers
+    if read_workers is not None:
+        READ_WORKERS = read_workers
+    if render_workers is not None:
+        RENDER_WORKERS = render_workers
+    shutdown(wait=False)
+
+
+def shutdown(wait=True):
+    """
+    Shuts down the executors.
+    :param wait: optional - whether to wait for the work in progress to finish
+    :return: no return
+    """
+    with _lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=wait)
+
+
+def _init_render_worker():
+    """
+    Sets up a rendering process: plots are only ever saved to files there.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _executor(kind):
+    """
+    Returns the executor for "io" (threads), "read" or "render" (processes)
+    work, creating it on first use.
+    """
+    with _lock:
+        executor = _executors.get(kind)
+        if executor is None:
+            if kind == 'io':
+                executor = ThreadPoolExecutor(max_workers=IO_WORKERS)
+            elif kind == 'read':
+                executor = ProcessPoolExecutor(max_workers=READ_WORKERS)
+            else:
+                executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS,
+                                               initializer=_init_render_worker)
+            _executors[kind] = executor
+    return executor
+
+
+async def _run(kind, timeout, func, *args):
+    """
+    Runs a blocking function on one of the executors, with a timeout.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_executor(kind), func, *args)
+    # On a timeout or cancellation wait_for cancels the future, which removes the
+    # call from the executor's queue if it has not started yet
+    return await asyncio.wait_for(future, timeout)
+
+
+def _detach(result):
+    """
+    Replaces the Variable objects in an extract function result by arrays of
+    their values, so that the result can be used after the file is closed.
+    """
+    items = result if isinstance(result, tuple) else (result,)
+    items = tuple(np.ma.asarray(item[:]) if hasattr(item, 'dimensions') else item
+                  for item in items)
+    return items if isinstance(result, tuple) else items[0]
+
+
+def _settings():
+    """
+    Returns the settings of the cache and extract modules that a reading process
+    needs, which it does not share with this process.
+    """
+    return {'cache_dir': cache.CACHE_DIR, 'cache_max_bytes': cache.MAX_BYTES,
+            'nan_fill': extract.NAN_FILL, 'compute_dtype': extract.COMPUTE_DTYPE,
+            'memory_budget': extract.MEMORY_BUDGET}
+
+
+def _is_classic(filename):
+    """
+    Returns True if a file is a NetCDF-3 file, which can be read by threads.
+    """
+    try:
+        return classic.is_classic_file(filename)
+    except (IOError, OSError):
+        # The reading process reports the error
+        return False
+
+
+def _extract(func_name, filename, varname, args, settings=None):
+    """
+    Calls an extract function on its own handle of the file (handles must not be
+    shared between threads), holding the lock that the file needs (see
+    netcdf_utils.thread_lock).  In a reading process, the settings of the
+    calling process are applied first.
+    """
+    if settings is not None:
+        cache.CACHE_DIR = settings['cache_dir']
+        cache.MAX_BYTES = settings['cache_max_bytes']
+        extract.NAN_FILL = settings['nan_fill']
+        extract.COMPUTE_DTYPE = settings['compute_dtype']
+        extract.MEMORY_BUDGET = settings['memory_budget']
+    with nu.thread_lock(filename):
+        nc = nu.open_dataset(filename)
+    try:
+        data_var = expression.lookup(nc, varname)
+        func = getattr(extract, func_name)
+        # The lock does nothing for NetCDF-3 files, and a reading process runs
+        # one extract at a time, so it is never waited for here
+        with nu.thread_lock(filename):
+            return _detach(cache.cached_call(func, nc, data_var, *args))
+    finally:
+        with nu.thread_lock(filename):
+            nc.close()
+
+
+async def _run_extract(timeout, func_name, filename, varname, args):
+    """
+    Runs an extract function on the executor suited to the file: threads for
+    NetCDF-3 files, processes for all others.  Checking the format of the file
+    reads it, so it is done on a thread too.
+    """
+    loop = asyncio.get_running_loop()
+    is_classic = await loop.run_in_executor(_executor('io'), _is_classic, filename)
+    if is_classic:
+        return await _run('io', timeout, _extract, func_name, filename, varname, args)
+    return await _run('read', timeout, _extract, func_name, filename, varname, args,
+                      _settings())
+
+
+def _plot(func_name, args):
+    """
+    Calls a plot function of the main module in a rendering process.
+    """
+    import main
+    getattr(main, func_name)(*args)
+    return args[-1]
+
+
+async def extract_map_data(filename, varname, t_index, z_index, timeout=None):
+    """
+    Asynchronous version of extract.extract_map_data_downsampled.
+    :param filename: location of a NetCDF file
+    :param varname: the identifier of the variable (or an expression)
+    :param t_index: the desired index along the time axis (if present) - an integer
+    :param z_index: the desired index along the z-axis (if present) - an integer
+    :param timeout: optional - seconds to wait for the result
+    :raise asyncio.TimeoutError: if the result is not ready within the timeout
+    :return: the 2D array of map data, and the longitude and latitude values
+    """
+    return await _run_extract(timeout, 'extract_map_data_downsampled',
+                              filename, varname, (t_index, z_index))
+
+
+async def extract_vertical_data(filename, varname, direction, value, t_index, timeout=None):
+    """
+    Asynchronous version of extract.extract_vertical_data.  The coordinates are
+    returned as arrays rather than Variable objects.
+    :param filename: location of a NetCDF file
+    :param varname: the identifier of the variable (or an expression)
+    :param direction: the direction of the vertical section, "NS" or "EW"
+    :param value: the latitude or longitude that section represents
+    :param t_index: the desired index along the time axis (if present) - an integer
+    :param timeout: optional - seconds to wait for the result
+    :raise asyncio.TimeoutError: if the result is not ready within the timeout
+    :return: the section data, the horizontal and the vertical coordinate values
+    """
+    return await _run_extract(timeout, 'extract_vertical_data',
+                              filename, varname, (direction, value, t_index))
+
+
+async def extract_timeseries(filename, varname, lon, lat, z, timeout=None):
+    """
+    Asynchronous version of extract.extract_timeseries.  The times are returned
+    as an array of values rather than a Variable object.
+    :param filename: location of a NetCDF file
+    :param varname: the identifier of the variable (or an expression)
+    :param lon: the value of longitude in degrees
+    :param lat: the value of latitude in degrees
+    :param z: the value of vertical coordinate variable
+    :param timeout: optional - seconds to wait for the result
+    :raise asyncio.TimeoutError: if the result is not ready within the timeout
+    :return: the time series data and the time values
+    """
+    return await _run_extract(timeout, 'extract_timeseries',
+                              filename, varname, (lon, lat, z))
+
+
+async def plot_map(filename, varname, t_index, z_index, output, timeout=None):
+    """
+    Asynchronous version of main.plot_map, saving the plot to an image file.
+    :param filename: location of a NetCDF file
+    :param varname: the identifier of the variable (or an expression)
+    :param t_index: index along the time axis as an integer
+    :param z_index: index along the vertical axis as an integer
+    :param output: location of the image file
+    :param timeout: optional - seconds to wait for the plot
+    :raise asyncio.TimeoutError: if the plot is not finished within the timeout
+    :return: the location of the image file
+    """
+    return await _run('render', timeout, _plot, 'plot_map',
+                      (filename, varname, t_index, z_index, output))
+
+
+async def plot_vertical_section(filename, varname, direction, value, t_index, output,
+                                timeout=None):
+    """
+    Asynchronous version of main.plot_vertical_section, saving the plot to an
+    image file.
+    :param filename: location of a NetCDF file
+    :param varname: the identifier of the variable (or an expression)
+    :param direction: the direction of the vertical section, "NS" or "EW"
+    :param value: the latitude or longitude that section represents
+    :param t_index: index along the time axis as an integer
+    :param output: location of the image file
+    :param timeout: optional - seconds to wait for the plot
+    :raise asyncio.TimeoutError: if the plot is not finished within the timeout
+    :return: the location of the image file
+    """
+    return await _run('render', timeout, _plot, 'plot_vertical_section',
+                      (filename, varname, direction, value, t_index, output))
+
+
+async def plot_timeseries(filename, varname, lon, lat, z, output, timeout=None):
+    """
+    Asynchronous version of main.plot_timeseries, saving the plot to an image file.
+    :param filename: location of a NetCDF file
+    :param varname: the identifier of the variable (or an expression)
+    :param lon: the value of longitude in degrees
+    :param lat: the value of latitude in degrees
+    :param z: the value of vertical coordinate variable
+    :param output: location of the image file
+    :param timeout: optional - seconds to wait for the plot
+    :raise asyncio.TimeoutError: if the plot is not finished within the timeout
+    :return: the location of the image file
+    """
+    return await _run('render', timeout, _plot, 'plot_timeseries',
+                      (filename, varname, lon, lat, z, output))
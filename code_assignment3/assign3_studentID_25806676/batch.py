@@ -0,0 +1,347 @@
+""" Contains a command-line batch runner for plot and extract tasks listed in a
+    job file, e.g.
+
+        {"output_dir": "plots",
+         "workers": 4,
+         "tasks": [
+             {"kind": "plot_map", "file": "ostia.nc", "varname": "analysed_sst",
+              "t_index": 0, "z_index": 0, "output": "sst.png"},
+             {"id": "ta_section", "kind": "plot_vertical_section",
+              "file": "GlobModel_temp.nc", "varname": "ta", "direction": "NS",
+              "value": 0, "t_index": 0, "output": "ta_ns.png"},
+             {"kind": "extract_timeseries", "file": "ostia.nc",
+              "varname": "analysed_sst", "lon": -20, "lat": 50, "z": 0,
+              "output": "sst_series.npz"},
+             {"kind": "plot_ozone_difference", "file": "GlobModel_ozone.nc",
+              "sciamachy_file": "sciamachy.csv", "output": "ozone.png"}]}
+
+    Job files are JSON, or YAML if their name ends in .yaml or .yml (which needs
+    PyYAML).  Tasks are grouped by input file; every group runs in one worker
+    process, which opens its file once and shares the handle (and the axis
+    lookups and chunk caches that go with it) between its tasks.  Plots are saved
+    to image files and extracted data to .npz files in the output directory.
+
+    When a task finishes, a record of it is written to the ".batch" directory in
+    the output directory.  A task whose record matches its definition and the
+    current version of its input files is skipped when the job is run again, so
+    an interrupted run can simply be restarted.  A summary of all tasks with their
+    status and timing is written to "summary.json".
+
+    Run this script to run a job file, e.g.
+    python batch.py jobs.json --workers 8 """
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+import numpy as np
+import cache
+import expression
+import extract
+import netcdf_utils as nu
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# The parameters of each kind of task (besides "file" and "output")
+TASK_KINDS = OrderedDict([
+    ('plot_map', ('varname', 't_index', 'z_index')),
+    ('plot_vertical_section', ('varname', 'direction', 'value', 't_index')),
+    ('plot_timeseries', ('varname', 'lon', 'lat', 'z')),
+    ('plot_ozone_difference', ('sciamachy_file',)),
+    ('extract_map_data', ('varname', 't_index', 'z_index')),
+    ('extract_vertical_data', ('varname', 'direction', 'value', 't_index')),
+    ('extract_timeseries', ('varname', 'lon', 'lat', 'z')),
+])
+# Parameters that may be left out, with their defaults
+OPTIONAL_PARAMETERS = {'projection': None}
+
+# Default number of worker processes
+WORKERS = 4
+# Name of the directory (in the output directory) holding the task records
+STATE_DIR = '.batch'
+
+
+def load_job(filename):
+    """
+    Reads a job file and checks its tasks.  Tasks without an "id" are named after
+    their kind and position.
+    :param filename: location of the job file
+    :raise ValueError: if a task is of an unknown kind or lacks a parameter
+    :raise RuntimeError: if the job file is YAML and PyYAML is not installed
+    :return: dictionary of the job, with the list of tasks under "tasks"
+    """
+    with open(filename) as f:
+        if filename.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise RuntimeError("Reading YAML job files needs PyYAML")
+            job = yaml.safe_load(f)
+        else:
+            job = json.load(f)
+    ids = set()
+    for i, task in enumerate(job.get('tasks', [])):
+        kind = task.get('kind')
+        if kind not in TASK_KINDS:
+            raise ValueError("Task %d is of unknown kind %r; need one of %s"
+                             % (i, kind, ', '.join(TASK_KINDS)))
+        task.setdefault('id', '%s_%d' % (kind, i))
+        missing = [p for p in ('file', 'output') + TASK_KINDS[kind] if p not in task]
+        if missing:
+            raise ValueError("Task %s needs %s" % (task['id'], ', '.join(missing)))
+        if task['id'] in ids:
+            raise ValueError("Task id %s is used more than once" % task['id'])
+        ids.add(task['id'])
+    return job
+
+
+def task_key(task):
+    """
+    Builds the key identifying a task and the version of its input files, so
+    that a task is run again if its definition or any of its inputs changes.
+    :param task: dictionary of the task
+    :return: the key as a hexadecimal string
+    """
+    inputs = [task['file']] + ([task['sciamachy_file']] if 'sciamachy_file' in task else [])
+    description = [task, [cache.file_identity(f) for f in inputs]]
+    text = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _record_path(output_dir, task):
+    """
+    Returns the location of the record of a finished task.
+    """
+    return os.path.join(output_dir, STATE_DIR, '%s.json' % task['id'])
+
+
+def is_done(output_dir, task):
+    """
+    Returns True if a task has been completed before with the same definition
+    and inputs, and its output is still there.
+    :param output_dir: the output directory of the job
+    :param task: dictionary of the task
+    :return: True if the task can be skipped
+    """
+    try:
+        with open(_record_path(output_dir, task)) as f:
+            record = json.load(f)
+        key = task_key(task)
+    except (IOError, OSError, ValueError):
+        return False
+    return record.get('key') == key and record.get('status') == 'done' and \
+        os.path.exists(os.path.join(output_dir, task['output']))
+
+
+def _write_record(output_dir, task, record):
+    """
+    Writes the record of a task, under a temporary name first so that a record is
+    never seen half written.
+    """
+    path = _record_path(output_dir, task)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(record, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def save_result(result, output):
+    """
+    Saves the result of an extract function to a .npz file: arrays as "data_0",
+    "data_1", ..., the masks of masked arrays as "mask_0", ..., and Variable
+    objects (coordinates) as their values.
+    :param result: an array, or a tuple of arrays and Variable objects
+    :param output: location of the .npz file
+    :return: no return
+    """
+    items = result if isinstance(result, tuple) else (result,)
+    arrays = {}
+    for i, item in enumerate(items):
+        values = np.ma.asarray(item[:]) if hasattr(item, 'dimensions') else item
+        arrays['data_%d' % i] = np.ma.getdata(values)
+        if np.ma.isMaskedArray(values):
+            arrays['mask_%d' % i] = np.ma.getmaskarray(values)
+    np.savez(output, **arrays)
+
+
+def run_task(task, output, nc):
+    """
+    Runs one task, with the input file already open.
+    :param task: dictionary of the task
+    :param output: location of the output file
+    :param nc: the input file as a Dataset object (None for ozone comparisons,
+               which read their files themselves)
+    :return: no return
+    """
+    kind = task['kind']
+    args = [task[p] for p in TASK_KINDS[kind]]
+    if kind == 'plot_ozone_difference':
+        import ozone
+        projection = task.get('projection', OPTIONAL_PARAMETERS['projection'])
+        if projection is None:
+            ozone.plot_difference(task['file'], task['sciamachy_file'], output)
+        else:
+            ozone.plot_difference_basemap(task['file'], task['sciamachy_file'], projection,
+                                          output)
+    elif kind.startswith('plot_'):
+        import main
+        getattr(main, kind)(task['file'], *args, output=output, nc=nc)
+    else:
+        data_var = expression.lookup(nc, args[0])
+        save_result(cache.cached_call(getattr(extract, kind), nc, data_var, *args[1:]),
+                    output)
+
+
+def run_group(tasks, output_dir):
+    """
+    Worker function: runs the tasks on one input file, through one handle of the
+    file.  A failing task is recorded and does not stop the others.
+    :param tasks: list of task dictionaries, all with the same "file"
+    :param output_dir: the output directory of the job
+    :return: list of the records of the tasks
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    needs_nc = any(task['kind'] != 'plot_ozone_difference' for task in tasks)
+    nc = None
+    records = []
+    try:
+        for task in tasks:
+            record = {'id': task['id'], 'kind': task['kind'], 'file': task['file'],
+                      'output': task['output'], 'key': None}
+            start = time.perf_counter()
+            try:
+                # The key reads the identity of the input files, so a missing
+                # input fails the task here rather than the whole group
+                record['key'] = task_key(task)
+                if nc is None and needs_nc:
+                    nc = nu.open_dataset(task['file'])
+                output = os.path.join(output_dir, task['output'])
+                run_task(task, output, None if task['kind'] == 'plot_ozone_difference' else nc)
+                record['status'] = 'done'
+            except Exception as e:
+                record['status'] = 'failed'
+                record['error'] = '%s: %s' % (type(e).__name__, e)
+                record['traceback'] = traceback.format_exc()
+            record['seconds'] = time.perf_counter() - start
+            _write_record(output_dir, task, record)
+            records.append(record)
+    finally:
+        if nc is not None:
+            nc.close()
+    return records
+
+
+def group_tasks(tasks):
+    """
+    Groups tasks by input file, keeping the order of the job file within groups.
+    :param tasks: list of task dictionaries
+    :return: list of lists of tasks
+    """
+    groups = OrderedDict()
+    for task in tasks:
+        groups.setdefault(os.path.abspath(task['file']), []).append(task)
+    return list(groups.values())
+
+
+def run_job(job, output_dir=None, workers=None, force=False):
+    """
+    Runs the tasks of a job over a pool of worker processes, skipping tasks
+    completed by earlier runs, and writes a summary.
+    :param job: dictionary of the job (see load_job)
+    :param output_dir: optional - the output directory (the job's "output_dir", or
+                       the current directory, if not given)
+    :param workers: optional - the number of worker processes (the job's "workers",
+                    or WORKERS, if not given)
+    :param force: optional - if True, run all tasks even if they were completed
+    :return: dictionary of the summary: the records of all tasks in the order of
+             the job file, and the counts and total time of each status
+    """
+    output_dir = output_dir or job.get('output_dir', '.')
+    workers = workers or job.get('workers', WORKERS)
+    state_dir = os.path.join(output_dir, STATE_DIR)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+
+    tasks = job.get('tasks', [])
+    records = {}
+    pending = []
+    for task in tasks:
+        if not force and is_done(output_dir, task):
+            with open(_record_path(output_dir, task)) as f:
+                records[task['id']] = dict(json.load(f), status='skipped')
+        else:
+            pending.append(task)
+
+    start = time.perf_counter()
+    groups = group_tasks(pending)
+    if workers <= 1 or len(groups) <= 1:
+        results = [run_group(group, output_dir) for group in groups]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(groups))) as pool:
+            futures = [pool.submit(run_group, group, output_dir) for group in groups]
+            results = []
+            for group, future in zip(groups, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # The worker itself failed (e.g. it was killed), so none of
+                    # its tasks were recorded
+                    results.append([{'id': task['id'], 'kind': task['kind'],
+                                     'file': task['file'], 'output': task['output'],
+                                     'key': None, 'status': 'failed', 'seconds': 0.,
+                                     'error': '%s: %s' % (type(e).__name__, e)}
+                                    for task in group])
+    for group_records in results:
+        for record in group_records:
+            records[record['id']] = record
+
+    summary = {'tasks': [records[task['id']] for task in tasks],
+               'seconds': time.perf_counter() - start}
+    for status in ('done', 'failed', 'skipped'):
+        summary[status] = sum(1 for r in summary['tasks'] if r['status'] == status)
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    return summary
+
+
+def format_summary(summary):
+    """
+    Formats a summary as a table, one line per task.
+    :param summary: the result of run_job
+    :return: the table as a string
+    """
+    lines = ['%-30s %-22s %-8s %10s' % ('task', 'kind', 'status', 'time/s')]
+    for r in summary['tasks']:
+        lines.append('%-30s %-22s %-8s %10.3f%s' % (
+            r['id'], r['kind'], r['status'], r.get('seconds', 0.),
+            '  ' + r['error'] if r['status'] == 'failed' else ''))
+    lines.append('%d done, %d skipped, %d failed in %.3f s'
+                 % (summary['done'], summary['skipped'], summary['failed'], summary['seconds']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the plot and extract tasks of a job file')
+    parser.add_argument('job_file', help='JSON (or YAML) file listing the tasks')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes (default: from the job file, or %d)'
+                             % WORKERS)
+    parser.add_argument('--output-dir', default=None,
+                        help='directory for the outputs (default: from the job file)')
+    parser.add_argument('--force', action='store_true',
+                        help='run all tasks, including those completed by earlier runs')
+    args = parser.parse_args()
+
+    summary = run_job(load_job(args.job_file), args.output_dir, args.workers, args.force)
+    print(format_summary(summary))
+    sys.exit(1 if summary['failed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
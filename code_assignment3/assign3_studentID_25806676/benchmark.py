@@ -0,0 +1,457 @@
+""" Benchmarks for the extract layer.  Synthetic CF-compliant NetCDF files are
+    generated in a temporary directory, the hot paths are timed with a warm cache
+    (one open Dataset, repeated calls) and a cold cache (the file is reopened and,
+    where the OS allows, dropped from the page cache before every call), and the
+    results are written as JSON so that they can be compared across commits.
+
+    The import time of the modules used by extract-only jobs is also measured,
+    in fresh interpreters, and checked against a budget: these modules must not
+    load matplotlib or Basemap, which plotting modules import on first use.
+
+    Run this script to run the benchmarks, e.g.
+    python benchmark.py --size 24,10,180,360 --chunking map --output results.json
+    python benchmark.py --compare old.json new.json
+    python benchmark.py --check-imports """
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import netCDF4
+import numpy as np
+import extract
+import globmodel
+import netcdf_utils as nu
+import rechunk
+
+# Default grid size: (time, z, lat, lon)
+DEFAULT_SIZE = (12, 10, 180, 360)
+# Modules that extract-only jobs import, and the largest time in seconds an
+# import of one of them (including numpy and netCDF4) may take
+IMPORT_MODULES = ('netcdf_utils', 'extract', 'globmodel', 'main', 'ozone')
+IMPORT_BUDGET = 0.5
+# Modules that must not be loaded by importing IMPORT_MODULES
+HEAVY_MODULES = ('matplotlib', 'mpl_toolkits.basemap')
+
+
+def make_synthetic_file(path, size=DEFAULT_SIZE, ndim=4, chunking=None, complevel=0,
+                        file_format='NETCDF4', varname='ta'):
+    """
+    Writes a synthetic CF-compliant file with a data variable on a regular global
+    grid, with time, (optionally) pressure levels, latitude and longitude axes.
+    :param path: location of the new file
+    :param size: optional - (n_time, n_z, n_lat, n_lon); n_z is ignored if ndim is 3
+    :param ndim: optional - 3 for (time, lat, lon) or 4 for (time, z, lat, lon)
+    :param chunking: optional - None for contiguous storage, an access pattern
+                     ("timeseries", "map" or "section") or a list of chunk sizes
+    :param complevel: optional - the deflate level (0 for no compression)
+    :param file_format: optional - "NETCDF4" or one of the NetCDF-3 formats
+    :param varname: optional - the name of the data variable
+    :return: no return
+    """
+    if ndim not in (3, 4):
+        raise ValueError("Synthetic files must have 3 or 4 dimensions")
+    if isinstance(chunking, str):
+        # Write contiguously first, then rewrite with the pattern's chunking
+        tmp_path = path + '.contiguous'
+        make_synthetic_file(tmp_path, size, ndim, None, 0, 'NETCDF4', varname)
+        rechunk.rechunk(tmp_path, varname, path, chunking, complevel=complevel)
+        os.remove(tmp_path)
+        return
+
+    n_t, n_z, n_lat, n_lon = size
+    nc = netCDF4.Dataset(path, 'w', format=file_format)
+    try:
+        nc.Conventions = 'CF-1.6'
+        # Contiguous NetCDF-4 variables cannot have an unlimited dimension, so
+        # time is only a record dimension in NetCDF-3 files
+        nc.createDimension('time', n_t if file_format == 'NETCDF4' else None)
+        t_var = nc.createVariable('time', 'f8', ('time',))
+        t_var.units = 'hours since 2006-08-20 00:00:00'
+        t_var.calendar = 'standard'
+        t_var.standard_name = 'time'
+        dims = ['time']
+        if ndim == 4:
+            nc.createDimension('plev', n_z)
+            z_var = nc.createVariable('plev', 'f4', ('plev',))
+            z_var.units = 'hPa'
+            z_var.positive = 'down'
+            z_var[:] = np.linspace(1000., 100., n_z)
+            dims.append('plev')
+        nc.createDimension('lat', n_lat)
+        lat_var = nc.createVariable('lat', 'f4', ('lat',))
+        lat_var.units = 'degrees_north'
+        lat_var[:] = np.linspace(-90., 90., n_lat)
+        nc.createDimension('lon', n_lon)
+        lon_var = nc.createVariable('lon', 'f4', ('lon',))
+        lon_var.units = 'degrees_east'
+        lon_var[:] = np.arange(n_lon) * 360. / n_lon
+        dims += ['lat', 'lon']
+
+        kwargs = {}
+        if file_format == 'NETCDF4':
+            kwargs = {'zlib': complevel > 0, 'complevel': complevel or 4,
+                      'chunksizes': chunking}
+            if chunking is None and complevel == 0:
+                kwargs = {'contiguous': True}
+        data_var = nc.createVariable(varname, 'f4', tuple(dims), fill_value=-999., **kwargs)
+        data_var.units = 'K'
+        data_var.standard_name = 'air_temperature'
+
+        # Write one time step at a time: a smooth field plus noise
+        lats = np.radians(lat_var[:])[:, np.newaxis]
+        lons = np.radians(lon_var[:])[np.newaxis, :]
+        rand = np.random.RandomState(0)
+        for t in range(n_t):
+            t_var[t] = t * 6.
+            field = 250. + 40. * np.cos(lats) + 5. * np.sin(lons + t * 0.1)
+            if ndim == 4:
+                field = field[np.newaxis] - np.linspace(0., 60., n_z)[:, np.newaxis, np.newaxis]
+            data_var[t] = (field + rand.standard_normal(field.shape)).astype(np.float32)
+    finally:
+        nc.close()
+
+
+def make_globmodel_file(path, n_lat=90, n_lon=180):
+    """
+    Writes a synthetic GlobModel file with an ozone column variable "colo3".
+    :param path: location of the new file
+    :param n_lat: optional - the number of latitudes
+    :param n_lon: optional - the number of longitudes
+    :return: no return
+    """
+    nc = netCDF4.Dataset(path, 'w')
+    try:
+        nc.createDimension('time', 1)
+        t_var = nc.createVariable('time', 'f8', ('time',))
+        t_var.units = 'days since 2006-08-20 00:00:00'
+        t_var[:] = 0.
+        nc.createDimension('lat', n_lat)
+        lat_var = nc.createVariable('lat', 'f4', ('lat',))
+        lat_var.units = 'degrees_north'
+        lat_var[:] = np.linspace(-90., 90., n_lat)
+        nc.createDimension('lon', n_lon)
+        lon_var = nc.createVariable('lon', 'f4', ('lon',))
+        lon_var.units = 'degrees_east'
+        lon_var[:] = np.arange(n_lon) * 360. / n_lon
+        colo3 = nc.createVariable('colo3', 'f4', ('time', 'lat', 'lon'))
+        colo3.units = 'kg m-2'
+        colo3[0] = (300. + 50. * np.cos(np.radians(lat_var[:]))[:, np.newaxis]
+                    * np.ones(n_lon)) * 2.1414E-5
+    finally:
+        nc.close()
+
+
+def drop_page_cache(path):
+    """
+    Asks the OS to drop a file from the page cache, so that the next read comes
+    from disk.  This is only possible where posix_fadvise is available; elsewhere
+    the "cold" timings only include reopening the file.
+    :param path: location of the file
+    :return: True if the request was made, False otherwise
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def time_call(func, repeat, setup=None):
+    """
+    Times repeated calls of a function.
+    :param func: the function to be timed, called with the result of setup()
+    :param repeat: the number of calls
+    :param setup: optional - untimed function called before each call
+    :return: list of the times of the calls in seconds
+    """
+    times = []
+    for i in range(repeat):
+        arg = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(name, variant, config, times):
+    """
+    Summarizes the timings of one benchmark as a dictionary.
+    """
+    return {'name': name, 'variant': variant, 'config': config, 'repeat': len(times),
+            'min': min(times), 'median': float(np.median(times)), 'mean': float(np.mean(times))}
+
+
+def benchmark_file(path, config, repeat=5, varname='ta'):
+    """
+    Times the extract functions and nearest-index helpers on one file, with warm
+    and cold caches.
+    :param path: location of a synthetic file
+    :param config: dictionary describing the file, copied into the results
+    :param repeat: optional - the number of calls of each function
+    :param varname: optional - the name of the data variable
+    :return: list of result dictionaries
+    """
+    # Files without a vertical axis have no vertical sections and no z index
+    has_z = config.get('ndim') != 3
+    z = 500. if has_z else None
+    calls = [
+        ('extract_map_data', lambda nc, v: extract.extract_map_data(nc, v, 0, 0)),
+        ('extract_timeseries', lambda nc, v: extract.extract_timeseries(nc, v, 90., 10., z)),
+        ('find_nearest_lat_index', lambda nc, v: nu.find_nearest_lat_index(nc, v, 10.)),
+        ('find_nearest_lon_index', lambda nc, v: nu.find_nearest_lon_index(nc, v, 90.)),
+    ]
+    if has_z:
+        calls += [
+            ('extract_vertical_data',
+             lambda nc, v: extract.extract_vertical_data(nc, v, 'NS', 90., 0)),
+            ('find_nearest_z_index', lambda nc, v: nu.find_nearest_z_index(nc, v, 500.)),
+        ]
+
+    results = []
+    nc = nu.open_dataset(path)
+    try:
+        data_var = nc.variables[varname]
+        for name, call in calls:
+            # Warm: one handle, and one untimed call to fill the caches
+            call(nc, data_var)
+            times = time_call(lambda arg: call(nc, data_var), repeat)
+            results.append(summarize(name, 'warm', config, times))
+    finally:
+        nc.close()
+
+    def cold_open():
+        drop_page_cache(path)
+        return path
+
+    for name, call in calls:
+        def cold_call(p):
+            cold_nc = nu.open_dataset(p)
+            try:
+                call(cold_nc, cold_nc.variables[varname])
+            finally:
+                cold_nc.close()
+        results.append(summarize(name, 'cold', config, time_call(cold_call, repeat, cold_open)))
+    return results
+
+
+def benchmark_globmodel(path, n_obs=1000, repeat=5):
+    """
+    Times globmodel.read_globmodel for a set of random observation locations.
+    :param path: location of a synthetic GlobModel file
+    :param n_obs: optional - the number of observation locations
+    :param repeat: optional - the number of calls
+    :return: list of result dictionaries
+    """
+    rand = np.random.RandomState(1)
+    lons = rand.uniform(0., 360., n_obs)
+    lats = rand.uniform(-90., 90., n_obs)
+    config = {'n_obs': n_obs}
+    times = time_call(lambda arg: globmodel.read_globmodel(path, lons, lats), repeat,
+                      lambda: drop_page_cache(path))
+    return [summarize('read_globmodel', 'cold', config, times)]
+
+
+def time_import(module, repeat=5):
+    """
+    Times the import of a module in fresh interpreters, so that nothing is
+    already imported, and finds which heavy modules (see HEAVY_MODULES) the
+    import loads.
+    :param module: the name of the module
+    :param repeat: optional - the number of interpreters started
+    :return: list of the import times in seconds, and the list of heavy modules
+             loaded
+    """
+    code = ('import json, sys, time\n'
+            'start = time.perf_counter()\n'
+            'import %s\n'
+            'seconds = time.perf_counter() - start\n'
+            'print(json.dumps([seconds, [m for m in %r if m in sys.modules]]))'
+            % (module, HEAVY_MODULES))
+    times = []
+    heavy = []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+        seconds, heavy = json.loads(out.decode().strip().splitlines()[-1])
+        times.append(seconds)
+    return times, heavy
+
+
+def benchmark_imports(modules=IMPORT_MODULES, repeat=5, budget=IMPORT_BUDGET):
+    """
+    Times the imports of the modules used by extract-only jobs, and checks them
+    against the import budget.
+    :param modules: optional - the names of the modules
+    :param repeat: optional - the number of imports of each module
+    :param budget: optional - the largest median import time in seconds
+    :return: list of result dictionaries, each with "within_budget" (False if the
+             median time is over the budget or a heavy module was loaded) and
+             "heavy_modules" entries
+    """
+    results = []
+    for module in modules:
+        times, heavy = time_import(module, repeat)
+        result = summarize('import ' + module, 'cold', {'budget': budget}, times)
+        result['heavy_modules'] = heavy
+        result['within_budget'] = result['median'] <= budget and not heavy
+        results.append(result)
+    return results
+
+
+def git_commit():
+    """
+    Returns the current git commit of this code, or None if it is not known.
+    """
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.DEVNULL)
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=(DEFAULT_SIZE,), ndims=(4,), chunkings=(None,), complevels=(0,),
+        file_formats=('NETCDF4',), repeat=5, n_obs=1000, work_dir=None):
+    """
+    Generates synthetic files for every combination of the settings and
+    benchmarks them.
+    :param sizes: optional - sequence of (n_time, n_z, n_lat, n_lon) grid sizes
+    :param ndims: optional - sequence of dimensionalities (3 or 4)
+    :param chunkings: optional - sequence of chunkings (see make_synthetic_file)
+    :param complevels: optional - sequence of deflate levels
+    :param file_formats: optional - sequence of file formats
+    :param repeat: optional - the number of calls of each function
+    :param n_obs: optional - the number of locations for read_globmodel
+    :param work_dir: optional - directory for the files (a temporary directory
+                     that is deleted afterwards if not given)
+    :return: dictionary of the environment and the list of results
+    """
+    tmp_dir = work_dir or tempfile.mkdtemp(prefix='extract_benchmark_')
+    results = []
+    try:
+        for size in sizes:
+            for ndim in ndims:
+                for chunking in chunkings:
+                    for complevel in complevels:
+                        for file_format in file_formats:
+                            if file_format != 'NETCDF4' and (chunking or complevel):
+                                # NetCDF-3 files can be neither chunked nor compressed
+                                continue
+                            config = {'size': list(size), 'ndim': ndim, 'chunking': chunking,
+                                      'complevel': complevel, 'format': file_format}
+                            path = os.path.join(tmp_dir, 'synthetic.nc')
+                            make_synthetic_file(path, size, ndim, chunking, complevel,
+                                                file_format)
+                            results.extend(benchmark_file(path, config, repeat))
+                            os.remove(path)
+        glob_path = os.path.join(tmp_dir, 'globmodel.nc')
+        make_globmodel_file(glob_path)
+        results.extend(benchmark_globmodel(glob_path, n_obs, repeat))
+        results.extend(benchmark_imports(repeat=repeat))
+    finally:
+        if work_dir is None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'netCDF4': netCDF4.__version__,
+            'results': results}
+
+
+def compare(old, new):
+    """
+    Compares two sets of benchmark results, matching benchmarks by name, variant
+    and configuration.
+    :param old: the results of run() for the baseline
+    :param new: the results of run() to be compared with the baseline
+    :return: list of (name, variant, config, old median, new median, ratio) tuples
+    """
+    def key(r):
+        return r['name'], r['variant'], json.dumps(r['config'], sort_keys=True)
+    old_results = dict((key(r), r) for r in old['results'])
+    rows = []
+    for r in new['results']:
+        if key(r) in old_results:
+            old_median = old_results[key(r)]['median']
+            rows.append((r['name'], r['variant'], r['config'], old_median, r['median'],
+                         r['median'] / old_median if old_median > 0 else float('nan')))
+    return rows
+
+
+def _parse_chunking(text):
+    """
+    Parses a --chunking option: "none", an access pattern, or comma-separated sizes.
+    """
+    if text == 'none':
+        return None
+    if text in rechunk.ACCESS_PATTERNS:
+        return text
+    return [int(n) for n in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', action='append', default=None,
+                        help='grid size as n_time,n_z,n_lat,n_lon (repeatable)')
+    parser.add_argument('--ndim', action='append', type=int, default=None, choices=(3, 4))
+    parser.add_argument('--chunking', action='append', default=None,
+                        help='none, timeseries, map, section or chunk sizes (repeatable)')
+    parser.add_argument('--complevel', action='append', type=int, default=None)
+    parser.add_argument('--format', action='append', default=None, dest='file_format',
+                        choices=('NETCDF4', 'NETCDF3_CLASSIC', 'NETCDF3_64BIT_OFFSET'))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--n-obs', type=int, default=1000)
+    parser.add_argument('--output', help='file for the JSON results (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    parser.add_argument('--check-imports', action='store_true',
+                        help='only check the import times against the budget; the exit '
+                             'status is 1 if any is over it')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET,
+                        help='the largest import time in seconds (default: %(default)s)')
+    args = parser.parse_args()
+
+    if args.check_imports:
+        results = benchmark_imports(repeat=args.repeat, budget=args.import_budget)
+        for r in results:
+            print('%-24s %10.5f s %-8s %s' % (r['name'], r['median'],
+                                              'ok' if r['within_budget'] else 'OVER',
+                                              ', '.join(r['heavy_modules'])))
+        sys.exit(0 if all(r['within_budget'] for r in results) else 1)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        for name, variant, config, old_median, new_median, ratio in compare(old, new):
+            print('%-24s %-5s %-60s %10.5f %10.5f %6.2fx' % (
+                name, variant, json.dumps(config, sort_keys=True), old_median, new_median, ratio))
+        return
+
+    sizes = [tuple(int(n) for n in s.split(',')) for s in args.size] if args.size \
+        else [DEFAULT_SIZE]
+    results = run(sizes, args.ndim or [4],
+                  [_parse_chunking(c) for c in args.chunking] if args.chunking else [None],
+                  args.complevel or [0], args.file_format or ['NETCDF4'],
+                  args.repeat, args.n_obs)
+    text = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+""" Contains code for caching extracted data on disk, so that repeated requests
+    for the same slice of the same file do not need to decode the NetCDF data again """
+
+import hashlib
+import json
+import os
+import numpy as np
+import extract
+import instrument
+
+# Directory holding the cached results.  Caching is switched off while this is None.
+CACHE_DIR = None
+# Upper bound on the total size (in bytes) of all the files in the cache directory
+MAX_BYTES = 1024 ** 3
+
+
+def enable(cache_dir, max_bytes=None):
+    """
+    Switches on the result cache, storing entries in the given directory (which is
+    created if it does not exist yet).
+    :param cache_dir: path of the directory holding the cached results
+    :param max_bytes: optional - the maximum total size of the cache in bytes
+    :return: no return
+    """
+    global CACHE_DIR, MAX_BYTES
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    CACHE_DIR = cache_dir
+    if max_bytes is not None:
+        MAX_BYTES = max_bytes
+
+
+def disable():
+    """
+    Switches off the result cache.  Entries already on disk are left in place.
+    :return: no return
+    """
+    global CACHE_DIR
+    CACHE_DIR = None
+
+
+def file_identity(filename):
+    """
+    Returns the properties identifying the current contents of a file: its absolute
+    path, its size and its modification time.  If the file is rewritten, the identity
+    changes and older cache entries are simply never hit again.
+    :param filename: location of a file
+    :return: list of [path, size, mtime in nanoseconds]
+    """
+    st = os.stat(filename)
+    return [os.path.abspath(filename), st.st_size,
+            getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))]
+
+
+def normalize_arg(arg):
+    """
+    Converts an argument of an extract function into a plain JSON value, so that
+    equal arguments always give equal keys (e.g. numpy.int64(3) and 3, or 10 and 10.0).
+    :param arg: argument value
+    :return: JSON-serialisable version of the argument
+    """
+    if isinstance(arg, np.generic):
+        arg = arg.item()
+    if isinstance(arg, bool) or arg is None:
+        return arg
+    if isinstance(arg, (int, float)):
+        # Integers and floats of equal value share a key
+        return repr(float(arg))
+    if isinstance(arg, (list, tuple, np.ndarray)):
+        return [normalize_arg(a) for a in arg]
+    if isinstance(arg, slice):
+        return ['slice', normalize_arg(arg.start), normalize_arg(arg.stop),
+                normalize_arg(arg.step)]
+    return str(arg)
+
+
+def extract_settings():
+    """
+    Returns the settings of the extract module that change the results of the
+    extract functions: the NaN-filled mode, the compute type and the memory budget
+    (which decides how far extract_map_data_downsampled downsamples).
+    :return: dictionary of JSON values
+    """
+    dtype = extract.COMPUTE_DTYPE
+    return {'nan_fill': bool(extract.NAN_FILL),
+            'compute_dtype': None if dtype is None else np.dtype(dtype).str,
+            'memory_budget': extract.MEMORY_BUDGET}
+
+
+def make_key(filename, varname, func_name, args, settings=None):
+    """
+    Builds the cache key for one extraction.  The key is a hash of the file identity,
+    the variable name, the extract function, its normalised arguments and the
+    extract settings it ran with.
+    :param filename: location of the NetCDF file
+    :param varname: the identifier of the extracted variable (or a list of it and
+                    the identities of other files a derived variable reads)
+    :param func_name: the name of the extract function
+    :param args: sequence of the remaining arguments of the extract function
+    :param settings: optional - the extract settings (the current ones, see
+                     extract_settings, if not given)
+    :return: the key as a hexadecimal string
+    """
+    if settings is None:
+        settings = extract_settings()
+    description = [file_identity(filename), varname, func_name,
+                   [normalize_arg(a) for a in args], settings]
+    text = json.dumps(description, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _entry_path(key, suffix):
+    """
+    Returns the path of one of the files belonging to a cache entry.
+    :param key: the cache key
+    :param suffix: the suffix of the file, e.g. ".json" or "_0.npy"
+    :return: the path of the file in the cache directory
+    """
+    return os.path.join(CACHE_DIR, key + suffix)
+
+
+def _save_array(path, arr):
+    """
+    Writes an array to a .npy file.  The file is written under a temporary name and
+    then renamed, so that readers never see a partially written file.
+    :param path: destination of the file
+    :param arr: the array to be saved
+    :return: no return
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(arr))
+    os.replace(tmp_path, path)
+
+
+def store(key, result):
+    """
+    Stores the result of an extract function in the cache.  Arrays are written as
+    .npy files, masked arrays as a data file plus a mask file, and NetCDF Variable
+    objects (e.g. coordinate variables returned with a vertical section) are
+    recorded by name only.
+    :param key: the cache key
+    :param result: an array, or a tuple of arrays and Variable objects
+    :return: no return
+    """
+    items = result if isinstance(result, tuple) else (result,)
+    manifest = {'tuple': isinstance(result, tuple), 'items': []}
+    for i, item in enumerate(items):
+        if hasattr(item, 'dimensions') and not isinstance(item, np.ndarray):
+            # A NetCDF Variable object - it is looked up again when the entry is used
+            manifest['items'].append({'kind': 'variable', 'name': item._name})
+            continue
+        masked = np.ma.isMaskedArray(item)
+        data = np.ma.getdata(item)
+        _save_array(_entry_path(key, '_%d.npy' % i), data)
+        if masked:
+            _save_array(_entry_path(key, '_%d_mask.npy' % i), np.ma.getmaskarray(item))
+            manifest['items'].append({'kind': 'masked',
+                                      'fill_value': np.asarray(item.fill_value).item()})
+        else:
+            manifest['items'].append({'kind': 'array'})
+
+    # The manifest is written last: an entry without a manifest is never loaded
+    tmp_path = _entry_path(key, '.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, _entry_path(key, '.json'))
+    evict(MAX_BYTES)
+
+
+def load(key, nc):
+    """
+    Loads a result from the cache.  Arrays are memory-mapped rather than read, so
+    only the parts that are actually used (e.g. by a plot) are brought into memory.
+    The maps are copy-on-write: callers (e.g. matplotlib, which updates masks in
+    place) may modify the arrays without changing the cache.
+    :param key: the cache key
+    :param nc: the NetCDF Dataset object, used to look up cached Variable objects
+    :return: the cached result, or None if the key is not in the cache
+    """
+    manifest_path = _entry_path(key, '.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        items = []
+        for i, item in enumerate(manifest['items']):
+            if item['kind'] == 'variable':
+                items.append(nc.variables[item['name']])
+                continue
+            data = np.load(_entry_path(key, '_%d.npy' % i), mmap_mode='c')
+            if item['kind'] == 'masked':
+                mask = np.load(_entry_path(key, '_%d_mask.npy' % i), mmap_mode='c')
+                data = np.ma.MaskedArray(data, mask=mask, fill_value=item['fill_value'])
+            items.append(data)
+    except (IOError, OSError, ValueError, KeyError):
+        # Missing or damaged entry (e.g. evicted by another process) - treat as a miss
+        return None
+
+    # Mark the entry as recently used for the LRU eviction
+    os.utime(manifest_path, None)
+    return tuple(items) if manifest['tuple'] else items[0]
+
+
+def evict(max_bytes):
+    """
+    Deletes the least recently used entries until the cache is no larger than
+    max_bytes.
+    :param max_bytes: the maximum total size of the cache in bytes
+    :return: no return
+    """
+    entries = {}
+    total = 0
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        total += st.st_size
+        key = name.split('_')[0].split('.')[0]
+        size, last_used = entries.get(key, (0, 0))
+        if name.endswith('.json'):
+            last_used = st.st_mtime
+        entries[key] = (size + st.st_size, last_used)
+    if total <= max_bytes:
+        return
+
+    # Oldest entries first
+    for key in sorted(entries, key=lambda k: entries[k][1]):
+        for name in os.listdir(CACHE_DIR):
+            if name.startswith(key):
+                try:
+                    os.remove(os.path.join(CACHE_DIR, name))
+                except OSError:
+                    pass
+        total -= entries[key][0]
+        if total <= max_bytes:
+            break
+
+
+def cached_call(func, nc, data_var, *args):
+    """
+    Calls an extract function (e.g. extract.extract_map_data), using the cache if it
+    is enabled.  On a hit, the NetCDF data is not read at all.
+    :param func: the extract function, called as func(nc, data_var, *args)
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object representing the variable to be extracted
+    :param args: the remaining arguments of the extract function
+    :return: the result of the extract function
+    """
+    if CACHE_DIR is None:
+        return func(nc, data_var, *args)
+    try:
+        filename = nc.filepath()
+    except (AttributeError, ValueError):
+        # In-memory dataset - there is no file to identify it by
+        return func(nc, data_var, *args)
+
+    varname = data_var._name
+    if hasattr(data_var, 'source_files'):
+        # A derived variable (see the expression module) may read other files too
+        varname = [varname] + [file_identity(f) for f in data_var.source_files()]
+    key = make_key(filename, varname, func.__module__ + '.' + func.__name__, args)
+    result = load(key, nc)
+    instrument.count('extract_cache', result is not None)
+    if result is None:
+        result = func(nc, data_var, *args)
+        store(key, result)
+    return result
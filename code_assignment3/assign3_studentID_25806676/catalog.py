@@ -0,0 +1,297 @@
+""" Contains code for building and searching a catalog of NetCDF files.  The
+    catalog is an SQLite database holding the variables, axes, extents, time
+    ranges and units of every file in a directory tree, so that questions like
+    "which files contain ta on 2006-08-20 over this region" can be answered
+    without opening any of the data files. """
+
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import os
+import sqlite3
+import netCDF4
+import numpy as np
+import netcdf_utils as nu
+
+# File name extensions of NetCDF files picked up by a scan
+NETCDF_EXTENSIONS = ('.nc', '.nc3', '.nc4', '.cdf', '.netcdf')
+# Errors raised by files or metadata that cannot be read, e.g. a damaged file or
+# a time unit that num2date does not understand
+READ_ERRORS = (IOError, OSError, ValueError, RuntimeError, KeyError, AttributeError,
+               TypeError, IndexError)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    readable INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS variables (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    standard_name TEXT,
+    units TEXT,
+    dimensions TEXT,
+    axes TEXT,
+    lon_min REAL, lon_max REAL,
+    lat_min REAL, lat_max REAL,
+    z_min REAL, z_max REAL, z_units TEXT,
+    time_start TEXT, time_end TEXT, time_units TEXT
+);
+CREATE INDEX IF NOT EXISTS variables_name ON variables(name);
+CREATE INDEX IF NOT EXISTS variables_standard_name ON variables(standard_name);
+CREATE INDEX IF NOT EXISTS variables_time ON variables(time_start, time_end);
+"""
+
+VARIABLE_COLUMNS = ('name', 'standard_name', 'units', 'dimensions', 'axes',
+                    'lon_min', 'lon_max', 'lat_min', 'lat_max', 'z_min', 'z_max', 'z_units',
+                    'time_start', 'time_end', 'time_units')
+
+
+def open_catalog(db_path):
+    """
+    Opens (or creates) a catalog database.
+    :param db_path: location of the SQLite database file
+    :return: sqlite3 Connection object
+    """
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def format_time(date):
+    """
+    Formats a date as an ISO 8601 string.  The strings sort in time order, and
+    work for dates in any CF calendar (e.g. 30 February in a 360_day calendar).
+    :param date: datetime.datetime or cftime date object
+    :return: string of the form "YYYY-MM-DDTHH:MM:SS"
+    """
+    return '%04d-%02d-%02dT%02d:%02d:%02d' % (date.year, date.month, date.day,
+                                               date.hour, date.minute, date.second)
+
+
+def parse_time_range(time):
+    """
+    Converts the time argument of find() into a (start, end) pair of ISO strings.
+    A date without a time of day, e.g. "2006-08-20", covers the whole day.
+    :param time: a string, a datetime.datetime or datetime.date object, or a
+                 (start, end) pair of these
+    :return: tuple of two ISO strings
+    """
+    if isinstance(time, (tuple, list)):
+        return parse_time_range(time[0])[0], parse_time_range(time[1])[1]
+    if isinstance(time, datetime.datetime):
+        text = format_time(time)
+        return text, text
+    if isinstance(time, datetime.date):
+        time = time.isoformat()
+    time = time.strip().replace(' ', 'T')
+    if 'T' not in time:
+        return time + 'T00:00:00', time + 'T23:59:59'
+    # Pad partial times such as "2006-08-20T12" or "2006-08-20T12:30"
+    start = (time + ':00:00')[:19] if len(time) < 19 else time[:19]
+    return start, start
+
+
+def _coordinate_extent(nc, dim):
+    """
+    Returns the minimum and maximum values of a coordinate variable.
+    """
+    values = np.ma.compressed(np.ma.asarray(nc.variables[dim][:]))
+    if values.size == 0:
+        return None, None
+    return float(values.min()), float(values.max())
+
+
+def describe_file(path):
+    """
+    Reads the metadata of all data variables in a NetCDF file.  Only the
+    coordinate variables are read, never the data variables themselves.
+    :param path: location of a NetCDF file
+    :return: list of dictionaries, one per data variable, with keys as in
+             VARIABLE_COLUMNS, or None if the file cannot be read
+    """
+    try:
+        nc = nu.open_dataset(path)
+    except READ_ERRORS:
+        return None
+    try:
+        records = []
+        for name, var in nc.variables.items():
+            if name in var.dimensions:
+                # A coordinate variable - described as part of the data variables
+                continue
+            try:
+                roles = nu.find_axis_roles(nc, var)
+                record = dict.fromkeys(VARIABLE_COLUMNS)
+                record.update(name=name,
+                              standard_name=nu.get_attribute(var, 'standard_name'),
+                              units=nu.get_attribute(var, 'units'),
+                              dimensions=','.join(var.dimensions),
+                              axes=''.join(role or '-' for role in roles))
+                for role, dim in zip(roles, var.dimensions):
+                    if role == 'x':
+                        record['lon_min'], record['lon_max'] = _coordinate_extent(nc, dim)
+                    elif role == 'y':
+                        record['lat_min'], record['lat_max'] = _coordinate_extent(nc, dim)
+                    elif role == 'z':
+                        record['z_min'], record['z_max'] = _coordinate_extent(nc, dim)
+                        record['z_units'] = nu.get_attribute(nc.variables[dim], 'units')
+                    elif role == 't':
+                        t_var = nc.variables[dim]
+                        t_min, t_max = _coordinate_extent(nc, dim)
+                        if t_min is not None:
+                            calendar = nu.get_attribute(t_var, 'calendar', 'standard')
+                            dates = netCDF4.num2date([t_min, t_max], t_var.units, calendar)
+                            record['time_start'] = format_time(dates[0])
+                            record['time_end'] = format_time(dates[1])
+                        record['time_units'] = t_var.units
+                records.append(record)
+            except READ_ERRORS:
+                # Unreadable metadata (e.g. a time unit num2date does not
+                # understand) - the variable is left out of the catalog
+                continue
+        return records
+    finally:
+        nc.close()
+
+
+def _store_file(conn, path, st, records):
+    """
+    Replaces the catalog entries of one file.
+    """
+    conn.execute('DELETE FROM files WHERE path = ?', (path,))
+    cur = conn.execute('INSERT INTO files (path, size, mtime, readable) VALUES (?, ?, ?, ?)',
+                       (path, st.st_size, st.st_mtime, records is not None))
+    file_id = cur.lastrowid
+    conn.executemany('INSERT INTO variables (file_id, %s) VALUES (?%s)'
+                     % (', '.join(VARIABLE_COLUMNS), ', ?' * len(VARIABLE_COLUMNS)),
+                     [[file_id] + [r[c] for c in VARIABLE_COLUMNS] for r in records or []])
+
+
+def _find_netcdf_files(root):
+    """
+    Lists all NetCDF files (by extension) in a directory tree.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith(NETCDF_EXTENSIONS):
+                yield os.path.abspath(os.path.join(dirpath, filename))
+
+
+def needs_update(conn, path, st=None):
+    """
+    Returns True if a file is not in the catalog, or has changed since it was added.
+    :param conn: catalog Connection object
+    :param path: location of the file
+    :param st: optional - the result of os.stat(path), if already known
+    :return: True if the file should be (re)described
+    """
+    st = st or os.stat(path)
+    row = conn.execute('SELECT size, mtime FROM files WHERE path = ?',
+                       (os.path.abspath(path),)).fetchone()
+    return row is None or row[0] != st.st_size or row[1] != st.st_mtime
+
+
+def update_file(conn, path):
+    """
+    Adds a single file to the catalog, or refreshes its entry if it has changed.
+    :param conn: catalog Connection object
+    :param path: location of the NetCDF file
+    :return: True if the entry was (re)written, False if it was up to date
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    if not needs_update(conn, path, st):
+        return False
+    with conn:
+        _store_file(conn, path, st, describe_file(path))
+    return True
+
+
+def remove_file(conn, path):
+    """
+    Removes a file from the catalog.
+    :param conn: catalog Connection object
+    :param path: location of the file
+    :return: no return
+    """
+    with conn:
+        conn.execute('DELETE FROM files WHERE path = ?', (os.path.abspath(path),))
+
+
+def scan(conn, root, workers=4):
+    """
+    Brings the catalog up to date with a directory tree.  Only new or changed
+    files (by size and modification time) are opened, in parallel worker
+    processes; entries of files that no longer exist are removed.
+    :param conn: catalog Connection object
+    :param root: the directory to be scanned
+    :param workers: optional - the number of worker processes
+    :return: the number of files that were (re)described
+    """
+    root = os.path.abspath(root)
+    stats = dict((path, os.stat(path)) for path in _find_netcdf_files(root))
+    changed = [path for path, st in stats.items() if needs_update(conn, path, st)]
+
+    if workers > 1 and len(changed) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(describe_file, changed, chunksize=8))
+    else:
+        results = [describe_file(path) for path in changed]
+
+    with conn:
+        for path, records in zip(changed, results):
+            _store_file(conn, path, stats[path], records)
+        # Forget files under this root that have been deleted
+        prefix = os.path.join(root, '')
+        for (path,) in conn.execute('SELECT path FROM files WHERE substr(path, 1, ?) = ?',
+                                    (len(prefix), prefix)).fetchall():
+            if path not in stats:
+                conn.execute('DELETE FROM files WHERE path = ?', (path,))
+    return len(changed)
+
+
+def find(conn, varname=None, standard_name=None, time=None, bbox=None):
+    """
+    Finds the files containing a variable that covers a time and/or region.
+    All the criteria are optional; e.g.
+    find(conn, 'ta', time='2006-08-20', bbox=(-10, 40, 10, 60))
+    :param conn: catalog Connection object
+    :param varname: optional - the identifier of the variable
+    :param standard_name: optional - the CF standard_name of the variable
+    :param time: optional - a date (string or datetime) or (start, end) pair that
+                 the variable's time axis must overlap
+    :param bbox: optional - (lon_min, lat_min, lon_max, lat_max) in degrees that
+                 the variable's horizontal extent must overlap
+    :return: list of (path, variable name) tuples
+    """
+    conditions = ['files.readable = 1']
+    params = []
+    if varname is not None:
+        conditions.append('variables.name = ?')
+        params.append(varname)
+    if standard_name is not None:
+        conditions.append('variables.standard_name = ?')
+        params.append(standard_name)
+    if time is not None:
+        start, end = parse_time_range(time)
+        conditions.append('variables.time_start <= ? AND variables.time_end >= ?')
+        params.extend([end, start])
+    if bbox is not None:
+        lon_min, lat_min, lon_max, lat_max = bbox
+        conditions.append('variables.lat_min <= ? AND variables.lat_max >= ?')
+        params.extend([lat_max, lat_min])
+        # Longitudes may be stored as 0..360 or -180..180, so also try the box
+        # shifted by one revolution either way
+        lon_tests = []
+        for shift in (0, 360, -360):
+            lon_tests.append('(variables.lon_min <= ? AND variables.lon_max >= ?)')
+            params.extend([lon_max + shift, lon_min + shift])
+        conditions.append('(%s)' % ' OR '.join(lon_tests))
+    query = ('SELECT files.path, variables.name FROM variables '
+             'JOIN files ON files.id = variables.file_id WHERE %s ORDER BY files.path'
+             % ' AND '.join(conditions))
+    return conn.execute(query, params).fetchall()
@@ -0,0 +1,287 @@
+""" Contains code for sizing the HDF5 chunk cache of NetCDF-4 variables for the
+    way they are read.  netCDF4 gives every variable the same default cache, which
+    is often too small to hold the chunks of one read: a time series at one point
+    touches every chunk along the time axis, and neighbouring points (or the
+    following time step of a map) need the same chunks again, which are then
+    read and decompressed again.
+
+    configure works out how many chunks one read of an access pattern ("map",
+    "section" or "timeseries", as in rechunk) touches, sizes the cache of the
+    variable to hold them (see Variable.set_var_chunk_cache), and estimates the
+    hit rates of the old and new cache sizes over a typical sequence of reads.
+    While instrumentation is switched on, reads of configured variables through
+    extract.read are also counted as chunk cache hits and misses (as "chunks
+    <variable>") against a model of the cache, so the hit rates of real
+    workloads appear in instrument reports.  HDF5 does not report its own cache
+    statistics, so these are estimates from a least-recently-used model.
+
+    Usage:
+        nc = netcdf_utils.open_dataset('ostia.nc')
+        report = chunkcache.configure(nc, nc.variables['analysed_sst'], 'timeseries')
+        print(report['hit_rate_before'], report['hit_rate_after']) """
+
+from collections import OrderedDict
+import itertools
+import threading
+import netCDF4
+import numpy as np
+import instrument
+import netcdf_utils as nu
+import rechunk
+
+# Largest chunk cache given to a single variable, in bytes
+MAX_CACHE_BYTES = 256 * 1024 ** 2
+# Number of reads in the sequence used to estimate hit rates
+SEQUENCE_LENGTH = 16
+# How strongly HDF5 evicts chunks that have been read completely before others
+# (0 to 1, the HDF5 default)
+PREEMPTION = 0.75
+
+# Number of configured variables whose reads are counted (the oldest are
+# forgotten first)
+MAX_MODELS = 64
+
+# Cache models of the configured variables, by id of the Variable object
+_models = OrderedDict()
+_models_lock = threading.Lock()
+
+
+def _next_prime(n):
+    """
+    Returns the smallest prime number not less than n.
+    """
+    n = max(int(n), 2)
+    while any(n % d == 0 for d in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+
+def _sources(data_var):
+    """
+    Returns the NetCDF variables read by a variable: the variables of a derived
+    variable (see the expression module), or the variable itself.
+    """
+    # Looked up on the class: netCDF4 variables raise KeyError for unknown names
+    if callable(getattr(type(data_var), 'variables', None)):
+        return data_var.variables()
+    return [data_var]
+
+
+def chunk_nbytes(data_var):
+    """
+    Returns the size of one decompressed chunk of a variable, which is the size
+    it takes up in the chunk cache.
+    :param data_var: NetCDF Variable object
+    :return: the size in bytes, or None if the variable is not chunked
+    """
+    chunks = data_var.chunking() if hasattr(data_var, 'chunking') else 'contiguous'
+    if chunks == 'contiguous' or chunks is None:
+        return None
+    return int(np.prod(chunks, dtype=np.int64)) * data_var.dtype.itemsize
+
+
+def touched_chunks(shape, chunks, index):
+    """
+    Lists the chunks that a read of the given index touches.
+    :param shape: the shape of the variable
+    :param chunks: list of chunk sizes
+    :param index: tuple with one integer or slice per dimension
+    :return: generator of tuples of chunk numbers along each dimension
+    """
+    ranges = []
+    for n, chunk, idx in zip(shape, chunks, index):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(n)
+            if stop <= start:
+                return
+            ranges.append(range(start // chunk, (stop - 1) // chunk + 1))
+        else:
+            ranges.append((int(idx) % n // chunk,))
+    for key in itertools.product(*ranges):
+        yield key
+
+
+class _CacheModel(object):
+    """
+    A least-recently-used model of the chunk cache of one variable.
+    """
+
+    def __init__(self, name, shape, chunks, capacity):
+        self.name = name
+        self.shape = shape
+        self.chunks = chunks
+        # The number of chunks that fit in the cache
+        self.capacity = capacity
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, index):
+        """
+        Records a read, returning the numbers of chunk hits and misses.
+        """
+        hits = misses = 0
+        with self._lock:
+            for key in touched_chunks(self.shape, self.chunks, index):
+                if key in self._chunks:
+                    self._chunks[key] = self._chunks.pop(key)
+                    hits += 1
+                    continue
+                misses += 1
+                if self.capacity > 0:
+                    self._chunks[key] = True
+                    while len(self._chunks) > self.capacity:
+                        self._chunks.popitem(last=False)
+        return hits, misses
+
+
+def access_sequence(nc, data_var, pattern, n_reads=SEQUENCE_LENGTH):
+    """
+    Builds a typical sequence of reads of an access pattern: maps or sections of
+    successive time steps, or time series at successive points along a row.
+    :param nc: NetCDF Dataset object
+    :param data_var: NetCDF Variable object
+    :param pattern: the access pattern as a string (see rechunk.ACCESS_PATTERNS)
+    :param n_reads: optional - the number of reads
+    :return: list of indices (tuples of integers and slices)
+    """
+    roles = nu.find_axis_roles(nc, data_var)
+    first = list(rechunk.query_index(nc, data_var, pattern))
+    # The axis stepped along between reads
+    step_role = 'x' if pattern == 'timeseries' else 't'
+    if step_role not in roles or isinstance(first[roles.index(step_role)], slice):
+        return [tuple(first)] * n_reads
+    axis = roles.index(step_role)
+    sequence = []
+    for i in range(min(n_reads, data_var.shape[axis])):
+        index = list(first)
+        index[axis] = i
+        sequence.append(tuple(index))
+    return sequence
+
+
+def estimate_hit_rate(shape, chunks, sequence, capacity):
+    """
+    Estimates the chunk cache hit rate of a sequence of reads.
+    :param shape: the shape of the variable
+    :param chunks: list of chunk sizes
+    :param sequence: list of indices read one after the other
+    :param capacity: the number of chunks that fit in the cache
+    :return: the fraction of chunk lookups that hit the cache, or None if the
+             reads touch no chunks
+    """
+    model = _CacheModel(None, shape, chunks, capacity)
+    hits = misses = 0
+    for index in sequence:
+        h, m = model.read(index)
+        hits += h
+        misses += m
+    return hits / float(hits + misses) if hits + misses else None
+
+
+def cache_settings(nc, data_var, pattern, max_bytes=MAX_CACHE_BYTES):
+    """
+    Works out the chunk cache settings of a variable for an access pattern: a
+    cache large enough for all the chunks one read touches (so that the next
+    read of a neighbouring point or time step finds them again), up to max_bytes.
+    Variables whose reads fit in the default cache keep the default size.
+    :param nc: NetCDF Dataset object
+    :param data_var: NetCDF Variable object
+    :param pattern: the access pattern as a string (see rechunk.ACCESS_PATTERNS)
+    :param max_bytes: optional - the largest cache size in bytes
+    :raise ValueError: if the access pattern is not known
+    :return: tuple (size in bytes, number of hash slots, preemption) for
+             Variable.set_var_chunk_cache, or None if the variable is not chunked
+    """
+    if pattern not in rechunk.ACCESS_PATTERNS:
+        raise ValueError("Need to choose the access pattern from %s" %
+                         ', '.join(sorted(rechunk.ACCESS_PATTERNS)))
+    nbytes = chunk_nbytes(data_var)
+    if nbytes is None:
+        return None
+    index = rechunk.query_index(nc, data_var, pattern)
+    n_chunks = rechunk.count_chunks(data_var.shape, data_var.chunking(), index)
+    # One chunk more than a read needs, so the next read can start loading
+    # before anything it needs again is evicted.  The cache is never made smaller
+    # than the library default, which other reads of the variable may rely on.
+    size = min(max_bytes, max((n_chunks + 1) * nbytes, netCDF4.get_chunk_cache()[0]))
+    # HDF5 advises a prime number of hash slots, about 100 times the number of
+    # chunks that fit, to keep collisions rare
+    fit = max(1, size // nbytes)
+    return size, _next_prime(max(521, min(100 * fit, 1000003))), PREEMPTION
+
+
+def configure(nc, data_var, pattern, max_bytes=MAX_CACHE_BYTES):
+    """
+    Sizes the chunk cache of a variable for an access pattern.  Derived variables
+    (see the expression module) have the caches of the variables they read
+    configured.  Variables that are not chunked (e.g. in NetCDF-3 files) are left
+    alone.
+    :param nc: NetCDF Dataset object
+    :param data_var: NetCDF Variable object
+    :param pattern: the access pattern as a string (see rechunk.ACCESS_PATTERNS)
+    :param max_bytes: optional - the largest cache size in bytes
+    :raise ValueError: if the access pattern is not known
+    :return: dictionary reporting the chunking, the number of chunks one read
+             touches, the cache settings before and after, and the estimated hit
+             rates of a typical sequence of reads before and after; a list of them
+             for a derived variable; or None if the variable is not chunked
+    """
+    sources = _sources(data_var)
+    if len(sources) != 1 or sources[0] is not data_var:
+        return [configure(nc, var, pattern, max_bytes) for var in sources]
+    settings = cache_settings(nc, data_var, pattern, max_bytes)
+    if settings is None or not hasattr(data_var, 'set_var_chunk_cache'):
+        return None
+    nbytes = chunk_nbytes(data_var)
+    chunks = data_var.chunking()
+    before = data_var.get_var_chunk_cache()
+    data_var.set_var_chunk_cache(*settings)
+    with _models_lock:
+        _models[id(data_var)] = (data_var, _CacheModel(data_var._name, data_var.shape, chunks,
+                                                       settings[0] // nbytes))
+        while len(_models) > MAX_MODELS:
+            _models.popitem(last=False)
+
+    sequence = access_sequence(nc, data_var, pattern)
+    return {'variable': data_var._name,
+            'pattern': pattern,
+            'chunks': list(chunks),
+            'chunk_bytes': nbytes,
+            'chunks_per_read': rechunk.count_chunks(data_var.shape, chunks, sequence[0]),
+            'cache_before': tuple(before),
+            'cache_after': tuple(data_var.get_var_chunk_cache()),
+            'hit_rate_before': estimate_hit_rate(data_var.shape, chunks, sequence,
+                                                 before[0] // nbytes),
+            'hit_rate_after': estimate_hit_rate(data_var.shape, chunks, sequence,
+                                                settings[0] // nbytes)}
+
+
+def note_read(data_var, index):
+    """
+    Counts the chunk cache hits and misses of a read of a configured variable
+    (see instrument.count).  Does nothing for variables that have not been
+    configured.
+    :param data_var: NetCDF Variable object (or derived variable)
+    :param index: tuple with one integer or slice per dimension
+    :return: no return
+    """
+    for var in _sources(data_var):
+        entry = _models.get(id(var))
+        if entry is None or entry[0] is not var:
+            continue
+        hits, misses = entry[1].read(index)
+        instrument.count('chunks ' + entry[1].name, True, hits)
+        instrument.count('chunks ' + entry[1].name, False, misses)
+
+
+def forget(data_var=None):
+    """
+    Stops counting the chunk cache hits of a variable, or of all variables.
+    :param data_var: optional - the NetCDF Variable object
+    :return: no return
+    """
+    with _models_lock:
+        if data_var is None:
+            _models.clear()
+        else:
+            _models.pop(id(data_var), None)
@@ -0,0 +1,307 @@
+""" Contains a lightweight reader for NetCDF-3 ("classic", "64-bit offset" and CDF-5)
+    files.  The header is parsed directly and the data of every variable is exposed
+    as a view of a memory-mapped file, so opening a file is cheap and slicing a
+    variable reads only the sliced part of the file.
+
+    The ClassicDataset and ClassicVariable objects provide the parts of the
+    netCDF4.Dataset and netCDF4.Variable interfaces used in this package
+    (variables, dimensions, ncattrs, getncattr, slicing), so they can be passed to
+    the functions in netcdf_utils and extract in place of netCDF4 objects. """
+
+from collections import OrderedDict
+import struct
+import numpy as np
+
+# The first four bytes of NetCDF-3 files, for each format version
+MAGIC_NUMBERS = (b'CDF\x01', b'CDF\x02', b'CDF\x05')
+
+# Tags used in the header
+ZERO = 0
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+
+# Data types (the values are stored big-endian in the file)
+NC_TYPES = {1: '>i1', 2: 'S1', 3: '>i2', 4: '>i4', 5: '>f4', 6: '>f8',
+            7: '>u1', 8: '>u2', 9: '>u4', 10: '>i8', 11: '>u8'}
+
+
+def is_classic_file(filename):
+    """
+    Returns True if the file is a NetCDF-3 file that can be read by this module.
+    :param filename: location of a file
+    :return: True if the file starts with a NetCDF-3 magic number, False otherwise
+    """
+    with open(filename, 'rb') as f:
+        return f.read(4) in MAGIC_NUMBERS
+
+
+class _HeaderReader(object):
+    """
+    Reads the items of a NetCDF-3 header one by one from a buffer.
+    """
+
+    def __init__(self, buf, version):
+        self.buf = buf
+        self.pos = 0
+        # CDF-5 uses 64-bit counts; both 64-bit offset files and CDF-5 use 64-bit offsets
+        self.count_fmt = '>Q' if version == 5 else '>I'
+        self.offset_fmt = '>I' if version == 1 else '>Q'
+
+    def unpack(self, fmt):
+        value, = struct.unpack_from(fmt, self.buf, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return value
+
+    def count(self):
+        return self.unpack(self.count_fmt)
+
+    def offset(self):
+        return self.unpack(self.offset_fmt)
+
+    def padded_bytes(self, n):
+        data = bytes(self.buf[self.pos:self.pos + n])
+        # Values in the header are padded to a multiple of four bytes
+        self.pos += (n + 3) // 4 * 4
+        return data
+
+    def name(self):
+        return self.padded_bytes(self.count()).decode('utf-8')
+
+    def tagged_list(self, expected_tag, read_item):
+        tag = self.unpack('>I')
+        n = self.count()
+        if tag == ZERO:
+            # ABSENT list
+            return []
+        if tag != expected_tag:
+            raise ValueError("Not a valid NetCDF-3 header: unexpected tag %d" % tag)
+        return [read_item() for i in range(n)]
+
+    def attribute(self):
+        name = self.name()
+        dtype = np.dtype(NC_TYPES[self.unpack('>I')])
+        n = self.count()
+        raw = self.padded_bytes(n * dtype.itemsize)
+        if dtype.kind == 'S':
+            # Text attributes are returned as strings, as netCDF4 does
+            return name, raw.rstrip(b'\x00').decode('utf-8', 'replace')
+        values = np.frombuffer(raw, dtype=dtype).astype(dtype.newbyteorder('='))
+        return name, values[0] if n == 1 else values
+
+    def attributes(self):
+        return OrderedDict(self.tagged_list(NC_ATTRIBUTE, self.attribute))
+
+
+class ClassicDimension(object):
+    """
+    A dimension of a NetCDF-3 file.
+    """
+
+    def __init__(self, name, size, unlimited):
+        self.name = name
+        self.size = size
+        self._unlimited = unlimited
+
+    def __len__(self):
+        return self.size
+
+    def isunlimited(self):
+        return self._unlimited
+
+
+class ClassicVariable(object):
+    """
+    A variable of a NetCDF-3 file.  Slicing it returns a masked array of the
+    sliced data, copied from the memory-mapped file in the native byte order,
+    with the same values masked as netCDF4 masks (fill values, or the default fill
+    value of the type if none is set, and values outside the valid range), and
+    packed data (with scale_factor or add_offset) unpacked.  With masking
+    switched off (set_auto_mask(False)), slicing an unpacked variable returns a
+    view of the file without copying it; raw returns the whole view.
+    """
+
+    def __init__(self, name, dimensions, attributes, data, mask):
+        self._name = name
+        self.name = name
+        self.dimensions = dimensions
+        self._attributes = attributes
+        self._data = data
+        self._mask = mask
+        self.shape = data.shape
+        self.ndim = data.ndim
+        # Report the native data type, as netCDF4 does
+        self.dtype = data.dtype.newbyteorder('=')
+
+    def ncattrs(self):
+        return list(self._attributes.keys())
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def __getattr__(self, name):
+        # Attributes can be read as Python attributes, e.g. time_var.units
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError("Variable %s has no attribute %s" % (self._name, name))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def set_auto_mask(self, mask):
+        self._mask = mask
+
+    def chunking(self):
+        return 'contiguous'
+
+    def raw(self):
+        """
+        Returns all the data of the variable as an unmasked view of the file.
+        """
+        return self._data
+
+    def __getitem__(self, key):
+        data = self._data[key]
+        scale = self._attributes.get('scale_factor')
+        offset = self._attributes.get('add_offset')
+        if not self._mask and scale is None and offset is None:
+            return data
+        if data.dtype.kind not in 'iuf':
+            # Character data are neither masked nor unpacked
+            return np.array(data)
+        mask = np.ma.nomask
+        if self._mask:
+            # The same values as netCDF4 masks (see netcdf_utils.missing_mask)
+            import netcdf_utils as nu
+            missing = nu.missing_mask(self, data)
+            if missing is not None and np.any(missing):
+                mask = missing
+        if scale is not None or offset is not None:
+            data = data * (1 if scale is None else scale) + (0 if offset is None else offset)
+        # A private array in the native byte order, as netCDF4 returns
+        data = np.asarray(data, dtype=data.dtype.newbyteorder('='))
+        if data.base is not None or not data.flags.writeable:
+            data = data.copy()
+        if not self._mask:
+            return data
+        return np.ma.MaskedArray(data, mask=mask)
+
+
+class ClassicDataset(object):
+    """
+    A NetCDF-3 file opened for reading.
+    :param filename: location of the NetCDF-3 file
+    :param mask: optional - whether slices of variables mask their fill values
+    """
+
+    data_model = 'NETCDF3_CLASSIC'
+
+    def __init__(self, filename, mask=True):
+        self._filename = filename
+        with open(filename, 'rb') as f:
+            magic = f.read(4)
+            if magic not in MAGIC_NUMBERS:
+                raise ValueError("%s is not a NetCDF-3 file" % filename)
+        self._mm = np.memmap(filename, dtype=np.uint8, mode='r')
+        version = bytearray(magic)[3]
+        header = _HeaderReader(self._mm, version)
+        header.pos = 4
+        numrecs = header.count()
+        if numrecs in (0xFFFFFFFF, 0xFFFFFFFFFFFFFFFF):
+            raise ValueError("Streaming NetCDF-3 files (unknown number of records) "
+                             "are not supported")
+
+        dims = header.tagged_list(NC_DIMENSION, lambda: (header.name(), header.count()))
+        self.dimensions = OrderedDict()
+        for name, size in dims:
+            # A size of zero marks the record (unlimited) dimension
+            self.dimensions[name] = ClassicDimension(name, size or numrecs, size == 0)
+        self._attributes = header.attributes()
+
+        var_headers = header.tagged_list(NC_VARIABLE, lambda: self._read_var_header(header))
+        # All record variables are interleaved, one slab of each per record
+        rec_vars = [v for v in var_headers if v['is_record']]
+        if len(rec_vars) == 1:
+            # A single record variable is stored without padding between records
+            recsize = int(np.prod(rec_vars[0]['shape'][1:], dtype=np.int64)) * \
+                rec_vars[0]['dtype'].itemsize
+        else:
+            recsize = sum(v['vsize'] for v in rec_vars)
+
+        self.variables = OrderedDict()
+        for v in var_headers:
+            data = self._view(v, numrecs, recsize)
+            self.variables[v['name']] = ClassicVariable(v['name'], v['dimensions'],
+                                                        v['attributes'], data, mask)
+
+    def _read_var_header(self, header):
+        """
+        Reads the header entry of one variable.
+        """
+        name = header.name()
+        dimids = [header.count() for i in range(header.count())]
+        attributes = header.attributes()
+        dtype = np.dtype(NC_TYPES[header.unpack('>I')])
+        vsize = header.count()
+        begin = header.offset()
+        dim_names = list(self.dimensions.keys())
+        dimensions = tuple(dim_names[i] for i in dimids)
+        shape = tuple(len(self.dimensions[d]) for d in dimensions)
+        is_record = len(dimensions) > 0 and self.dimensions[dimensions[0]].isunlimited()
+        return {'name': name, 'dimensions': dimensions, 'attributes': attributes,
+                'dtype': dtype, 'vsize': vsize, 'begin': begin, 'shape': shape,
+                'is_record': is_record}
+
+    def _view(self, v, numrecs, recsize):
+        """
+        Creates the array view of a variable's data in the memory-mapped file.
+        Record variables are strided views, stepping over the other record
+        variables' data from one record to the next.
+        """
+        dtype = v['dtype']
+        shape = v['shape']
+        strides = [dtype.itemsize] * len(shape)
+        for i in range(len(shape) - 2, -1, -1):
+            strides[i] = strides[i + 1] * shape[i + 1]
+        if v['is_record']:
+            strides[0] = recsize
+        if any(n == 0 for n in shape):
+            return np.zeros(shape, dtype=dtype)
+        return np.ndarray(shape, dtype=dtype, buffer=self._mm, offset=v['begin'],
+                          strides=tuple(strides))
+
+    def ncattrs(self):
+        return list(self._attributes.keys())
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError("Dataset has no attribute %s" % name)
+
+    def __getitem__(self, name):
+        return self.variables[name]
+
+    def filepath(self):
+        return self._filename
+
+    def close(self):
+        # The views keep the memory map alive until they are no longer used
+        self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,455 @@
+""" Contains code for derived variables defined as lazy expressions over NetCDF
+    variables, e.g. the wind speed
+
+        speed = expression.define(nc, 'sqrt(ua ** 2 + va ** 2)', units='m s-1')
+        data = extract.extract_map_data(nc, speed, 0, 5)
+
+    Nothing is read when an expression is built.  When it is sliced, only the
+    requested hyperslab of each input variable is read, and the expression is
+    evaluated block by block, so a derived map costs no more I/O than maps of its
+    inputs and the temporary arrays never exceed one block.
+
+    Expressions have the parts of the netCDF4.Variable interface that the
+    netcdf_utils and extract functions use (dimensions, shape, dtype, attributes
+    and slicing), so they can be passed anywhere a variable can.  Their inputs may
+    come from different files, as long as they are on the same grid; the
+    coordinates are then looked up in the Dataset passed to the extract function. """
+
+import ast
+import numbers
+import operator
+import numpy as np
+import netcdf_utils as nu
+
+# Maximum size in bytes of the inputs and result of one block of an evaluation
+BLOCK_BYTES = 16 * 1024 ** 2
+
+# Functions that can be used in the text of an expression (see define)
+FUNCTIONS = {'sqrt': np.sqrt, 'abs': np.abs, 'exp': np.exp, 'log': np.log,
+             'log10': np.log10, 'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+             'arctan2': np.arctan2, 'hypot': np.hypot, 'minimum': np.minimum,
+             'maximum': np.maximum, 'degrees': np.degrees, 'radians': np.radians}
+# Operators that can be used in the text of an expression
+BINARY_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+                    ast.Div: operator.truediv, ast.Pow: operator.pow}
+UNARY_OPERATORS = {ast.USub: operator.neg, ast.UAdd: lambda value: value}
+
+
+def normalize_index(key, shape):
+    """
+    Converts a slicing key into a tuple with one non-negative integer or slice per
+    dimension, as used by the extract functions.
+    :param key: an integer, slice, Ellipsis or tuple of these
+    :param shape: the shape of the sliced variable
+    :raise IndexError: if the key has too many entries, an integer is out of
+                       range, or an entry is not an integer or slice
+    :return: tuple with one integer or slice per dimension
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = [k is Ellipsis for k in key].index(True)
+        key = key[:i] + (slice(None),) * (len(shape) - len(key) + 1) + key[i + 1:]
+    if len(key) > len(shape):
+        raise IndexError("Too many indices (%d) for %d dimensions" % (len(key), len(shape)))
+    key = key + (slice(None),) * (len(shape) - len(key))
+    index = []
+    for k, n in zip(key, shape):
+        if isinstance(k, slice):
+            index.append(k)
+        elif isinstance(k, (numbers.Integral, np.integer)):
+            k = int(k)
+            if not -n <= k < n:
+                raise IndexError("Index %d is out of range for a dimension of length %d" % (k, n))
+            index.append(k % n)
+        else:
+            raise IndexError("Expressions can only be sliced with integers and slices")
+    return tuple(index)
+
+
+def _as_expression(operand):
+    """
+    Returns an operand of an expression as an Expression, wrapping NetCDF
+    variables; numbers are returned as they are.
+    """
+    if isinstance(operand, Expression):
+        return operand
+    if isinstance(operand, (numbers.Number, np.generic)):
+        return operand
+    if hasattr(operand, 'dimensions') and hasattr(operand, 'shape'):
+        return VariableExpression(operand)
+    raise ValueError("Cannot use %r in an expression: only variables, expressions "
+                     "and numbers can be combined" % (operand,))
+
+
+class Expression(object):
+    """
+    Base class of the expressions: a lazily evaluated array with the dimensions,
+    shape, data type and attributes of a NetCDF variable.
+    """
+
+    def __init__(self, name, dimensions, shape, dtype, attributes=None):
+        self._name = name
+        self.name = name
+        self.dimensions = tuple(dimensions)
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype(dtype)
+        self._attributes = dict(attributes or {})
+
+    def ncattrs(self):
+        return list(self._attributes.keys())
+
+    def getncattr(self, name):
+        return self._attributes[name]
+
+    def __getattr__(self, name):
+        # Attributes can be read as Python attributes, e.g. speed.units
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._attributes[name]
+        except KeyError:
+            raise AttributeError("Expression %s has no attribute %s" % (self._name, name))
+
+    def set_attributes(self, **attributes):
+        """
+        Sets attributes of the expression, e.g. units or standard_name.
+        :return: the expression itself
+        """
+        self._attributes.update(attributes)
+        return self
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __repr__(self):
+        return '<expression %s%s>' % (self._name, self.shape)
+
+    def variables(self):
+        """
+        Returns the NetCDF variables that the expression reads.
+        """
+        raise NotImplementedError
+
+    def source_files(self):
+        """
+        Returns the locations of the files that the expression reads, so that cached
+        results can be invalidated when any of them changes.
+        """
+        files = []
+        for var in self.variables():
+            group = getattr(var, 'group', None)
+            try:
+                filename = group().filepath() if group is not None else None
+            except (AttributeError, ValueError):
+                filename = None
+            if filename is not None and filename not in files:
+                files.append(filename)
+        return files
+
+    def evaluate(self, index, plain):
+        """
+        Evaluates one block of the expression.
+        :param index: tuple with one integer or slice per dimension
+        :param plain: True for plain arrays with NaN for missing values, False for
+                      masked arrays
+        :return: the values of the block
+        """
+        raise NotImplementedError
+
+    def _slice(self, key, plain, dtype=None):
+        """
+        Evaluates a hyperslab block by block, splitting it along its first sliced
+        dimension so that each block fits in BLOCK_BYTES.
+        """
+        index = normalize_index(key, self.shape)
+        axes = [i for i, idx in enumerate(index) if isinstance(idx, slice)]
+        if not axes:
+            return self.evaluate(index, plain)
+        shape = [len(range(*index[i].indices(self.shape[i]))) for i in axes]
+        # Every input is read into its own block, besides the result
+        n_inputs = len(self.variables()) + 1
+        row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * self.dtype.itemsize * n_inputs
+        rows = max(1, BLOCK_BYTES // max(row_bytes, 1))
+        if rows >= shape[0]:
+            result = self.evaluate(index, plain)
+            return result if dtype is None else result.astype(dtype, copy=False)
+
+        axis = axes[0]
+        start, stop, step = index[axis].indices(self.shape[axis])
+        out = None
+        mask = None
+        for first in range(0, shape[0], rows):
+            last = min(first + rows, shape[0])
+            block_index = list(index)
+            block_index[axis] = slice(start + first * step, start + last * step, step)
+            block = self.evaluate(tuple(block_index), plain)
+            if out is None:
+                # Plain blocks of integer variables come back as floats
+                out = np.empty(shape, dtype=dtype or block.dtype)
+            out[first:last] = np.ma.getdata(block)
+            block_mask = np.ma.getmask(block)
+            if block_mask is not np.ma.nomask:
+                if mask is None:
+                    mask = np.zeros(shape, dtype=bool)
+                mask[first:last] = block_mask
+        if plain:
+            return out
+        return np.ma.MaskedArray(out, mask=np.ma.nomask if mask is None else mask)
+
+    def __getitem__(self, key):
+        return self._slice(key, plain=False)
+
+    def read_plain(self, index, dtype=None):
+        """
+        Evaluates a hyperslab as a plain array with NaN for missing values (see
+        netcdf_utils.read_plain).
+        """
+        return self._slice(index, plain=True, dtype=dtype)
+
+    # Arithmetic builds new expressions
+    def __add__(self, other):
+        return apply(np.add, self, other, name='(%s + %s)')
+
+    def __radd__(self, other):
+        return apply(np.add, other, self, name='(%s + %s)')
+
+    def __sub__(self, other):
+        return apply(np.subtract, self, other, name='(%s - %s)')
+
+    def __rsub__(self, other):
+        return apply(np.subtract, other, self, name='(%s - %s)')
+
+    def __mul__(self, other):
+        return apply(np.multiply, self, other, name='%s * %s')
+
+    def __rmul__(self, other):
+        return apply(np.multiply, other, self, name='%s * %s')
+
+    def __truediv__(self, other):
+        return apply(np.true_divide, self, other, name='%s / %s')
+
+    def __rtruediv__(self, other):
+        return apply(np.true_divide, other, self, name='%s / %s')
+
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+
+    def __pow__(self, other):
+        return apply(np.power, self, other, name='%s ** %s')
+
+    def __rpow__(self, other):
+        return apply(np.power, other, self, name='%s ** %s')
+
+    def __neg__(self):
+        return apply(np.negative, self, name='-%s')
+
+    def __abs__(self):
+        return apply(np.abs, self, name='abs(%s)')
+
+
+class VariableExpression(Expression):
+    """
+    An expression that reads a NetCDF variable (netCDF4.Variable or
+    classic.ClassicVariable) as it is.
+    """
+
+    def __init__(self, var):
+        Expression.__init__(self, var._name, var.dimensions, var.shape, var.dtype,
+                            dict((att, var.getncattr(att)) for att in var.ncattrs()))
+        self._var = var
+        # Packed variables are unpacked to floating point when they are read
+        if 'scale_factor' in self._attributes or 'add_offset' in self._attributes:
+            self.dtype = np.result_type(np.float32 if self.dtype.itemsize <= 2 else self.dtype,
+                                        *[np.asarray(self._attributes[att]).dtype
+                                          for att in ('scale_factor', 'add_offset')
+                                          if att in self._attributes])
+
+    def variables(self):
+        return [self._var]
+
+    def evaluate(self, index, plain):
+        if plain:
+            return nu.read_plain(self._var, index)
+        return self._var[index]
+
+
+class Operation(Expression):
+    """
+    An expression that applies a numpy function (usually a ufunc) elementwise to
+    its operands.
+    """
+
+    def __init__(self, func, operands, name):
+        self._func = func
+        self._operands = operands
+        arrays = [o for o in operands if isinstance(o, Expression)]
+        first = arrays[0]
+        for other in arrays[1:]:
+            if other.dimensions != first.dimensions or other.shape != first.shape:
+                raise ValueError("Cannot combine %s%s and %s%s: expressions must have the "
+                                 "same dimensions" % (first._name, first.dimensions,
+                                                      other._name, other.dimensions))
+        # Work out the result type from a one-element sample of each operand
+        sample = func(*[np.ones(1, dtype=o.dtype) if isinstance(o, Expression) else o
+                        for o in operands])
+        names = tuple(o._name if isinstance(o, Expression) else repr(o) for o in operands)
+        Expression.__init__(self, name % names, first.dimensions, first.shape,
+                            np.asarray(sample).dtype)
+
+    def variables(self):
+        result = []
+        for o in self._operands:
+            if isinstance(o, Expression):
+                result.extend(v for v in o.variables() if v not in result)
+        return result
+
+    def evaluate(self, index, plain):
+        values = [o.evaluate(index, plain) if isinstance(o, Expression) else o
+                  for o in self._operands]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._func(*values)
+
+
+def wrap(var):
+    """
+    Wraps a NetCDF variable as an expression, so that it can be combined with
+    arithmetic, e.g. wrap(nc.variables['colo3']) / 2.1414E-5.
+    :param var: a NetCDF Variable object
+    :return: Expression object
+    """
+    return _as_expression(var)
+
+
+def apply(func, *operands, **kwargs):
+    """
+    Builds an expression that applies a numpy function elementwise to its operands,
+    e.g. apply(np.hypot, ua, va).
+    :param func: the function, usually a numpy ufunc
+    :param operands: variables, expressions and numbers
+    :param name: optional keyword - format string for the name of the expression,
+                 with one %s per operand
+    :raise ValueError: if there is no variable among the operands, or the
+                       variables are not on the same dimensions
+    :return: Expression object
+    """
+    operands = [_as_expression(o) for o in operands]
+    if not any(isinstance(o, Expression) for o in operands):
+        raise ValueError("An expression needs at least one variable")
+    name = kwargs.get('name') or '%s(%s)' % (getattr(func, '__name__', 'func'),
+                                              ', '.join(['%s'] * len(operands)))
+    return Operation(func, operands, name)
+
+
+def _combine(func, *operands):
+    """
+    Applies an operator or function to operands of an expression.  Numbers are
+    combined as numpy floats, so that e.g. 10 ** 10 ** 10 overflows to inf rather
+    than running for ever, and the result is turned back into a Python float so
+    that it does not change the data type of the variables it is combined with.
+    """
+    if any(isinstance(o, Expression) for o in operands):
+        return func(*operands)
+    with np.errstate(all='ignore'):
+        return float(func(*[np.float64(o) for o in operands]))
+
+
+def _check_syntax(tree, text):
+    """
+    Checks that the syntax tree of an expression holds only names, numbers, the
+    operators in BINARY_OPERATORS and UNARY_OPERATORS and calls of the functions
+    in FUNCTIONS (without keyword arguments).
+    :raise ValueError: naming the first construct that is not allowed
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Expression, ast.Name, ast.Load)):
+            allowed = True
+        elif isinstance(node, ast.Constant):
+            allowed = isinstance(node.value, numbers.Real) and not isinstance(node.value, bool)
+        elif isinstance(node, ast.BinOp):
+            allowed = type(node.op) in BINARY_OPERATORS
+        elif isinstance(node, ast.UnaryOp):
+            allowed = type(node.op) in UNARY_OPERATORS
+        elif isinstance(node, ast.Call):
+            allowed = isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and \
+                not node.keywords
+        else:
+            # Operator nodes are checked with the BinOp and UnaryOp they belong to
+            allowed = isinstance(node, (ast.operator, ast.unaryop))
+        if not allowed:
+            raise ValueError("Cannot evaluate the expression %r: %s is not allowed in "
+                             "expressions" % (text, type(node).__name__))
+
+
+def _evaluate_node(node, nc, text):
+    """
+    Evaluates a node of the syntax tree of an expression that has passed
+    _check_syntax.
+    :raise ValueError: if a name is not a variable of the Dataset
+    :return: Expression object, or a number
+    """
+    if isinstance(node, ast.Name):
+        if node.id not in nc.variables:
+            raise ValueError("Cannot evaluate the expression %r: %s is not a variable"
+                             % (text, node.id))
+        return VariableExpression(nc.variables[node.id])
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.BinOp):
+        return _combine(BINARY_OPERATORS[type(node.op)], _evaluate_node(node.left, nc, text),
+                        _evaluate_node(node.right, nc, text))
+    if isinstance(node, ast.UnaryOp):
+        return _combine(UNARY_OPERATORS[type(node.op)], _evaluate_node(node.operand, nc, text))
+    # A call of one of FUNCTIONS
+    args = [_evaluate_node(arg, nc, text) for arg in node.args]
+    if not any(isinstance(arg, Expression) for arg in args):
+        return _combine(FUNCTIONS[node.func.id], *args)
+    return apply(FUNCTIONS[node.func.id], *args)
+
+
+def define(nc, text, **attributes):
+    """
+    Builds an expression from its text, in which the variables of a Dataset are
+    available by name, together with the functions in FUNCTIONS, e.g.
+    define(nc, 'colo3 / 2.1414E-5', units='DU').  The text is parsed, not run as
+    Python: only variable names, numbers, arithmetic (+ - * / **) and calls of
+    the functions in FUNCTIONS are accepted, and anything else is rejected before
+    any part of the text is evaluated.
+    :param nc: a NetCDF Dataset object
+    :param text: the expression as a string
+    :param attributes: optional - attributes of the derived variable, e.g. units
+    :raise ValueError: if the text does not describe an expression over variables
+    :return: Expression object
+    """
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError("Cannot evaluate the expression %r: %s" % (text, e))
+    _check_syntax(tree, text)
+    result = _evaluate_node(tree.body, nc, text)
+    if not isinstance(result, Expression):
+        raise ValueError("%r is not an expression over variables" % text)
+    result._name = result.name = text
+    return result.set_attributes(**attributes)
+
+
+def lookup(nc, varname):
+    """
+    Returns a variable of a Dataset, or a derived variable if varname is not the
+    name of a variable but an expression, e.g. 'sqrt(ua ** 2 + va ** 2)'.
+    :param nc: a NetCDF Dataset object
+    :param varname: the identifier of a variable, or an expression
+    :raise KeyError: if varname is a plain name that is not a variable
+    :raise ValueError: if varname is not a valid expression (see define)
+    :return: Variable or Expression object
+    """
+    if varname in nc.variables:
+        return nc.variables[varname]
+    if varname.strip().isidentifier():
+        # A mistyped variable name, not an expression
+        raise KeyError("%s is not a variable of the dataset" % varname)
+    return define(nc, varname)
@@ -1,17 +1,139 @@
 """ Contains code for extracting data from NetCDF files """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+import netCDF4
+import numpy as np
 import netcdf_utils as nu
+import chunkcache
+import instrument
 
+# Maximum number of bytes a single read may allocate.  No limit while this is None.
+MEMORY_BUDGET = None
+# Whether reads return plain float arrays with NaN for missing values (True) or
+# masked arrays, as netCDF4 does (False)
+NAN_FILL = False
+# Floating point type that reads are converted to, e.g. np.float32.  While this is
+# None the data keep the type of the source data (float32 for most model output).
+COMPUTE_DTYPE = None
 
-def extract_map_data(nc, data_var, t_index, z_index):
+
+def set_memory_budget(nbytes):
     """
-    This function extracts data ready to be plotted on a map.  It takes 4 arguments:
-    nc: a NetCDF Dataset object
-    data_var: a NetCDF Variable object representing the variable to be extracted 
-    t_index: the desired index along the time axis (if present) - an integer
-    z_index: the desired index along the z-axis (if present) - an integer
-    
-    The function returns a 2D numpy array of map data
+    Sets the maximum number of bytes that a single read of the extract functions
+    may allocate.  Reads that would need more raise a MemoryError before any data
+    are read; use iter_map_tiles or extract_map_data_downsampled for those.
+    :param nbytes: the budget in bytes, or None for no limit
+    :return: no return
+    """
+    global MEMORY_BUDGET
+    MEMORY_BUDGET = nbytes
+
+
+def set_nan_fill(enabled):
+    """
+    Chooses how the extract functions return data.  With enabled=True they return
+    plain float32/float64 arrays with NaN for missing values (see
+    netcdf_utils.read_plain), which need about half the memory of masked arrays
+    and are faster in arithmetic; with enabled=False they return masked arrays.
+    :param enabled: True for NaN-filled arrays, False for masked arrays
+    :return: no return
+    """
+    global NAN_FILL
+    NAN_FILL = enabled
+
+
+def set_compute_dtype(dtype):
+    """
+    Sets the precision policy: the floating point type that the extract functions
+    (and the colocation in globmodel) return their data in.  Keeping float32 model
+    data in float32 halves the memory and bandwidth of float64.
+    :param dtype: a numpy floating point type, e.g. np.float32, or None to keep
+                  the type of the source data
+    :raise ValueError: if dtype is not a floating point type
+    :return: no return
+    """
+    global COMPUTE_DTYPE
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+        if dtype.kind != 'f':
+            raise ValueError("The compute type must be a floating point type, not %s" % dtype)
+    COMPUTE_DTYPE = dtype
+
+
+def result_shape(shape, index):
+    """
+    Works out the shape of the array that reading the given index of a variable
+    returns.
+    :param shape: the shape of the variable
+    :param index: tuple with one integer or slice per dimension
+    :return: the shape of the result as a tuple
+    """
+    result = []
+    for n, idx in zip(shape, index):
+        if isinstance(idx, slice):
+            result.append(len(range(*idx.indices(n))))
+        # Integer indices remove their dimension
+    return tuple(result)
+
+
+def estimate_nbytes(data_var, index):
+    """
+    Estimates the memory needed to read the given index of a variable, from the
+    dimension lengths and the data type.  One byte per element is added for the
+    mask of the masked array that netCDF4 returns.
+    :param data_var: a NetCDF Variable object
+    :param index: tuple with one integer or slice per dimension
+    :return: the estimated number of bytes
+    """
+    n = int(np.prod(result_shape(data_var.shape, index), dtype=np.int64))
+    itemsize = data_var.dtype.itemsize
+    if COMPUTE_DTYPE is not None:
+        itemsize = max(itemsize, COMPUTE_DTYPE.itemsize)
+    return n * (itemsize + 1)
+
+
+def read(data_var, index, max_bytes=None):
+    """
+    Reads the given index of a variable, after checking the size of the result
+    against the memory budget.  The size is recorded by the instrumentation.
+    :param data_var: a NetCDF Variable object
+    :param index: tuple with one integer or slice per dimension
+    :param max_bytes: optional - the size limit (the memory budget if not given)
+    :raise MemoryError: if the result would be larger than the size limit
+    :return: the data as a masked numpy array, or a plain array with NaN for
+             missing values (see set_nan_fill), in the compute type if one is
+             set (see set_compute_dtype)
+    """
+    max_bytes = MEMORY_BUDGET if max_bytes is None else max_bytes
+    nbytes = estimate_nbytes(data_var, index)
+    if max_bytes is not None and nbytes > max_bytes:
+        raise MemoryError("Reading %s%s needs about %d bytes, more than the limit "
+                          "of %d bytes; read it in tiles or downsampled instead"
+                          % (data_var._name, result_shape(data_var.shape, index), nbytes,
+                             max_bytes))
+    instrument.note_allocation(nbytes)
+    if instrument.ENABLED:
+        chunkcache.note_read(data_var, index)
+    if NAN_FILL:
+        return nu.read_plain(data_var, index, COMPUTE_DTYPE)
+    data = data_var[index]
+    if COMPUTE_DTYPE is not None and data.dtype != COMPUTE_DTYPE:
+        data = data.astype(COMPUTE_DTYPE)
+    return data
+
+
+def map_index(nc, data_var, t_index, z_index):
+    """
+    This function works out which part of a variable makes up a map.  It takes the
+    same arguments as extract_map_data.
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object representing the variable to be extracted
+    :param t_index: the desired index along the time axis (if present) - an integer
+    :param z_index: the desired index along the z-axis (if present) - an integer
+    :return: tuple with one integer or slice per dimension
     """
 
     # Find the number of dimensions for the data variable
@@ -28,7 +150,7 @@ def extract_map_data(nc, data_var, t_index, z_index):
 
     if num_dims == 2:
         # Simple case - just return all the data
-        return data_var[:,:]
+        return (slice(None), slice(None))
     elif num_dims == 3:
         # Determine whether to use time or z axis
         z_var = nu.find_vertical_var(nc, data_var)
@@ -40,15 +162,199 @@ def extract_map_data(nc, data_var, t_index, z_index):
 
         if z_var is not None:
             # We have a z-axis
-            return data_var[z_index,:,:]
+            return (z_index, slice(None), slice(None))
         else:
             # We have a time axis
-            return data_var[t_index,:,:]
+            return (t_index, slice(None), slice(None))
     else:
         # num_dims must equal 4
-        return data_var[t_index,z_index,:,:]
+        return (t_index, z_index, slice(None), slice(None))
+
 
+@instrument.timed('decode')
+def extract_map_data(nc, data_var, t_index, z_index):
+    """
+    This function extracts data ready to be plotted on a map.  It takes 4 arguments:
+    nc: a NetCDF Dataset object
+    data_var: a NetCDF Variable object representing the variable to be extracted 
+    t_index: the desired index along the time axis (if present) - an integer
+    z_index: the desired index along the z-axis (if present) - an integer
+    
+    The function returns a 2D numpy array of map data
+    """
+    return read(data_var, map_index(nc, data_var, t_index, z_index))
+
+
+def _thinned(index, step):
+    """
+    Returns a map index that reads every step-th latitude and longitude.
+    """
+    return index[:-2] + (slice(None, None, step), slice(None, None, step))
+
+
+@instrument.timed('decode')
+def extract_map_data_downsampled(nc, data_var, t_index, z_index, max_bytes=None):
+    """
+    This function extracts map data like extract_map_data, but reads only every
+    n-th latitude and longitude if that is needed to keep the result within the
+    memory budget.  If the full map fits, it is returned at full resolution.
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object representing the variable to be extracted
+    :param t_index: the desired index along the time axis (if present) - an integer
+    :param z_index: the desired index along the z-axis (if present) - an integer
+    :param max_bytes: optional - the size limit (the memory budget if not given)
+    :raise MemoryError: if even a single value is larger than the size limit
+    :return: the 2D array of map data, and the matching longitude and latitude values
+    """
+    max_bytes = MEMORY_BUDGET if max_bytes is None else max_bytes
+    index = map_index(nc, data_var, t_index, z_index)
+    step = 1
+    nbytes = estimate_nbytes(data_var, index)
+    if max_bytes is not None and nbytes > max_bytes:
+        # Thinning both axes by "step" divides the size by about step**2
+        step = int(math.ceil(math.sqrt(float(nbytes) / max_bytes)))
+        # [::step] keeps ceil(n / step) values of each axis, which can still be
+        # too many, so the step grows until the thinned map fits (or is a
+        # single value)
+        while estimate_nbytes(data_var, _thinned(index, step)) > max_bytes and \
+                step < max(data_var.shape[-2:]):
+            step += 1
+    index = _thinned(index, step)
+    lon_vals = nu.find_longitude_var(nc, data_var)[::step]
+    lat_vals = nu.find_latitude_var(nc, data_var)[::step]
+    return read(data_var, index, max_bytes), lon_vals, lat_vals
+
+
+def check_same_grid(data_vars):
+    """
+    Checks that several variables are defined on the same grid, i.e. have the
+    same dimensions with the same lengths.
+    :param data_vars: list of NetCDF Variable objects
+    :raise ValueError: if the variables are not on the same grid
+    :return: no return
+    """
+    first = data_vars[0]
+    for var in data_vars[1:]:
+        if tuple(var.dimensions) != tuple(first.dimensions) or \
+                tuple(var.shape) != tuple(first.shape):
+            raise ValueError("%s%s and %s%s are not on the same grid"
+                             % (first._name, tuple(first.shape), var._name, tuple(var.shape)))
+
+
+def _read_parallel(nc, data_vars, index, workers):
+    """
+    Reads the same index of several variables in a pool of threads.  A Dataset
+    must not be shared between threads, so each thread opens the file again and
+    reads the variables through its own handle.  Only NetCDF-3 files are read
+    concurrently; the netCDF-C/HDF5 libraries used for other files are not
+    thread-safe, so their reads take turns (see netcdf_utils.thread_lock).
+    Derived variables (see the expression module) are read through the caller's
+    handles, one at a time.
+    """
+    try:
+        filename = nc.filepath()
+    except (AttributeError, ValueError):
+        filename = None
+    file_lock = nu.thread_lock(filename)
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def read_one(var):
+        if filename is not None and nc.variables.get(var._name) is var:
+            with file_lock:
+                handle = getattr(local, 'nc', None)
+                if handle is None:
+                    handle = local.nc = nu.open_dataset(filename)
+                    with lock:
+                        handles.append(handle)
+                return read(handle.variables[var._name], index)
+        with lock, nu.NETCDF_LOCK:
+            return read(var, index)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(workers, len(data_vars))) as pool:
+            return list(pool.map(read_one, data_vars))
+    finally:
+        with file_lock:
+            for handle in handles:
+                handle.close()
+
+
+@instrument.timed('decode')
+def extract_map_data_multi(nc, data_vars, t_index, z_index, workers=1):
+    """
+    This function extracts maps of several variables on the same grid at once, e.g.
+    temperature, salinity and currents for the same time and level.  The axes are
+    resolved once for all of them, and with workers > 1 the variables are read
+    concurrently.
+    :param nc: a NetCDF Dataset object
+    :param data_vars: list of NetCDF Variable objects (or variable identifiers)
+    :param t_index: the desired index along the time axis (if present) - an integer
+    :param z_index: the desired index along the z-axis (if present) - an integer
+    :param workers: optional - the number of threads reading variables
+    :raise ValueError: if the variables are not on the same grid
+    :return: OrderedDict mapping variable identifiers to 2D arrays of map data,
+             and the shared longitude and latitude values
+    """
+    data_vars = [nc.variables[var] if isinstance(var, str) else var for var in data_vars]
+    if not data_vars:
+        raise ValueError("Need at least one variable to extract map data")
+    check_same_grid(data_vars)
+    index = map_index(nc, data_vars[0], t_index, z_index)
+    lon_vals = nu.find_longitude_var(nc, data_vars[0])[:]
+    lat_vals = nu.find_latitude_var(nc, data_vars[0])[:]
 
+    if workers > 1 and len(data_vars) > 1:
+        results = _read_parallel(nc, data_vars, index, workers)
+    else:
+        results = [read(var, index) for var in data_vars]
+    return OrderedDict(zip([var._name for var in data_vars], results)), lon_vals, lat_vals
+
+
+def iter_tiles(data_var, index, max_bytes=None):
+    """
+    Reads the given index of a variable in tiles that each fit in max_bytes.  The
+    result is split along its first axis, so every tile is a band of complete rows.
+    :param data_var: a NetCDF Variable object
+    :param index: tuple with one integer or slice per dimension
+    :param max_bytes: optional - the size limit (the memory budget if not given)
+    :return: generator of (row slice, tile) pairs, where the row slice gives the
+             position of the tile in the first axis of the full result
+    """
+    max_bytes = MEMORY_BUDGET if max_bytes is None else max_bytes
+    shape = result_shape(data_var.shape, index)
+    # The first sliced dimension of the variable is the first axis of the result
+    axis = [i for i, idx in enumerate(index) if isinstance(idx, slice)][0]
+    start, stop, step = index[axis].indices(data_var.shape[axis])
+    row_bytes = estimate_nbytes(data_var, index) // max(shape[0], 1)
+    rows = shape[0] if max_bytes is None else max(1, max_bytes // max(row_bytes, 1))
+    for first in range(0, shape[0], rows):
+        last = min(first + rows, shape[0])
+        tile_index = list(index)
+        tile_index[axis] = slice(start + first * step, start + last * step, step)
+        # A single row is read even if it is larger than the limit
+        tile_bytes = None if max_bytes is None else max(max_bytes, row_bytes)
+        yield slice(first, last), read(data_var, tuple(tile_index), tile_bytes)
+
+
+def iter_map_tiles(nc, data_var, t_index, z_index, max_bytes=None):
+    """
+    This function extracts map data like extract_map_data, but yields it in
+    bands of latitudes that each fit within the memory budget, so that a map
+    larger than the budget can be processed (e.g. written out or reduced) piece
+    by piece.
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object representing the variable to be extracted
+    :param t_index: the desired index along the time axis (if present) - an integer
+    :param z_index: the desired index along the z-axis (if present) - an integer
+    :param max_bytes: optional - the size limit (the memory budget if not given)
+    :return: generator of (latitude slice, tile) pairs
+    """
+    return iter_tiles(data_var, map_index(nc, data_var, t_index, z_index), max_bytes)
+
+
+@instrument.timed('decode')
 def extract_vertical_data(nc, data_var, direction, value, t_index):
     """
     This function extracts data ready to be plotted on the vertical cross section.
@@ -80,24 +386,25 @@ def extract_vertical_data(nc, data_var, direction, value, t_index):
                 raise ValueError("Cannont plot vertical cross section without vertical dimension")               
             elif t_var is None:
                 # Return 3-D array, x- and z- coordinate data if time dimension does not exist
-                return data_var[:,:,sec_index], lat_var, z_var
+                return read(data_var, (slice(None), slice(None), sec_index)), lat_var, z_var
             else:
                 # Return 4-D array, x- and z- coordinate data if time dimension exists
-                return data_var[t_index,:,:,sec_index], lat_var, z_var
+                return read(data_var, (t_index, slice(None), slice(None), sec_index)), lat_var, z_var
                     
         elif (direction == 'EW'):
             sec_index = nu.find_nearest_lat_index(nc, data_var, value)
             if z_var is None:
                 raise ValueError("Cannont plot vertical cross section without vertical dimension")               
             elif t_var is None:
-                return data_var[:,sec_index,:], lon_var, z_var
+                return read(data_var, (slice(None), sec_index, slice(None))), lon_var, z_var
             else:
-                return data_var[t_index,:,sec_index,:], lon_var, z_var
+                return read(data_var, (t_index, slice(None), sec_index, slice(None))), lon_var, z_var
                 
         else:
             raise ValueError("Need to choose the direction from NS or EW") 
     
     
+@instrument.timed('decode')
 def extract_timeseries(nc, data_var, lon, lat, z):
     """
     This function extracts data ready to be plotted the time series.
@@ -130,11 +437,331 @@ def extract_timeseries(nc, data_var, lon, lat, z):
     elif z_var is not None:
         lon_index = nu.find_nearest_lon_index(nc, data_var, lon)
         lat_index = nu.find_nearest_lat_index(nc, data_var, lat)
-        z_index = nu.find_nearest_z_index_index(nc, data_var, z)
-        return data_var[:,z_index,lat_index,lon_index], t_var
+        z_index = nu.find_nearest_z_index(nc, data_var, z)
+        return read(data_var, (slice(None), z_index, lat_index, lon_index)), t_var
     else:
         lon_index = nu.find_nearest_lon_index(nc, data_var, lon)
         lat_index = nu.find_nearest_lat_index(nc, data_var, lat)
-        return data_var[:,lat_index,lon_index], t_var
-    
-    
+        return read(data_var, (slice(None), lat_index, lon_index)), t_var
+
+
+def _bracket(vals, targets, period=None):
+    """
+    Finds the two coordinate values either side of each target, for linear
+    interpolation.  Targets beyond the ends of a non-cyclic axis take the end value.
+    :param vals: 1D array of coordinate values (in any order)
+    :param targets: array of target values
+    :param period: optional - the period of a cyclic axis (e.g. 360 for longitude)
+    :return: arrays of the lower index, upper index and weight of the upper index
+    """
+    vals = np.asarray(vals, dtype=np.float64)
+    targets = np.asarray(targets, dtype=np.float64)
+    if period is not None:
+        vals = np.mod(vals, period)
+        targets = np.mod(targets, period)
+    order = np.argsort(vals, kind='mergesort')
+    sorted_vals = vals[order]
+    n = len(vals)
+    upper = np.searchsorted(sorted_vals, targets)
+    lower = upper - 1
+    if period is None:
+        lower = np.clip(lower, 0, n - 1)
+        upper = np.clip(upper, 0, n - 1)
+        span = sorted_vals[upper] - sorted_vals[lower]
+        offset = targets - sorted_vals[lower]
+    else:
+        lower %= n
+        upper %= n
+        span = np.mod(sorted_vals[upper] - sorted_vals[lower], period)
+        offset = np.mod(targets - sorted_vals[lower], period)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(span > 0, np.clip(offset / np.where(span > 0, span, 1.), 0., 1.), 0.)
+    return order[lower], order[upper], weight
+
+
+def _time_values(t_var, times):
+    """
+    Converts observation times to numbers in the units of a time variable.
+    Numbers are used as they are; dates are converted.
+    """
+    times = np.asarray(times)
+    if times.dtype.kind in 'iuf':
+        return times.astype(np.float64)
+    return np.asarray(netCDF4.date2num(list(times), t_var.units,
+                                       nu.get_attribute(t_var, 'calendar', 'standard')),
+                      dtype=np.float64)
+
+
+# Latitude/longitude size of the blocks read at once by extract_profiles from
+# files without chunks (NetCDF-3 and contiguous NetCDF-4 variables)
+PROFILE_TILE = 32
+
+
+@instrument.timed('decode')
+def extract_profiles(nc, data_var, lons, lats, times=None, interpolate=False):
+    """
+    This function extracts the vertical profiles of a variable at a batch of
+    observation locations (and times), e.g. to compare the model with radiosondes
+    or profiling floats.  The profiles are read from the file block by block:
+    every block (a chunk of the variable, or a tile of PROFILE_TILE x
+    PROFILE_TILE columns for unchunked files) holding at least one of the
+    needed columns is read exactly once.
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object with a vertical axis and latitude and
+                     longitude axes (and optionally a time axis)
+    :param lons: array of the longitudes of the observations in degrees
+    :param lats: array of the latitudes of the observations in degrees
+    :param times: optional - array of the times of the observations, as dates or
+                  as numbers in the units of the time variable (needed if the
+                  variable has a time axis)
+    :param interpolate: optional - if True, interpolate bilinearly between the four
+                        surrounding columns and linearly between the two
+                        surrounding time steps; if False, take the nearest column
+                        and time step.  Missing columns are left out of the
+                        interpolation.
+    :raise ValueError: if the variable does not have the axes needed
+    :return: (n_obs, n_levels) masked array of the profiles, the vertical
+             coordinate variable, and True if the vertical axis is positive up
+             (see netcdf_utils.isPositiveUp)
+    """
+    roles = nu.find_axis_roles(nc, data_var)
+    if None in roles or not set('zyx') <= set(roles):
+        raise ValueError("Cannot extract profiles from a variable with axes %s; need "
+                         "vertical, latitude and longitude axes (and optionally time)"
+                         % ''.join(role or '-' for role in roles))
+    z_var = nu.find_vertical_var(nc, data_var)
+    lat_vals = nu.find_latitude_var(nc, data_var)[:]
+    lon_vals = nu.find_longitude_var(nc, data_var)[:]
+    lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+    lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+    n_obs = len(lats)
+    period = 360. if len(lon_vals) > 1 and \
+        abs(abs(float(lon_vals[-1]) - float(lon_vals[0])) +
+            abs(float(lon_vals[1]) - float(lon_vals[0])) - 360.) < 1e-3 else None
+
+    # The corners of every observation: arrays of (n_obs, n_corners) indices along
+    # each axis, and their weights
+    if interpolate:
+        y0, y1, wy = _bracket(lat_vals, lats)
+        x0, x1, wx = _bracket(lon_vals, lons, period)
+        ys = [y0, y0, y1, y1]
+        xs = [x0, x1, x0, x1]
+        weights = [(1 - wy) * (1 - wx), (1 - wy) * wx, wy * (1 - wx), wy * wx]
+    else:
+        ys = [nu.find_nearest_lat_indices(nc, data_var, lats)]
+        xs = [nu.find_nearest_lon_indices(nc, data_var, lons)]
+        weights = [np.ones(n_obs)]
+    ts = [np.zeros(n_obs, dtype=np.int64)] * len(ys)
+    if 't' in roles:
+        if times is None:
+            raise ValueError("The data has a time dimension: the observation times are needed")
+        t_var = nu.find_time_var(nc, data_var)
+        t_obs = _time_values(t_var, np.atleast_1d(times))
+        if interpolate:
+            t0, t1, wt = _bracket(t_var[:], t_obs)
+            ts = [t0] * len(ys) + [t1] * len(ys)
+            weights = [w * (1 - wt) for w in weights] + [w * wt for w in weights]
+            ys, xs = ys * 2, xs * 2
+        else:
+            ts = [nu.find_nearest_indices(t_var[:], t_obs)] * len(ys)
+    corners = np.stack([np.stack(ts, 1), np.stack(ys, 1), np.stack(xs, 1)], -1).reshape(-1, 3)
+    weights = np.stack(weights, 1)
+    columns, inverse = np.unique(corners, axis=0, return_inverse=True)
+
+    # Columns are read in blocks: chunks of the variable along the t, y and x axes
+    chunking = data_var.chunking() if hasattr(data_var, 'chunking') else 'contiguous'
+    if chunking == 'contiguous' or chunking is None:
+        block = {'t': 1, 'y': PROFILE_TILE, 'x': PROFILE_TILE}
+    else:
+        block = dict((role, size) for role, size in zip(roles, chunking))
+        block.setdefault('t', 1)
+    keys = columns // np.array([block['t'], block['y'], block['x']])
+    n_levels = data_var.shape[roles.index('z')]
+    values = np.ma.masked_all((len(columns), n_levels), dtype=np.float64)
+    # Order of the axes of a block read from the variable, to put them in the
+    # order t, z, y, x
+    present = [role for role in 'tzyx' if role in roles]
+    to_tzyx = [roles.index(role) for role in present]
+
+    block_keys, block_of = np.unique(keys, axis=0, return_inverse=True)
+    block_of = block_of.ravel()
+    for b in range(len(block_keys)):
+        members = np.flatnonzero(block_of == b)
+        t, y, x = columns[members, 0], columns[members, 1], columns[members, 2]
+        t_first, y_first, x_first = t.min(), y.min(), x.min()
+        bounds = {'t': slice(t_first, t.max() + 1), 'z': slice(None),
+                  'y': slice(y_first, y.max() + 1), 'x': slice(x_first, x.max() + 1)}
+        data = read(data_var, tuple(bounds[role] for role in roles))
+        data = np.ma.masked_invalid(np.ma.asarray(data, dtype=np.float64)).transpose(to_tzyx)
+        if 't' not in roles:
+            data = data[np.newaxis]
+        values[members] = data[t - t_first, :, y - y_first, x - x_first]
+
+    # Weighted mean of the corners, leaving out missing ones (their data may be
+    # NaN, so they are filled with zeros rather than only given zero weight)
+    corner_values = values[inverse.ravel()].reshape(n_obs, -1, n_levels)
+    valid = ~np.ma.getmaskarray(corner_values)
+    w = weights[:, :, None] * valid
+    total = w.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        profiles = (np.ma.filled(corner_values, 0.) * w).sum(axis=1) / total
+    dtype = COMPUTE_DTYPE or np.result_type(data_var.dtype, np.float32)
+    profiles = np.ma.MaskedArray(profiles.astype(dtype), mask=total <= 0)
+    return profiles, z_var, nu.isPositiveUp(z_var)
+
+
+# Size of the blocks of time steps read at once by the streaming extractors
+# (extract_zonal_mean, extract_meridional_mean) when no memory budget is set
+STREAM_BLOCK_BYTES = 64 * 1024 ** 2
+
+
+def _latitude_band(lat_vals, lat_min=None, lat_max=None):
+    """
+    Returns the slice of the latitude axis covering a band of latitudes.  The
+    latitudes may be in either order; a band containing no latitude gives the
+    latitude nearest to its middle.
+    """
+    lat_vals = np.asarray(lat_vals, dtype=np.float64)
+    lat_min = lat_vals.min() if lat_min is None else lat_min
+    lat_max = lat_vals.max() if lat_max is None else lat_max
+    inside = np.flatnonzero((lat_vals >= min(lat_min, lat_max)) &
+                            (lat_vals <= max(lat_min, lat_max)))
+    if len(inside) == 0:
+        nearest = nu.find_nearest_indices(lat_vals, [0.5 * (lat_min + lat_max)])[0]
+        return slice(nearest, nearest + 1)
+    return slice(inside.min(), inside.max() + 1)
+
+
+def _stream_mean(nc, data_var, z_index, lat_min, lat_max, axis, weighted, max_bytes):
+    """
+    Averages a variable over its longitude (axis=2) or latitude (axis=1) axis for
+    every time step, reading the latitude band in blocks of time steps that fit
+    in max_bytes and reducing each block before the next is read.
+    """
+    roles = nu.find_axis_roles(nc, data_var)
+    if None in roles or not set('tyx') <= set(roles):
+        raise ValueError("Cannot average a variable with axes %s; need time, latitude "
+                         "and longitude axes (and optionally vertical)"
+                         % ''.join(role or '-' for role in roles))
+    lat_var = nu.find_latitude_var(nc, data_var)
+    lat_vals = np.asarray(lat_var[:], dtype=np.float64)
+    band = _latitude_band(lat_vals, lat_min, lat_max)
+    index = [{'t': slice(0, 1), 'z': z_index, 'y': band, 'x': slice(None)}[role]
+             for role in roles]
+    t_dim = roles.index('t')
+    # Order of the axes of a block, to put them in the order t, y, x
+    present = [role for role in roles if role != 'z']
+    to_tyx = [present.index(role) for role in 'tyx']
+
+    if weighted and axis == 1:
+        # Area weights: grid cells shrink with the cosine of the latitude
+        weights = np.cos(np.radians(lat_vals[band]))[None, :, None]
+    else:
+        weights = np.ones((1, 1, 1))
+    n_t = data_var.shape[t_dim]
+    n_out = len(range(*band.indices(len(lat_vals)))) if axis == 2 \
+        else data_var.shape[roles.index('x')]
+    dtype = COMPUTE_DTYPE or np.result_type(data_var.dtype, np.float32)
+    means = np.empty((n_t, n_out), dtype=dtype)
+    valid_out = np.empty((n_t, n_out), dtype=bool)
+
+    # The blocks are slices of the time axis, wherever it is among the
+    # dimensions of the variable (iter_tiles would split the first one)
+    max_bytes = MEMORY_BUDGET if max_bytes is None else max_bytes
+    max_bytes = max_bytes or STREAM_BLOCK_BYTES
+    step_bytes = estimate_nbytes(data_var, tuple(index))
+    n_steps = max(1, max_bytes // max(step_bytes, 1))
+    for start in range(0, n_t, n_steps):
+        rows = slice(start, min(start + n_steps, n_t))
+        index[t_dim] = rows
+        # A single time step is read even if it is larger than the limit
+        tile = read(data_var, tuple(index), max(max_bytes, step_bytes))
+        tile = tile.transpose(to_tyx)
+        valid = ~np.ma.getmaskarray(tile) & np.isfinite(np.ma.getdata(tile))
+        w = valid * weights
+        total = w.sum(axis=axis)
+        data = np.where(valid, np.ma.getdata(tile), 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[rows] = (data * w).sum(axis=axis) / total
+        valid_out[rows] = total > 0
+
+    if NAN_FILL:
+        means[~valid_out] = np.nan
+        return means
+    return np.ma.MaskedArray(means, mask=~valid_out)
+
+
+@instrument.timed('decode')
+def extract_zonal_mean(nc, data_var, z_index=0, lat_min=None, lat_max=None, max_bytes=None):
+    """
+    This function extracts the zonal mean of a variable (its mean over longitude)
+    for every time step, e.g. for a latitude-time plot.  Only the latitude band
+    asked for is read, a block of time steps at a time, and every block is
+    reduced before the next is read, so the memory used stays within the budget
+    however long the time axis is.  All cells of a latitude row have the same
+    area on a regular grid, so the mean needs no area weights.
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object with time, latitude and longitude axes
+    :param z_index: optional - the desired index along the z-axis (if present)
+    :param lat_min: optional - the southern edge of the latitude band (all
+                    latitudes if not given)
+    :param lat_max: optional - the northern edge of the latitude band
+    :param max_bytes: optional - the size limit of a block (the memory budget if
+                      not given, or STREAM_BLOCK_BYTES if there is no budget)
+    :raise ValueError: if the variable does not have the axes needed
+    :return: (n_times, n_latitudes) array of means (masked, or NaN where there are
+             no data, see set_nan_fill), the latitude values of the band, and the
+             time variable
+    """
+    means = _stream_mean(nc, data_var, z_index, lat_min, lat_max, 2, False, max_bytes)
+    lat_var = nu.find_latitude_var(nc, data_var)
+    band = _latitude_band(lat_var[:], lat_min, lat_max)
+    return means, lat_var[band], nu.find_time_var(nc, data_var)
+
+
+@instrument.timed('decode')
+def extract_meridional_mean(nc, data_var, z_index=0, lat_min=None, lat_max=None,
+                            weighted=True, max_bytes=None):
+    """
+    This function extracts the meridional mean of a variable (its mean over a
+    band of latitudes) for every time step and longitude.  Over a narrow band,
+    e.g. 5S to 5N, this is a Hovmoller (time-longitude) diagram.  As for
+    extract_zonal_mean, only the band is read, a block of time steps at a time.
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object with time, latitude and longitude axes
+    :param z_index: optional - the desired index along the z-axis (if present)
+    :param lat_min: optional - the southern edge of the latitude band (all
+                    latitudes if not given)
+    :param lat_max: optional - the northern edge of the latitude band
+    :param weighted: optional - if True, weight the latitudes by the cosine of the
+                     latitude (the area of the grid cells)
+    :param max_bytes: optional - the size limit of a block (the memory budget if
+                      not given, or STREAM_BLOCK_BYTES if there is no budget)
+    :raise ValueError: if the variable does not have the axes needed
+    :return: (n_times, n_longitudes) array of means (masked, or NaN where there are
+             no data, see set_nan_fill), the longitude variable and the time variable
+    """
+    means = _stream_mean(nc, data_var, z_index, lat_min, lat_max, 1, weighted, max_bytes)
+    return means, nu.find_longitude_var(nc, data_var), nu.find_time_var(nc, data_var)
+
+
+def extract_hovmoller(nc, data_var, lat, z_index=0, half_width=0., weighted=True,
+                      max_bytes=None):
+    """
+    This function extracts a Hovmoller (time-longitude) diagram of a variable:
+    its values along a latitude, or averaged over a band of latitudes around it,
+    for every time step.  See extract_meridional_mean.
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object with time, latitude and longitude axes
+    :param lat: the latitude of the diagram in degrees
+    :param z_index: optional - the desired index along the z-axis (if present)
+    :param half_width: optional - the half width in degrees of the latitude band
+                       to average over; with 0 the nearest latitude is taken
+    :param weighted: optional - if True, weight the latitudes of the band by the
+                     cosine of the latitude
+    :param max_bytes: optional - the size limit of a block read at once
+    :return: (n_times, n_longitudes) array, the longitude variable and the time
+             variable
+    """
+    return extract_meridional_mean(nc, data_var, z_index, lat - half_width,
+                                   lat + half_width, weighted, max_bytes)
@@ -1,32 +1,44 @@
 import netCDF4
 import netcdf_utils
 import numpy as np
+import extract
+import instrument
 
+# Column ozone in kg m-2 corresponding to one Dobson unit
+KG_M2_PER_DU = 2.1414E-5
+
+@instrument.timed('colocate')
 def read_globmodel(filename, array_lon, array_lat):
     """
-    This function finds out the ozone data from the GlobModel model results which 
-    has the same location as the satellite measurements'. And then return the 
+    This function finds out the ozone data from the GlobModel model results which
+    has the same location as the satellite measurements'. And then return the
     list of the ozone data which is extracted from the GlobModel data.
+    The data keep the type of the model data (or the compute type set with
+    extract.set_compute_dtype), and missing model values are returned as NaN.
     :param filename: the name of the NetCDF file containing GlobModel data.
-    :param array_lon: An array of longitude coordinate values of the extracted data 
+    :param array_lon: An array of longitude coordinate values of the extracted data
     :param array_lat: An array of latitude coordinate values of the extracted data
     :return: the extracted ozone data from GlobModel results with unit DU
     """
-    nc = netCDF4.Dataset(filename)
-    data_var = nc.variables['colo3']
-    
-    # Latitude and longitude arrays from satellite have the same lenth-scale
-    n = len(array_lat)
-    ozone_value = np.zeros(n)    
-    
-    # Extract the data on the same location as satellite
-    for i in range(n):
-        lat_index = netcdf_utils.find_nearest_lat_index(nc, data_var, array_lat[i])
-        lon_index = netcdf_utils.find_nearest_lon_index(nc, data_var, array_lon[i])
-            
-        # The time index of ozone from globmodel should be 0 because its shape is 1
-        ozone_value[i] = data_var[0, lat_index, lon_index]/2.1414E-5
-    
-    
+    nc = netcdf_utils.open_dataset(filename)
+    try:
+        data_var = nc.variables['colo3']
+
+        # Latitude and longitude arrays from satellite have the same lenth-scale;
+        # find the nearest grid point of all of them at once
+        lat_index = netcdf_utils.find_nearest_lat_indices(nc, data_var, array_lat)
+        lon_index = netcdf_utils.find_nearest_lon_indices(nc, data_var, array_lon)
+
+        # The time index of ozone from globmodel should be 0 because its shape is 1.
+        # Read the whole map once and pick out the satellite locations from it
+        field = extract.read(data_var, (0, slice(None), slice(None)))
+        ozone_value = field[lat_index, lon_index]
+        if ozone_value.dtype.kind != 'f':
+            ozone_value = ozone_value.astype(np.float64)
+        ozone_value = np.ma.filled(ozone_value, np.nan)
+    finally:
+        nc.close()
+
+    # Convert to DU in place, without making a float64 copy
+    ozone_value /= KG_M2_PER_DU
     return ozone_value
-    
\ No newline at end of file
@@ -0,0 +1,246 @@
+""" Contains optional instrumentation of the hot paths of this package.  When it
+    is switched on, every instrumented function records its number of calls,
+    wall time (total and excluding instrumented functions it calls), and the
+    number of elements and bytes of the arrays it returns; caches record their
+    hits and misses; the largest single read and the peak memory of the process
+    are kept.  When it is switched off (the default), an instrumented
+    function costs one extra function call and a test of a global flag.
+
+    Usage:
+        with instrument.profile() as report:
+            main.plot_map(filename, 'ta', 0, 5)
+        print(instrument.format_report(report))
+        instrument.dump_json(report, 'profile.json') """
+
+import contextlib
+import functools
+import json
+import sys
+import threading
+import time
+import numpy as np
+
+try:
+    # Only available on Unix
+    import resource
+except ImportError:
+    resource = None
+
+# Whether the instrumented functions record anything
+ENABLED = False
+
+# Records of the instrumented functions, keyed by "module.function"
+_records = {}
+# Hit and miss counts of the caches, keyed by cache name
+_counters = {}
+# Largest single read, as estimated by the extract functions
+_memory = {'peak_read_bytes': 0}
+_lock = threading.Lock()
+# Per-thread stack of the instrumented calls in progress, for the exclusive times
+_local = threading.local()
+
+
+def reset():
+    """
+    Clears all records and counters.
+    :return: no return
+    """
+    with _lock:
+        _records.clear()
+        _counters.clear()
+        _memory['peak_read_bytes'] = 0
+
+
+def _result_size(result):
+    """
+    Returns the number of elements and bytes of the arrays in a function result
+    (an array, or a tuple containing arrays).
+    """
+    items = result if isinstance(result, tuple) else (result,)
+    elements = 0
+    nbytes = 0
+    for item in items:
+        if isinstance(item, np.ndarray):
+            elements += item.size
+            nbytes += item.size * item.itemsize
+    return elements, nbytes
+
+
+def record(name, stage, seconds, self_seconds, elements=0, nbytes=0):
+    """
+    Adds one call to the records.
+    :param name: the name of the function, e.g. "extract.extract_map_data"
+    :param stage: the processing stage, e.g. "metadata", "decode" or "render"
+    :param seconds: the wall time of the call
+    :param self_seconds: the wall time excluding instrumented functions it called
+    :param elements: optional - the number of array elements produced
+    :param nbytes: optional - the number of bytes of array data produced
+    :return: no return
+    """
+    with _lock:
+        rec = _records.get(name)
+        if rec is None:
+            rec = _records[name] = {'stage': stage, 'calls': 0, 'seconds': 0.,
+                                    'self_seconds': 0., 'elements': 0, 'bytes': 0}
+        rec['calls'] += 1
+        rec['seconds'] += seconds
+        rec['self_seconds'] += self_seconds
+        rec['elements'] += elements
+        rec['bytes'] += nbytes
+
+
+def count(cache_name, hit, n=1):
+    """
+    Counts a cache hit or miss.  Does nothing when instrumentation is switched off.
+    :param cache_name: the name of the cache
+    :param hit: True for a hit, False for a miss
+    :param n: optional - the number of hits or misses
+    :return: no return
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        counter = _counters.setdefault(cache_name, {'hits': 0, 'misses': 0})
+        counter['hits' if hit else 'misses'] += n
+
+
+def note_allocation(nbytes):
+    """
+    Records the size of an array about to be read, keeping the largest.  Does
+    nothing when instrumentation is switched off.
+    :param nbytes: the (estimated) size of the array in bytes
+    :return: no return
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        if nbytes > _memory['peak_read_bytes']:
+            _memory['peak_read_bytes'] = nbytes
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory of this process so far in bytes, or None if
+    it is not available on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def timed(stage):
+    """
+    Decorator that instruments a function as part of the given stage.
+    :param stage: the processing stage, e.g. "metadata", "decode" or "render"
+    :return: the decorator
+    """
+    def decorator(func):
+        name = '%s.%s' % (func.__module__, func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            stack = getattr(_local, 'stack', None)
+            if stack is None:
+                stack = _local.stack = []
+            # Time spent in instrumented functions called from this one
+            stack.append(0.)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                child_seconds = stack.pop()
+                if stack:
+                    stack[-1] += seconds
+            elements, nbytes = _result_size(result)
+            record(name, stage, seconds, seconds - child_seconds, elements, nbytes)
+            return result
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    """
+    Returns a copy of the current records and counters, with totals per stage.
+    :return: dictionary with "functions", "stages", "caches" and "memory" entries
+    """
+    with _lock:
+        functions = dict((name, dict(rec)) for name, rec in _records.items())
+        caches = dict((name, dict(counter)) for name, counter in _counters.items())
+        memory = {'peak_read_bytes': _memory['peak_read_bytes'], 'peak_rss_bytes': peak_rss()}
+    stages = {}
+    for rec in functions.values():
+        stage = stages.setdefault(rec['stage'], {'calls': 0, 'self_seconds': 0.,
+                                                 'elements': 0, 'bytes': 0})
+        stage['calls'] += rec['calls']
+        stage['self_seconds'] += rec['self_seconds']
+        stage['elements'] += rec['elements']
+        stage['bytes'] += rec['bytes']
+    for counter in caches.values():
+        total = counter['hits'] + counter['misses']
+        counter['hit_rate'] = counter['hits'] / float(total) if total else None
+    return {'functions': functions, 'stages': stages, 'caches': caches, 'memory': memory}
+
+
+@contextlib.contextmanager
+def profile():
+    """
+    Context manager that switches instrumentation on for the duration of a block.
+    The report dictionary it yields is filled in (see snapshot) when the block ends.
+    :return: the report dictionary
+    """
+    global ENABLED
+    was_enabled = ENABLED
+    reset()
+    ENABLED = True
+    report = {}
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        ENABLED = was_enabled
+        report.update(snapshot())
+        report['seconds'] = time.perf_counter() - start
+
+
+def format_report(report):
+    """
+    Formats a report as a table, with the stages and functions that took most
+    time first.
+    :param report: the report dictionary
+    :return: the table as a string
+    """
+    memory = report.get('memory', {})
+    lines = ['Total time: %.4f s' % report.get('seconds', 0.),
+             'Largest read: %d bytes' % memory.get('peak_read_bytes', 0),
+             'Peak resident memory: %s bytes' % memory.get('peak_rss_bytes'), '',
+             '%-12s %8s %12s %14s %14s' % ('stage', 'calls', 'self time/s', 'elements', 'bytes')]
+    for stage, rec in sorted(report['stages'].items(), key=lambda s: -s[1]['self_seconds']):
+        lines.append('%-12s %8d %12.4f %14d %14d' % (stage, rec['calls'], rec['self_seconds'],
+                                                     rec['elements'], rec['bytes']))
+    lines += ['', '%-44s %8s %10s %12s' % ('function', 'calls', 'time/s', 'self time/s')]
+    for name, rec in sorted(report['functions'].items(), key=lambda f: -f[1]['self_seconds']):
+        lines.append('%-44s %8d %10.4f %12.4f' % (name, rec['calls'], rec['seconds'],
+                                                  rec['self_seconds']))
+    if report['caches']:
+        lines += ['', '%-20s %8s %8s %9s' % ('cache', 'hits', 'misses', 'hit rate')]
+        for name, counter in sorted(report['caches'].items()):
+            rate = counter['hit_rate']
+            lines.append('%-20s %8d %8d %9s' % (name, counter['hits'], counter['misses'],
+                                                '-' if rate is None else '%.1f%%' % (100 * rate)))
+    return '\n'.join(lines)
+
+
+def dump_json(report, filename):
+    """
+    Writes a report to a JSON file.
+    :param report: the report dictionary
+    :param filename: location of the JSON file
+    :return: no return
+    """
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
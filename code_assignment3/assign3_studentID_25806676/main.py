@@ -2,9 +2,13 @@ import netCDF4
 import extract
 import plotting
 import netcdf_utils
+import cache
+import chunkcache
+import expression
+import mosaic
 import os
 
-def plot_map(filename, varname, t_index, z_index):
+def plot_map(filename, varname, t_index, z_index, output=None, nc=None):
     """
     This function plots a map from NetCDF data.
     The function extracts the relevant data using functions from netcdf_utils and extract
@@ -13,29 +17,67 @@ def plot_map(filename, varname, t_index, z_index):
     There is no extra error handling  - the function will not work if the arguments are incorrect
     The netcdf file must contain a valid latitude and longitude variable
     :param filename: location of a NetCDF file as a string (in file system)
-    :param varname: the identifier of the variable that is to be plotted
+    :param varname: the identifier of the variable that is to be plotted, or an
+                    expression over variables (see expression.define)
     :param t_index: index along the time axis as an integer
     :param z_index: index along the vertical axis as an integer
+    :param output: optional - location of an image file to save the plot to
+                   instead of displaying it
+    :param nc: optional - the file already opened as a Dataset, used instead of
+               opening it again
     :return: no return
     """
-    nc = netCDF4.Dataset(filename)
-    data_var = nc.variables[varname]
-    
-    # Extract the required data
-    data = extract.extract_map_data(nc, data_var, t_index, z_index)
-    
-    # Find the longitude and latitude values
-    lon_var = netcdf_utils.find_longitude_var(nc, data_var)
-    lon_vals = lon_var[:]
-    lat_var = netcdf_utils.find_latitude_var(nc, data_var)
-    lat_vals = lat_var[:]
+    if nc is None:
+        nc = netcdf_utils.open_dataset(filename)
+    data_var = expression.lookup(nc, varname)
+    chunkcache.configure(nc, data_var, 'map')
+
+    # Extract the required data and the longitude and latitude values.  If a
+    # memory budget is set (see extract.set_memory_budget) and the full map does
+    # not fit, every n-th longitude and latitude is read instead
+    data, lon_vals, lat_vals = cache.cached_call(extract.extract_map_data_downsampled,
+                                                 nc, data_var, t_index, z_index)
     
     title = "Plot of %s" % netcdf_utils.get_title(data_var)
     
-    plotting.display_map_plot(data, lon_vals, lat_vals, title)
+    plotting.display_map_plot(data, lon_vals, lat_vals, title, output)
     
 
-def plot_vertical_section(filename, varname, direction, value, t_index):
+def plot_maps(filename, varnames, t_index, z_index, workers=4, output=None, nc=None):
+    """
+    This function plots maps of several variables on the same grid, e.g.
+    temperature and salinity at the same time and level.  The data of all
+    variables are extracted together (see extract.extract_map_data_multi), then
+    each is plotted as in plot_map.
+    :param filename: location of a NetCDF file as a string (in file system)
+    :param varnames: list of the identifiers of the variables (or expressions)
+    :param t_index: index along the time axis as an integer
+    :param z_index: index along the vertical axis as an integer
+    :param workers: optional - the number of threads reading variables
+    :param output: optional - location of the image files to save the plots to
+                   instead of displaying them, with %s for the variable identifier,
+                   e.g. "map_%s.png"
+    :param nc: optional - the file already opened as a Dataset, used instead of
+               opening it again
+    :return: no return
+    """
+    if nc is None:
+        nc = netcdf_utils.open_dataset(filename)
+    data_vars = [expression.lookup(nc, varname) for varname in varnames]
+    for data_var in data_vars:
+        chunkcache.configure(nc, data_var, 'map')
+
+    maps, lon_vals, lat_vals = extract.extract_map_data_multi(nc, data_vars, t_index,
+                                                              z_index, workers)
+
+    for data_var in data_vars:
+        title = "Plot of %s" % netcdf_utils.get_title(data_var)
+        plotting.display_map_plot(maps[data_var._name], lon_vals, lat_vals, title,
+                                  None if output is None else output % data_var._name)
+
+
+def plot_vertical_section(filename, varname, direction, value, t_index, output=None,
+                          nc=None):
     """
     This function plots a vertical section from NetCDF data.
     The function extracts the relevant data using functions from netcdf_utils and extract
@@ -44,18 +86,25 @@ def plot_vertical_section(filename, varname, direction, value, t_index):
     There is no extra error handling  - the function will not work if the arguments are incorrect
     The netcdf file must contain a valid latitude and longitude variable
     :param filename: location of a NetCDF file as a string (in file system)
-    :param varname: the identifier of the variable that is to be plotted
+    :param varname: the identifier of the variable that is to be plotted, or an
+                    expression over variables (see expression.define)
     :param direction: the direction of the vertical section as a string
     :param value: the latitude or longitude that section represents
     :param t_index: index along the time axis as an integer
+    :param output: optional - location of an image file to save the plot to
+                   instead of displaying it
+    :param nc: optional - the file already opened as a Dataset, used instead of
+               opening it again
     :return: no return
     """
-    nc = netCDF4.Dataset(filename)
-    data_var = nc.variables[varname]
+    if nc is None:
+        nc = netcdf_utils.open_dataset(filename)
+    data_var = expression.lookup(nc, varname)
+    chunkcache.configure(nc, data_var, 'section')
       
     # Extract the required vertical profile data and coordinate data
     data, coor_x, coor_z = \
-         extract.extract_vertical_data(nc, data_var, direction, value, t_index)
+         cache.cached_call(extract.extract_vertical_data, nc, data_var, direction, value, t_index)
 
     # Determine the title of the plot
     title = '{direction} section of {name} ({unit}) at {value} degrees {coord}'\
@@ -66,26 +115,33 @@ def plot_vertical_section(filename, varname, direction, value, t_index):
     value=value, coord =('latitude' if direction == 'EW' else 'longitude')\
     )
       
-    plotting.display_vertical_plot(data, coor_z, coor_x, title)
+    plotting.display_vertical_plot(data, coor_z, coor_x, title, output)
 
 
-def plot_timeseries(filename, varname, lon, lat, z):
+def plot_timeseries(filename, varname, lon, lat, z, output=None, nc=None):
     """
     This function plots the time series from NetCDF data.
     The function extracts the relevant data using functions from netcdf_utils and extract
     It plots the data using functions from plotting.
     :param filename: location of a NetCDF file as a string (in file system)
-    :param varname: the identifier of the variable that is to be plotted
+    :param varname: the identifier of the variable that is to be plotted, or an
+                    expression over variables (see expression.define)
     :param lon: the value of longitude in degrees
     :param lat: the value of latitude in degrees
     :param z: the value of vertical coordinate variable
+    :param output: optional - location of an image file to save the plot to
+                   instead of displaying it
+    :param nc: optional - the file already opened as a Dataset, used instead of
+               opening it again
     :return: no return
     """
-    nc = netCDF4.Dataset(filename)
-    data_var = nc.variables[varname]
+    if nc is None:
+        nc = netcdf_utils.open_dataset(filename)
+    data_var = expression.lookup(nc, varname)
+    chunkcache.configure(nc, data_var, 'timeseries')
 
     # Extract the required data and coordinate data
-    data, coor_t = extract.extract_timeseries(nc, data_var, lon, lat, z)
+    data, coor_t = cache.cached_call(extract.extract_timeseries, nc, data_var, lon, lat, z)
   
     # Determine the title of the plot
     z_var = netcdf_utils.find_vertical_var(nc, data_var)
@@ -99,7 +155,7 @@ def plot_timeseries(filename, varname, lon, lat, z):
             z_unit=netcdf_utils.get_attribute(z_var, 'units', 'no units')\
             )
         
-        plotting.display_timeseries_plot(data, data_var, coor_t, title)
+        plotting.display_timeseries_plot(data, data_var, coor_t, title, output)
     
     else:
         title = 'Time series for {name} ({unit})\nat {lat} degrees latitude and ' \
@@ -110,7 +166,39 @@ def plot_timeseries(filename, varname, lon, lat, z):
             lat=lat, lon=lon
             )
         
-        plotting.display_timeseries_plot(data, data_var, coor_t, title)
+        plotting.display_timeseries_plot(data, data_var, coor_t, title, output)
+
+
+def plot_mosaic(filenames, varname, t_index, z_index, overlap='last', workers=4,
+                output=None, out_file=None):
+    """
+    This function plots a map of a tiled product: the maps of a variable in
+    several tile files are joined into one (see mosaic.build_mosaic) and plotted
+    as in plot_map.
+    :param filenames: list of the locations of the tile files
+    :param varname: the identifier of the variable that is to be plotted, or an
+                    expression over variables (see expression.define)
+    :param t_index: index along the time axis as an integer
+    :param z_index: index along the vertical axis as an integer
+    :param overlap: optional - how to combine tiles where they overlap, one of
+                    mosaic.OVERLAP_RULES
+    :param workers: optional - the number of threads reading tiles
+    :param output: optional - location of an image file to save the plot to
+                   instead of displaying it
+    :param out_file: optional - location of a file to memory-map the mosaic to
+    :return: no return
+    """
+    data, lon_vals, lat_vals = mosaic.build_mosaic(filenames, varname, t_index, z_index,
+                                                   overlap, workers, out_file)
+
+    # The title is taken from the variable in the first tile
+    nc = netcdf_utils.open_dataset(filenames[0])
+    try:
+        title = "Plot of %s" % netcdf_utils.get_title(expression.lookup(nc, varname))
+    finally:
+        nc.close()
+
+    plotting.display_map_plot(data, lon_vals, lat_vals, title, output)
 
 
 #### Here are some tests
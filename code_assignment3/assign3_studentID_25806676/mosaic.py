@@ -0,0 +1,321 @@
+""" Contains code for joining maps from tiled products (files that each hold one
+    region of the same variable on the same grid) into a single map.
+
+    The mosaic grid is worked out from the coordinate values of the tiles: if all
+    of them lie on one regular grid, the mosaic covers it from the first value
+    to the last (cells no tile covers are missing); otherwise the grid is the
+    union of the tile coordinates.  The tiles are then read by several threads at
+    once, in bands of rows that fit in max_bytes (see extract.iter_tiles), and
+    placed into the mosaic by their coordinates.  The mosaic is an array in
+    memory, or a memory-mapped file for mosaics too large for memory.
+
+    Where tiles overlap, the overlap rule decides which values are kept:
+        'first' - the value of the tile earliest in the list of files
+        'last'  - the value of the tile latest in the list of files
+        'mean'  - the mean of the values of all tiles
+        'max', 'min' - the largest or smallest value
+    A missing value never replaces a valid one, so the margins that tiles often
+    fill with missing values do not punch holes into their neighbours.  Because
+    of this, tiles can be placed in any order and threads place them as soon as
+    they are read.
+
+    Usage:
+        data, lon_vals, lat_vals = mosaic.build_mosaic(glob.glob('sst_tile_*.nc'),
+                                                       'analysed_sst', 0, 0,
+                                                       overlap='mean')
+        plotting.display_map_plot(data, lon_vals, lat_vals, 'Mosaic of SST') """
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import threading
+import numpy as np
+import expression
+import extract
+import netcdf_utils as nu
+
+OVERLAP_RULES = ('first', 'last', 'mean', 'max', 'min')
+# Coordinate values closer than this fraction of the grid spacing are taken to be
+# the same grid point
+TOLERANCE = 0.01
+# Default number of threads reading tiles
+WORKERS = 4
+
+
+class _Tile(object):
+    """
+    One tile of a mosaic: its open file, variable, and the positions of its
+    longitudes and latitudes in the mosaic.
+    """
+
+    def __init__(self, filename, nc, data_var, lon_vals, lat_vals):
+        self.filename = filename
+        self.nc = nc
+        self.data_var = data_var
+        self.lon_vals = lon_vals
+        self.lat_vals = lat_vals
+        self.cols = None
+        self.rows = None
+
+
+def _normalize_longitudes(tiles):
+    """
+    Puts the longitudes of all tiles into the same convention: 0 to 360 if any
+    tile uses longitudes above 180, else they are left as they are (usually -180
+    to 180).
+    """
+    if any(np.any(tile.lon_vals > 180.) for tile in tiles):
+        for tile in tiles:
+            tile.lon_vals = np.mod(tile.lon_vals, 360.)
+
+
+def mosaic_axis(values):
+    """
+    Works out one axis of a mosaic from the coordinate values of its tiles.
+    :param values: list of 1D arrays of coordinate values, one per tile
+    :raise ValueError: if a tile has no coordinate values
+    :return: the ascending coordinate values of the mosaic, and a list of index
+             arrays giving the position of every tile value in them
+    """
+    if any(len(vals) == 0 for vals in values):
+        raise ValueError("Cannot place a tile without coordinate values")
+    # The grid spacing is the smallest spacing within any tile
+    steps = [np.median(np.abs(np.diff(vals))) for vals in values if len(vals) > 1]
+    steps = [step for step in steps if step > 0]
+    everything = np.concatenate(values)
+    low, high = everything.min(), everything.max()
+    if not steps:
+        step = high - low
+    else:
+        step = min(steps)
+    if step <= 0:
+        # A single grid point
+        return np.array([low]), [np.zeros(len(vals), dtype=np.intp) for vals in values]
+
+    tol = TOLERANCE * step
+    positions = (everything - low) / step
+    if np.all(np.abs(positions - np.rint(positions)) < TOLERANCE):
+        # All tiles lie on one regular grid
+        axis = low + step * np.arange(int(np.rint((high - low) / step)) + 1)
+        indices = [np.rint((vals - low) / step).astype(np.intp) for vals in values]
+        return axis, indices
+
+    # Otherwise the union of the tile values, with values closer than the
+    # tolerance merged
+    merged = np.sort(everything)
+    axis = merged[np.concatenate([[True], np.diff(merged) > tol])]
+    indices = [np.searchsorted(axis, vals - tol) for vals in values]
+    return axis, indices
+
+
+def _open_tiles(filenames, varname):
+    """
+    Opens the tile files and reads their coordinate values.
+    """
+    tiles = []
+    try:
+        for filename in filenames:
+            with nu.thread_lock(filename):
+                nc = nu.open_dataset(filename)
+                tile = _Tile(filename, nc, None, None, None)
+                tiles.append(tile)
+                tile.data_var = expression.lookup(nc, varname)
+                lon_var = nu.find_longitude_var(nc, tile.data_var)
+                lat_var = nu.find_latitude_var(nc, tile.data_var)
+                if lon_var is None or lat_var is None:
+                    raise ValueError("Need both latitude and longitude dimensions to "
+                                     "place %s of %s" % (varname, filename))
+                tile.lon_vals = np.asarray(lon_var[:], dtype=np.float64)
+                tile.lat_vals = np.asarray(lat_var[:], dtype=np.float64)
+    except Exception:
+        _close_tiles(tiles)
+        raise
+    return tiles
+
+
+def _close_tiles(tiles):
+    """
+    Closes the files of the tiles.
+    """
+    for tile in tiles:
+        with nu.thread_lock(tile.filename):
+            tile.nc.close()
+
+
+def _new_array(shape, dtype, filename=None, fill=None):
+    """
+    Allocates an array of the mosaic: in memory, or memory-mapped to a file (to a
+    temporary file in the same directory if filename is a directory).
+    """
+    if filename is None:
+        arr = np.empty(shape, dtype=dtype)
+    elif os.path.isdir(filename):
+        arr = np.memmap(tempfile.TemporaryFile(dir=filename), dtype=dtype, mode='w+',
+                        shape=shape)
+    else:
+        arr = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+    if fill is not None:
+        arr[...] = fill
+    return arr
+
+
+class _Placer(object):
+    """
+    Places bands of tiles into a mosaic following an overlap rule.
+    """
+
+    def __init__(self, shape, dtype, overlap, out_file=None):
+        self.overlap = overlap
+        self.lock = threading.Lock()
+        # Working arrays of large mosaics are memory-mapped to temporary files
+        # next to the output file
+        work_dir = None if out_file is None else os.path.dirname(os.path.abspath(out_file))
+        if overlap == 'mean':
+            # The data array holds the sums until finish
+            self.data = _new_array(shape, dtype, out_file, 0)
+            self.count = _new_array(shape, np.int32, work_dir, 0)
+        else:
+            self.data = _new_array(shape, dtype, out_file, np.nan)
+        if overlap in ('first', 'last'):
+            # The rank of the tile each value came from; -1 or the largest rank
+            # where there is no value yet, so that any tile passes the comparison
+            empty = np.iinfo(np.int32).max if overlap == 'first' else -1
+            self.owner = _new_array(shape, np.int32, work_dir, empty)
+
+    def place(self, band, rows, cols, rank):
+        """
+        Places a band of a tile (with NaN for missing values) at the given rows
+        and columns of the mosaic.
+        """
+        valid = ~np.isnan(band)
+        index = np.ix_(rows, cols)
+        with self.lock:
+            current = self.data[index]
+            if self.overlap == 'mean':
+                current[valid] += band[valid]
+                counts = self.count[index]
+                counts += valid
+                self.count[index] = counts
+            elif self.overlap in ('max', 'min'):
+                combine = np.fmax if self.overlap == 'max' else np.fmin
+                current = combine(current, band)
+            else:
+                owner = self.owner[index]
+                if self.overlap == 'first':
+                    take = valid & (owner > rank)
+                else:
+                    take = valid & (owner < rank)
+                current[take] = band[take]
+                owner[take] = rank
+                self.owner[index] = owner
+            self.data[index] = current
+
+    def finish(self):
+        """
+        Returns the mosaic, with NaN where no tile has a value.
+        """
+        if self.overlap == 'mean':
+            # Row by row, so that memory-mapped mosaics are not read whole
+            for row in range(self.data.shape[0]):
+                counts = self.count[row]
+                self.data[row] = np.where(counts > 0, self.data[row] / np.maximum(counts, 1),
+                                          np.nan)
+        if isinstance(self.data, np.memmap):
+            self.data.flush()
+        return self.data
+
+
+def _place_tile(tile, rank, placer, t_index, z_index, dtype, max_bytes):
+    """
+    Reads one tile in bands and places them into the mosaic.
+    """
+    index = extract.map_index(tile.nc, tile.data_var, t_index, z_index)
+    roles = [role for role, idx in zip(nu.find_axis_roles(tile.nc, tile.data_var), index)
+             if isinstance(idx, slice)]
+    # Bands are split along the first axis of the map, which holds latitudes
+    # unless the variable is stored as (longitude, latitude)
+    transposed = roles.index('x') < roles.index('y')
+    file_lock = nu.thread_lock(tile.filename)
+    bands = extract.iter_tiles(tile.data_var, index, max_bytes)
+    while True:
+        with file_lock:
+            item = next(bands, None)
+        if item is None:
+            break
+        band_slice, band = item
+        band = np.ma.filled(np.ma.asarray(band).astype(dtype), np.nan)
+        if transposed:
+            placer.place(band.T, tile.rows, tile.cols[band_slice], rank)
+        else:
+            placer.place(band, tile.rows[band_slice], tile.cols, rank)
+
+
+def build_mosaic(filenames, varname, t_index=0, z_index=0, overlap='last', workers=WORKERS,
+                 out_file=None, max_bytes=None):
+    """
+    Joins the maps of a variable in several tile files into one map.
+    :param filenames: list of the locations of the tile files; for the 'first' and
+                      'last' overlap rules, their order decides which tile wins
+    :param varname: the identifier of the variable, or an expression over
+                    variables (see expression.define)
+    :param t_index: optional - index along the time axis (if present), the same
+                    in every tile
+    :param z_index: optional - index along the vertical axis (if present)
+    :param overlap: optional - the overlap rule, one of OVERLAP_RULES
+    :param workers: optional - the number of threads reading tiles
+    :param out_file: optional - location of a file to memory-map the mosaic to,
+                     for mosaics larger than memory
+    :param max_bytes: optional - the size limit of every band read from a tile
+                      (the memory budget if not given)
+    :raise ValueError: if the overlap rule is not known, no files are given, or a
+                       tile has no latitude and longitude axes
+    :raise MemoryError: if the mosaic is held in memory and is larger than the
+                        memory budget (see extract.set_memory_budget)
+    :return: the 2D map of the mosaic (a masked array, or a plain array with NaN
+             for missing values if extract.NAN_FILL is set), and its longitude and
+             latitude values
+    """
+    if overlap not in OVERLAP_RULES:
+        raise ValueError("Need to choose the overlap rule from %s" % ', '.join(OVERLAP_RULES))
+    if not filenames:
+        raise ValueError("Need at least one tile to build a mosaic")
+
+    tiles = _open_tiles(filenames, varname)
+    try:
+        _normalize_longitudes(tiles)
+        lon_vals, cols = mosaic_axis([tile.lon_vals for tile in tiles])
+        lat_vals, rows = mosaic_axis([tile.lat_vals for tile in tiles])
+        for tile, tile_cols, tile_rows in zip(tiles, cols, rows):
+            tile.cols, tile.rows = tile_cols, tile_rows
+
+        # The mosaic holds the type the extract functions return
+        dtype = extract.COMPUTE_DTYPE
+        if dtype is None:
+            dtype = np.result_type(np.float32, *[tile.data_var.dtype for tile in tiles
+                                                 if tile.data_var.dtype.kind == 'f'])
+        shape = (len(lat_vals), len(lon_vals))
+        nbytes = shape[0] * shape[1] * np.dtype(dtype).itemsize
+        if out_file is None and extract.MEMORY_BUDGET is not None and \
+                nbytes > extract.MEMORY_BUDGET:
+            raise MemoryError("A mosaic of %d x %d values needs %d bytes, more than the "
+                              "memory budget of %d bytes; give an out_file to map it to"
+                              % (shape[0], shape[1], nbytes, extract.MEMORY_BUDGET))
+
+        placer = _Placer(shape, dtype, overlap, out_file)
+        if workers > 1 and len(tiles) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(tiles))) as pool:
+                futures = [pool.submit(_place_tile, tile, rank, placer, t_index, z_index,
+                                       dtype, max_bytes)
+                           for rank, tile in enumerate(tiles)]
+                for future in futures:
+                    future.result()
+        else:
+            for rank, tile in enumerate(tiles):
+                _place_tile(tile, rank, placer, t_index, z_index, dtype, max_bytes)
+        data = placer.finish()
+    finally:
+        _close_tiles(tiles)
+
+    if not extract.NAN_FILL:
+        data = np.ma.masked_invalid(data, copy=False)
+    return data, lon_vals, lat_vals
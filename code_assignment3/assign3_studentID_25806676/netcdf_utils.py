@@ -1,9 +1,47 @@
 
 from utils import *
+import contextlib
+import threading
+import netCDF4
+import classic
+import instrument
 
 """ This module contains code for reading data from NetCDF files and
     intepreting metadata """
 
+# The netCDF-C and HDF5 libraries are not thread-safe, so threads must hold this
+# lock whenever they open, read or close a file through netCDF4 (see thread_lock)
+NETCDF_LOCK = threading.RLock()
+
+
+@instrument.timed('open')
+def open_dataset(filename):
+    """
+    Opens a NetCDF file for reading.  NetCDF-3 files are opened with the
+    memory-mapped reader in the classic module, which is faster to open and
+    reads only the sliced parts of variables, masking them as netCDF4 does; all
+    other files (e.g. NetCDF-4/HDF5) are opened with netCDF4.Dataset.
+    :param filename: location of a NetCDF file as a string (in file system)
+    :return: Dataset object (netCDF4.Dataset or classic.ClassicDataset)
+    """
+    if classic.is_classic_file(filename):
+        return classic.ClassicDataset(filename)
+    return netCDF4.Dataset(filename)
+
+
+def thread_lock(filename):
+    """
+    Returns the lock that a thread must hold while it uses a file.  NetCDF-3 files
+    are opened with the classic module, which only reads a memory map, so threads
+    can use them concurrently; all other files need NETCDF_LOCK.
+    :param filename: location of a NetCDF file, or None for a derived variable or
+                     in-memory dataset read through netCDF4
+    :return: a lock, or a context manager that does nothing
+    """
+    if filename is not None and classic.is_classic_file(filename):
+        return contextlib.nullcontext()
+    return NETCDF_LOCK
+
 
 def get_attribute(var, att_name, default=None):
     """
@@ -23,6 +61,100 @@ def get_attribute(var, att_name, default=None):
         return default
 
 
+def fill_values(var):
+    """
+    Returns the values that mark missing data in a variable: its _FillValue
+    (or the default NetCDF fill value for its type if none is set) and its
+    missing_value(s).
+    :param var: NetCDF Variable object
+    :return: list of fill values
+    """
+    fills = []
+    fill_value = get_attribute(var, '_FillValue')
+    if fill_value is None and var.dtype.kind in 'iuf':
+        # Like netCDF4, treat the default fill value as missing (netCDF4 does so
+        # for bytes too, unless filling was switched off for the variable)
+        fill_value = netCDF4.default_fillvals.get(var.dtype.str[1:])
+    if fill_value is not None:
+        fills.append(fill_value)
+    missing_value = get_attribute(var, 'missing_value')
+    if missing_value is not None:
+        fills.extend(np.atleast_1d(missing_value).tolist())
+    return fills
+
+
+def missing_mask(var, raw):
+    """
+    Works out which values read from a variable are missing, as netCDF4 does when
+    it masks data: values equal to a fill value (see fill_values) and values
+    outside valid_min/valid_max/valid_range.
+    :param var: NetCDF Variable object
+    :param raw: array of values as stored in the file (before unpacking)
+    :return: boolean array, True where values are missing, or None if the
+             variable has no fill values or valid range
+    """
+    missing = None
+    for fill in fill_values(var):
+        is_fill = raw == fill
+        missing = is_fill if missing is None else missing | is_fill
+    valid_range = get_attribute(var, 'valid_range')
+    valid_min = get_attribute(var, 'valid_min', None if valid_range is None else valid_range[0])
+    valid_max = get_attribute(var, 'valid_max', None if valid_range is None else valid_range[1])
+    for bound, outside in ((valid_min, np.less), (valid_max, np.greater)):
+        if bound is not None:
+            is_out = outside(raw, bound)
+            missing = is_out if missing is None else missing | is_out
+    return missing
+
+
+def read_plain(var, index, dtype=None):
+    """
+    Reads part of a variable as a plain floating point array rather than a masked
+    array.  Missing values (fill values and values outside valid_min/valid_max/
+    valid_range) become NaN, and packed data are unpacked with scale_factor and
+    add_offset, all in place on the array that was read.  Float32 data (and short
+    integer data packed with float32 factors) stay float32 unless a dtype is given.
+    :param var: NetCDF Variable object
+    :param index: tuple with one integer or slice per dimension
+    :param dtype: optional - the floating point type of the result
+    :return: numpy array with NaN for missing values
+    """
+    if hasattr(var, 'read_plain'):
+        # A derived variable (see the expression module) evaluates its inputs itself
+        return var.read_plain(index, dtype)
+    scale = get_attribute(var, 'scale_factor')
+    offset = get_attribute(var, 'add_offset')
+    if dtype is None:
+        packing = [np.asarray(v).dtype for v in (scale, offset) if v is not None]
+        dtype = np.result_type(np.float32 if var.dtype.itemsize <= 2 else var.dtype, *packing)
+        if dtype.kind != 'f':
+            dtype = np.float64
+
+    # Read the raw values, without netCDF4 building a masked array
+    if hasattr(var, 'raw'):
+        raw = var.raw()[index]
+    else:
+        auto_mask, auto_scale = getattr(var, 'mask', True), getattr(var, 'scale', True)
+        var.set_auto_maskandscale(False)
+        try:
+            raw = var[index]
+        finally:
+            var.set_auto_mask(auto_mask)
+            var.set_auto_scale(auto_scale)
+    raw = np.asarray(raw)
+    # Converting the type copies the data once; float data read by netCDF4 are
+    # already a private native array and are used as they are
+    data = raw.astype(dtype, copy=not raw.flags.writeable)
+
+    missing = missing_mask(var, raw)
+    if scale is not None:
+        data *= scale
+    if offset is not None:
+        data += offset
+    if missing is not None:
+        data[missing] = np.nan
+    return data
+
 def get_title(var):
     """
     Returns a title for a variable in the form "name (units)"
@@ -139,6 +271,7 @@ def is_time_var(coord_var):
 # that you may not be familiar with (i.e. passing functions as arguments to other functions)
 # - see me if you want to know more.
     
+@instrument.timed('metadata')
 def find_longitude_var(nc, data_var):
     """
     Given a NetCDF Dataset object and a Variable object representing a data
@@ -160,6 +293,7 @@ def find_longitude_var(nc, data_var):
     return None
 
 
+@instrument.timed('metadata')
 def find_latitude_var(nc, data_var):
     """
     Given a NetCDF Dataset object and a Variable object representing a data
@@ -181,6 +315,7 @@ def find_latitude_var(nc, data_var):
     return None
 
 
+@instrument.timed('metadata')
 def find_vertical_var(nc, data_var):
     """
     Given a NetCDF Dataset object and a Variable object representing a data
@@ -202,6 +337,7 @@ def find_vertical_var(nc, data_var):
     return None
 
 
+@instrument.timed('metadata')
 def find_time_var(nc, data_var):
     """
     Given a NetCDF Dataset object and a Variable object representing a data
@@ -223,6 +359,35 @@ def find_time_var(nc, data_var):
     return None
 
 
+@instrument.timed('metadata')
+def find_axis_roles(nc, data_var):
+    """
+    Given a NetCDF Dataset object and a Variable object representing a data
+    variable, this function works out what each dimension of the variable
+    represents.  The result has one entry per dimension: 't' for time, 'z' for
+    the vertical axis, 'y' for latitude, 'x' for longitude, or None if the
+    dimension has no recognised coordinate variable.
+    :param nc: NetCDF Dataset object
+    :param data_var: NetCDF Variable object
+    :return: list of axis roles, in the order of the variable's dimensions
+    """
+    roles = []
+    for dim in data_var.dimensions:
+        coord_var = nc.variables.get(dim)
+        if coord_var is None:
+            roles.append(None)
+        elif is_time_var(coord_var):
+            roles.append('t')
+        elif is_vertical_var(coord_var):
+            roles.append('z')
+        elif is_latitude_var(coord_var):
+            roles.append('y')
+        elif is_longitude_var(coord_var):
+            roles.append('x')
+        else:
+            roles.append(None)
+    return roles
+
 def isPositiveUp(z_var):
     """
     Given a vertical coordinate variable, this function returns true if the
@@ -257,6 +422,7 @@ def isPositiveUp(z_var):
                 "to 'up' or 'down'" % direction)
                 
                 
+@instrument.timed('index')
 def find_nearest_lat_index(nc, data_var, target):
     """
     Given a NetCDF Dataset object, one variable object which can represent the data variable,
@@ -282,6 +448,7 @@ def find_nearest_lat_index(nc, data_var, target):
         return index_lat
         
         
+@instrument.timed('index')
 def find_nearest_z_index(nc, data_var, target):
     """
     Given a NetCDF Dataset object, one variable object which can represent the data variable,
@@ -307,6 +474,7 @@ def find_nearest_z_index(nc, data_var, target):
         return index_vert
   
   
+@instrument.timed('index')
 def find_nearest_lon_index(nc, data_var, target):
     """
     Given a NetCDF Dataset object, one variable object which can represent the data variable,
@@ -332,4 +500,79 @@ def find_nearest_lon_index(nc, data_var, target):
         diff = (np.array(lon)-target)/180.*np.pi
         index_lon = find_nearest_index(np.cos(diff), 1.0)
     
-        return index_lon
\ No newline at end of file
+        return index_lon
+
+@instrument.timed('index')
+def find_nearest_lat_indices(nc, data_var, targets):
+    """
+    Like find_nearest_lat_index, but for many latitude values at once.
+    :param nc: the NetCDF Dataset object
+    :param data_var: the NetCDF Variable object
+    :param targets: an array of latitude values
+    :raise ValueError: if there's no corresponding latitude coordinate variable
+    :return: integer array of the indices of the latitudes closest to the targets
+    """
+    lat = find_latitude_var(nc, data_var)
+    if lat is None:
+        raise ValueError("There is no latitude coordinate variable found")
+    return find_nearest_indices(lat[:], targets)
+
+
+@instrument.timed('index')
+def find_nearest_lon_indices(nc, data_var, targets):
+    """
+    Like find_nearest_lon_index, but for many longitude values at once.  Longitudes
+    are compared around the circle, so -10 and 350 are the same.
+    :param nc: the NetCDF Dataset object
+    :param data_var: the NetCDF Variable object
+    :param targets: an array of longitude values
+    :raise ValueError: if there's no corresponding longitude coordinate variable
+    :return: integer array of the indices of the longitudes closest to the targets
+    """
+    lon = find_longitude_var(nc, data_var)
+    if lon is None:
+        raise ValueError("There is no longitude coordinate variable found")
+    return find_nearest_indices(lon[:], targets, 360.)
+
+#######################################################################################
+#####  The following functions help to write new NetCDF files that share
+#####  dimensions and coordinates with an existing file.
+#######################################################################################
+
+def copy_attributes(src_var, dst_var, skip=()):
+    """
+    Copies all the attributes of one Variable (or Dataset) object to another,
+    except _FillValue, which can only be set when a variable is created.
+    :param src_var: NetCDF Variable or Dataset object to copy from
+    :param dst_var: NetCDF Variable or Dataset object to copy to
+    :param skip: optional - names of further attributes not to copy
+    :return: no return
+    """
+    for att_name in src_var.ncattrs():
+        if att_name != '_FillValue' and att_name not in skip:
+            dst_var.setncattr(att_name, src_var.getncattr(att_name))
+
+
+def copy_dimension(nc_in, nc_out, dim, index=slice(None)):
+    """
+    Creates a dimension in an output Dataset with the same name as in the input
+    Dataset, and copies its coordinate variable (if there is one) with all its
+    attributes.  An index can be given to copy only part of the coordinate values.
+    :param nc_in: NetCDF Dataset object to copy from
+    :param nc_out: NetCDF Dataset object (open for writing) to copy to
+    :param dim: the name of the dimension
+    :param index: optional - slice or index array selecting part of the dimension
+    :return: the new coordinate Variable object, or None if there is none
+    """
+    if dim in nc_out.dimensions:
+        # Already copied, e.g. shared by two data variables
+        return nc_out.variables.get(dim)
+    size = len(np.arange(len(nc_in.dimensions[dim]))[index])
+    nc_out.createDimension(dim, size)
+    if dim not in nc_in.variables:
+        return None
+    coord_in = nc_in.variables[dim]
+    coord_out = nc_out.createVariable(dim, coord_in.dtype, (dim,))
+    copy_attributes(coord_in, coord_out)
+    coord_out[:] = coord_in[index]
+    return coord_out
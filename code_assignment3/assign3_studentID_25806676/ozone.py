@@ -1,9 +1,29 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import globmodel
-from mpl_toolkits.basemap import Basemap
+import plotting
+import sciamachy
+import instrument
 
-def plot_difference(globmodel_file, sciamachy_file):
+# matplotlib and Basemap are imported by the plot functions, on first use, so
+# that ozone_difference can be used (e.g. by batch or validation jobs) without
+# loading them
+
+def ozone_difference(sciamachy_data, globmodel_data):
+    """
+    Calculates the differences between the SCIAMACHY and GlobModel ozone columns,
+    in the floating point type of the GlobModel data (see extract.set_compute_dtype),
+    so float32 model data give a float32 result.
+    :param sciamachy_data: array of SCIAMACHY ozone columns in DU
+    :param globmodel_data: array of the colocated GlobModel ozone columns in DU
+    :return: array of the differences in DU, NaN where the model has no data
+    """
+    ozone_diff = np.asarray(sciamachy_data).astype(globmodel_data.dtype)
+    ozone_diff -= globmodel_data
+    return ozone_diff
+
+
+@instrument.timed('render')
+def plot_difference(globmodel_file, sciamachy_file, output=None):
     """
     This function extracts data from the SCIAMACHY file, then extracts the 
     corresponding ozone values from the GlobModel file. Calculates the difference 
@@ -11,23 +31,22 @@ def plot_difference(globmodel_file, sciamachy_file):
     scatter plot.
     :param globmodel_file: The name of the NetCDF file containing GlobModel data
     :param sciamachy_file: The name of the CSV file containing SCIAMACHY data
+    :param output: optional - location of an image file to save the plot to
+                   instead of displaying it
     :return: no return
     """
+    import matplotlib.pyplot as plt
     # Read ozone data from the sciamachy file
-    r = np.recfromcsv(sciamachy_file)
+    r = sciamachy.read_sciamachy(sciamachy_file)
     sciamchy_data = r.o3_du
     
     # Extract the ozone data loates on the same location from globmodel file
     globmodel_data = globmodel.read_globmodel(globmodel_file, r.lon, r.lat)
     
     # Calculate the difference between there two measurements
-    # Latitude and longitude have the same length-scale
-    n = len(r.lat)
-    ozone_diff = np.zeros(n)
-    for i in range(n):
-        ozone_diff[i] = sciamchy_data[i] - globmodel_data[i]
+    ozone_diff = ozone_difference(sciamchy_data, globmodel_data)
     
-    vmax = max(np.abs(ozone_diff))
+    vmax = np.nanmax(np.abs(ozone_diff))
     
     # Plottitn the scatter plot for this difference
     plt.figure()
@@ -38,10 +57,11 @@ def plot_difference(globmodel_file, sciamachy_file):
     plt.ylabel('Latitude (degrees)')
     plt.title('The ozone measurements difference between sciamachy and globmodel results')
     plt.colorbar(extend='both')
-    plt.show()
+    plotting.show_or_save(output)
     
 
-def plot_difference_basemap(globmodel_file, sciamachy_file, projection):
+@instrument.timed('render')
+def plot_difference_basemap(globmodel_file, sciamachy_file, projection, output=None):
     """
     This function extracts data from the SCIAMACHY file, then extracts the 
     corresponding ozone values from the GlobModel file. Calculates the difference 
@@ -49,21 +69,21 @@ def plot_difference_basemap(globmodel_file, sciamachy_file, projection):
     :param globmodel_file: The name of the NetCDF file containing GlobModel data
     :param sciamachy_file: The name of the CSV file containing SCIAMACHY data
     :param projection: The map projection for using 
+    :param output: optional - location of an image file to save the plot to
+                   instead of displaying it
     :return: no return
     """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.basemap import Basemap
     # Read ozone data from the sciamachy file
-    r = np.recfromcsv(sciamachy_file)
+    r = sciamachy.read_sciamachy(sciamachy_file)
     sciamchy_data = r.o3_du
     
     # Extract the ozone data loates on the same location from globmodel file
     globmodel_data = globmodel.read_globmodel(globmodel_file, r.lon, r.lat)
     
     # Calculate the difference between there two measurements
-    # Latitude and longitude arrays from satellite have the same lenth-scale
-    n = len(r.lat)
-    ozone_diff = np.zeros(n)
-    for i in range(n):
-        ozone_diff[i] = sciamchy_data[i] - globmodel_data[i]
+    ozone_diff = ozone_difference(sciamchy_data, globmodel_data)
     
     # Determine the projection
     if (projection == 'npstere'):
@@ -90,11 +110,11 @@ def plot_difference_basemap(globmodel_file, sciamachy_file, projection):
     
     # Convert the coordinate variables
     x, y = m(r.lon, r.lat)
-    vmax = max(np.abs(ozone_diff))
+    vmax = np.nanmax(np.abs(ozone_diff))
     m.scatter(x, y, c=ozone_diff, cmap='seismic', edgecolors='none',
               vmin=-vmax, vmax=vmax)
     m.colorbar()
     plt.title('Measurements difference on the projection %s!' % projection) 
-    plt.show()
+    plotting.show_or_save(output)
           
         
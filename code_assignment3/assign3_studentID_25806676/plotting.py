@@ -1,39 +1,63 @@
-""" Contains code for displaying data """
+""" Contains code for displaying data.  matplotlib is imported by the functions
+    that draw, on first use, so that modules importing this one (e.g. main) stay
+    quick to import for jobs that only extract data. """
 
-import matplotlib.pyplot as plt
 import netcdf_utils
 import numpy as np
 import netCDF4 as nc
-import matplotlib.dates as mdates
+import instrument
 
-def display_map_plot(data, lons, lats, title):
+
+def show_or_save(output=None):
+    """
+    Shows the current figure, or saves it to a file and closes it.
+    :param output: optional - location of the image file; the figure is shown if None
+    :return: no return
+    """
+    import matplotlib.pyplot as plt
+    if output is None:
+        plt.show()
+    else:
+        plt.savefig(output)
+        plt.close()
+
+
+@instrument.timed('render')
+def display_map_plot(data, lons, lats, title, output=None):
     """
     This function will create and display a map plot. It takes 4 mandatory arguments:
     data: a 2D array of data
     lons: a 1D array of longitude values
     lats: a 1D array of latitude values
     title: a string that is used as the title
+    output: optional - location of an image file to save the plot to instead of
+            displaying it
 
     It uses contourf to produce the contour plot
     This plots using 20 different levels/colours - the min and max values are taken from the array automatically.
     """
+    import matplotlib.pyplot as plt
 
     pc = plt.contourf(lons, lats, data, 20)
     plt.colorbar(pc, orientation='horizontal')
     plt.title(title)
     plt.xlabel("longitude (degrees east)")
     plt.ylabel("latitude (degrees north)")
-    plt.show()
+    show_or_save(output)
     
     
-def display_vertical_plot(data, coor_z, coor_x, title):
+@instrument.timed('render')
+def display_vertical_plot(data, coor_z, coor_x, title, output=None):
     """
     This function will display a vertical profile plot.
     :param data: the data which need to be plotted
     :param coor_z: the vertical coordinate values of the data
     :param coor_x: the x-direction coordinate values of the data
     :param title: a string that is used as the title
+    :param output: optional - location of an image file to save the plot to
+                   instead of displaying it
     """
+    import matplotlib.pyplot as plt
     # Get the name of x-label and y-label
     x_label = netcdf_utils.get_title(coor_x)
     y_label = netcdf_utils.get_title(coor_z) 
@@ -49,17 +73,22 @@ def display_vertical_plot(data, coor_z, coor_x, title):
     plt.title(title)
     plt.xlabel(x_label)
     plt.ylabel(y_label)
-    plt.show()
+    show_or_save(output)
  
 
-def display_timeseries_plot(data, data_var, coor_t, title):
+@instrument.timed('render')
+def display_timeseries_plot(data, data_var, coor_t, title, output=None):
     """
     This function will display a timeseries plot.
     :param data: the data which need to be plotted
     :param data_var: the variable object of data which contains the information
     :param t_var: the time dimension values
     :param title: a string that is used as the title
+    :param output: optional - location of an image file to save the plot to
+                   instead of displaying it
     """
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
     # Get the name of x-label and y-label
     x_label = netcdf_utils.get_title(coor_t)
     y_label = netcdf_utils.get_title(data_var)
@@ -86,7 +115,7 @@ def display_timeseries_plot(data, data_var, coor_t, title):
     ax.xaxis.set_major_formatter(date_fmt)
     ax.xaxis.set_minor_locator(hour_locator)
     
-    plt.show()
+    show_or_save(output)
     
     
     
\ No newline at end of file
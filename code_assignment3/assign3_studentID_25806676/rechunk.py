@@ -0,0 +1,190 @@
+""" Contains code for rewriting NetCDF variables with a chunk layout suited to the
+    way they will be read, e.g. long time series at single points, or whole maps """
+
+import itertools
+import netCDF4
+import numpy as np
+import netcdf_utils as nu
+
+# Target size of one chunk in bytes (HDF5 works best with chunks of roughly 1MB)
+CHUNK_BYTES = 1024 ** 2
+# Maximum amount of data held in memory while copying a variable
+MEMORY_LIMIT = 256 * 1024 ** 2
+
+# For each access pattern, the axes that should be read whole and the axes that
+# should be widened to fill up the chunk afterwards
+ACCESS_PATTERNS = {
+    'timeseries': (('t',), ('y', 'x')),
+    'map': (('y', 'x'), ()),
+    'section': (('z', 'y', 'x'), ()),
+}
+
+
+def choose_chunks(nc, data_var, pattern, target_bytes=CHUNK_BYTES):
+    """
+    Chooses chunk sizes for a variable so that the given access pattern touches
+    as few chunks as possible:
+    "timeseries" - all time steps at one point (as read by extract_timeseries)
+    "map" - one horizontal plane (as read by extract_map_data)
+    "section" - one vertical section (as read by extract_vertical_data)
+    :param nc: NetCDF Dataset object
+    :param data_var: NetCDF Variable object
+    :param pattern: the access pattern as a string
+    :param target_bytes: optional - the approximate size of one chunk in bytes
+    :raise ValueError: if the access pattern is not known
+    :return: list of chunk sizes, one per dimension
+    """
+    if pattern not in ACCESS_PATTERNS:
+        raise ValueError("Need to choose the access pattern from %s" %
+                         ', '.join(sorted(ACCESS_PATTERNS)))
+    whole, widen = ACCESS_PATTERNS[pattern]
+    roles = nu.find_axis_roles(nc, data_var)
+    shape = data_var.shape
+    itemsize = data_var.dtype.itemsize
+    chunks = [n if role in whole else 1 for role, n in zip(roles, shape)]
+    # Guard against zero-length (e.g. empty unlimited) dimensions
+    chunks = [max(c, 1) for c in chunks]
+
+    # Halve the longest axis until the chunk fits the target size
+    while np.prod(chunks) * itemsize > target_bytes and max(chunks) > 1:
+        axis = int(np.argmax(chunks))
+        chunks[axis] = (chunks[axis] + 1) // 2
+
+    # Widen the other axes in turn while there is room
+    grow = [i for i, role in enumerate(roles) if role in widen]
+    while grow:
+        grown = False
+        for axis in grow:
+            if chunks[axis] < shape[axis] and \
+                    np.prod(chunks) * 2 * itemsize <= target_bytes:
+                chunks[axis] = min(chunks[axis] * 2, shape[axis])
+                grown = True
+        if not grown:
+            break
+    return chunks
+
+
+def query_index(nc, data_var, pattern):
+    """
+    Returns an index representing one typical read of the given access pattern,
+    e.g. the time series at the first grid point for "timeseries".
+    :param nc: NetCDF Dataset object
+    :param data_var: NetCDF Variable object
+    :param pattern: the access pattern as a string
+    :return: tuple of integers and slices
+    """
+    whole = ACCESS_PATTERNS[pattern][0]
+    roles = nu.find_axis_roles(nc, data_var)
+    index = [slice(None) if role in whole else 0 for role in roles]
+    if pattern == 'section' and 'x' in roles:
+        # A N-S section is at one longitude
+        index[roles.index('x')] = 0
+    return tuple(index)
+
+
+def count_chunks(shape, chunks, index):
+    """
+    Counts the number of chunks that a read of the given index touches.
+    :param shape: the shape of the variable
+    :param chunks: list of chunk sizes, or "contiguous" (as returned by
+                   Variable.chunking())
+    :param index: tuple with one integer or slice per dimension
+    :return: the number of chunks, or None for contiguous storage
+    """
+    if chunks == 'contiguous' or chunks is None:
+        return None
+    total = 1
+    for n, chunk, idx in zip(shape, chunks, index):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(n)
+            if stop <= start:
+                return 0
+            total *= (stop - 1) // chunk - start // chunk + 1
+        # A single integer index touches exactly one chunk along its axis
+    return total
+
+
+def iter_blocks(shape, chunks, itemsize, max_bytes=MEMORY_LIMIT):
+    """
+    Splits a variable into blocks for copying.  Each block is made of whole
+    chunks (so every output chunk is written once) and holds at most max_bytes,
+    unless a single chunk is larger than that.
+    :param shape: the shape of the variable
+    :param chunks: list of chunk sizes of the output variable
+    :param itemsize: the size of one value in bytes
+    :param max_bytes: optional - the maximum size of a block in bytes
+    :return: generator of tuples of slices
+    """
+    block = list(shape)
+    for axis in range(len(shape)):
+        # Shrink the outermost axes first, keeping a whole number of chunks
+        while np.prod(block) * itemsize > max_bytes and block[axis] > chunks[axis]:
+            block[axis] = max(chunks[axis], (block[axis] // 2) // chunks[axis] * chunks[axis])
+    starts = [range(0, max(n, 1), max(b, 1)) for n, b in zip(shape, block)]
+    for corner in itertools.product(*starts):
+        yield tuple(slice(c, min(c + b, n)) for c, b, n in zip(corner, block, shape))
+
+
+def rechunk(filename, varname, out_filename, pattern='timeseries', chunks=None,
+            complevel=4, shuffle=True, max_bytes=MEMORY_LIMIT):
+    """
+    Writes a variable (with its coordinate variables) to a new NetCDF-4 file,
+    chunked for the given access pattern and compressed with deflate.  The data
+    are copied block by block, so at most max_bytes of data are held in memory.
+    :param filename: location of the input NetCDF file
+    :param varname: the identifier of the variable to be rewritten
+    :param out_filename: location of the new NetCDF file
+    :param pattern: optional - the access pattern ("timeseries", "map" or "section")
+    :param chunks: optional - explicit chunk sizes, overriding the access pattern
+    :param complevel: optional - the deflate level (0 switches compression off)
+    :param shuffle: optional - whether to apply the HDF5 shuffle filter
+    :param max_bytes: optional - the maximum amount of data held in memory
+    :return: the chunk report (see chunk_report) for the access pattern
+    """
+    nc = netCDF4.Dataset(filename)
+    try:
+        data_var = nc.variables[varname]
+        if chunks is None:
+            chunks = choose_chunks(nc, data_var, pattern)
+        out = netCDF4.Dataset(out_filename, 'w', format='NETCDF4')
+        try:
+            nu.copy_attributes(nc, out)
+            for dim in data_var.dimensions:
+                nu.copy_dimension(nc, out, dim)
+            out_var = out.createVariable(varname, data_var.dtype, data_var.dimensions,
+                                         zlib=complevel > 0, complevel=complevel,
+                                         shuffle=shuffle, chunksizes=chunks,
+                                         fill_value=nu.get_attribute(data_var, '_FillValue'))
+            nu.copy_attributes(data_var, out_var)
+            # Copy the raw values, without masking and unmasking fill values
+            data_var.set_auto_maskandscale(False)
+            out_var.set_auto_maskandscale(False)
+            for block in iter_blocks(data_var.shape, chunks, data_var.dtype.itemsize, max_bytes):
+                out_var[block] = data_var[block]
+        finally:
+            out.close()
+        return chunk_report(nc, data_var, pattern, chunks)
+    finally:
+        nc.close()
+
+
+def chunk_report(nc, data_var, pattern, new_chunks=None):
+    """
+    Reports how many chunks one typical read of the access pattern touches with
+    the current chunking of a variable, and with a new chunking.
+    :param nc: NetCDF Dataset object
+    :param data_var: NetCDF Variable object
+    :param pattern: the access pattern as a string
+    :param new_chunks: optional - the new chunk sizes (chosen for the pattern if
+                       not given)
+    :return: dictionary with the current and new chunk sizes and chunk counts
+    """
+    if new_chunks is None:
+        new_chunks = choose_chunks(nc, data_var, pattern)
+    index = query_index(nc, data_var, pattern)
+    old_chunks = data_var.chunking()
+    return {'pattern': pattern,
+            'chunks_before': old_chunks,
+            'chunks_after': list(new_chunks),
+            'chunks_read_before': count_chunks(data_var.shape, old_chunks, index),
+            'chunks_read_after': count_chunks(data_var.shape, new_chunks, index)}
@@ -0,0 +1,367 @@
+""" Contains code for averaging fields over regions (ocean basins, countries, ...)
+    given as polygons of longitude/latitude vertices.
+
+    The polygons are rasterised once per grid into masks of the fraction of every
+    grid cell that they cover, by testing a number of sample points in each cell.
+    The masks are kept as sparse weights (the row, column and weight of every
+    cell touched), cached in memory and, if the result cache is enabled (see
+    cache.enable), on disk.  The weights are the covered fraction times the
+    area of the cell, which is proportional to cos(latitude) on a regular grid.
+
+    Means and sums are then computed for all regions and all time steps of a
+    block at once, with one gather and one cumulative sum per block.
+
+    Usage:
+        regions = OrderedDict([('north_atlantic', [(-80, 0), (0, 0), (0, 65), (-80, 65)]),
+                               ('indian', [(20, -40), (120, -40), (120, 25), (20, 25)])])
+        means, names, t_var = regions.aggregate_regions(nc, data_var, regions) """
+
+from collections import OrderedDict
+import hashlib
+import json
+import numpy as np
+import cache
+import extract
+import netcdf_utils as nu
+
+# Mean radius of the Earth in m
+EARTH_RADIUS = 6371000.
+# Number of sample points along each side of a grid cell when rasterising
+SUBDIVISIONS = 8
+# Default number of time steps read at once
+BLOCK_SIZE = 12
+# Largest number of sample points tested at once when rasterising
+MAX_SAMPLES = 2 ** 20
+# Number of sets of masks kept in memory
+MAX_CACHED = 16
+
+# Masks already built, by key (see _masks_key)
+_cached = OrderedDict()
+
+
+def _cell_edges(vals, lower=None, upper=None):
+    """
+    Returns the edges of the grid cells around coordinate values: half way
+    between neighbours, and half a step beyond the first and last values.
+    """
+    vals = np.asarray(vals, dtype=np.float64)
+    if len(vals) < 2:
+        return np.array([vals[0] - 0.5, vals[0] + 0.5])
+    middle = 0.5 * (vals[1:] + vals[:-1])
+    edges = np.concatenate([[2 * vals[0] - middle[0]], middle, [2 * vals[-1] - middle[-1]]])
+    if lower is not None:
+        edges = np.clip(edges, lower, upper)
+    return edges
+
+
+def points_in_polygon(x, y, poly_x, poly_y):
+    """
+    Tests which points lie inside a polygon, by the even-odd rule (counting the
+    edges crossed by a ray from each point).
+    :param x: array of the x coordinates (longitudes) of the points
+    :param y: array of the y coordinates (latitudes) of the points (x and y are
+              broadcast against each other)
+    :param poly_x: array of the x coordinates of the vertices of the polygon
+    :param poly_y: array of the y coordinates of the vertices of the polygon
+    :return: boolean array, True for the points inside
+    """
+    x, y = np.broadcast_arrays(x, y)
+    inside = np.zeros(x.shape, dtype=bool)
+    n = len(poly_x)
+    for i in range(n):
+        x1, y1 = poly_x[i], poly_y[i]
+        x2, y2 = poly_x[(i + 1) % n], poly_y[(i + 1) % n]
+        if y1 == y2:
+            # Horizontal edges are never crossed by a horizontal ray
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def coverage(polygon, lon_vals, lat_vals, subdivisions=SUBDIVISIONS):
+    """
+    Works out the fraction of every grid cell covered by a polygon.  Only the
+    cells overlapping the bounding box of the polygon are tested.  Longitudes of
+    the polygon must be continuous (e.g. 160 to 200 rather than 160 to -160 for a
+    region crossing the date line); the grid may use either convention.
+    :param polygon: sequence of (lon, lat) vertices in degrees
+    :param lon_vals: 1D array of the longitudes of the grid
+    :param lat_vals: 1D array of the latitudes of the grid
+    :param subdivisions: optional - the number of sample points along each side
+                         of a cell
+    :raise ValueError: if the polygon has fewer than 3 vertices
+    :return: arrays of the row indices, column indices and covered fractions of
+             the cells touched by the polygon
+    """
+    polygon = np.asarray(polygon, dtype=np.float64)
+    if polygon.ndim != 2 or polygon.shape[0] < 3:
+        raise ValueError("A polygon needs at least 3 (lon, lat) vertices")
+    poly_x, poly_y = polygon[:, 0], polygon[:, 1]
+    lon_edges = _cell_edges(lon_vals)
+    lat_edges = _cell_edges(lat_vals, -90., 90.)
+    south = np.minimum(lat_edges[:-1], lat_edges[1:])
+    north = np.maximum(lat_edges[:-1], lat_edges[1:])
+    rows = np.flatnonzero((north > poly_y.min()) & (south < poly_y.max()))
+
+    # Shift the cells into the longitude range of the polygon; a cell may also
+    # straddle the west edge of the polygon
+    west = np.minimum(lon_edges[:-1], lon_edges[1:])
+    width = np.abs(lon_edges[1:] - lon_edges[:-1])
+    x_min, x_max = poly_x.min(), poly_x.max()
+    west = x_min + np.mod(west - x_min, 360.)
+    west = np.where(west + width - 360. > x_min, west - 360., west)
+    cols = np.flatnonzero(west < x_max)
+    if len(rows) == 0 or len(cols) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([])
+
+    # Sample points at the centres of subdivisions x subdivisions sub-cells
+    steps = (np.arange(subdivisions) + 0.5) / subdivisions
+    sample_x = west[cols, None] + width[cols, None] * steps
+    sample_y = south[rows, None] + (north - south)[rows, None] * steps
+    inside_count = np.zeros((len(rows), len(cols)), dtype=np.int64)
+    band = max(1, MAX_SAMPLES // (len(cols) * subdivisions ** 2))
+    for first in range(0, len(rows), band):
+        y = sample_y[first:first + band, :, None, None]
+        x = sample_x[None, None, :, :]
+        inside = points_in_polygon(x, y, poly_x, poly_y)
+        inside_count[first:first + band] = inside.sum(axis=(1, 3))
+
+    hit_rows, hit_cols = np.nonzero(inside_count)
+    fractions = inside_count[hit_rows, hit_cols] / float(subdivisions ** 2)
+    return rows[hit_rows], cols[hit_cols], fractions
+
+
+def cell_areas(lon_vals, lat_vals):
+    """
+    Returns the areas of the cells of a regular longitude/latitude grid.
+    :param lon_vals: 1D array of the longitudes of the grid
+    :param lat_vals: 1D array of the latitudes of the grid
+    :return: (n_lat, n_lon) array of areas in m2
+    """
+    lon_edges = np.radians(_cell_edges(lon_vals))
+    lat_edges = np.radians(_cell_edges(lat_vals, -90., 90.))
+    width = np.abs(np.diff(lon_edges))
+    height = np.abs(np.diff(np.sin(lat_edges)))
+    return EARTH_RADIUS ** 2 * height[:, None] * width[None, :]
+
+
+class RegionMasks(object):
+    """
+    The sparse masks of several regions on one grid.  The cells of every region
+    are stored one region after another: region i has the cells
+    offsets[i]:offsets[i + 1] of rows, cols and weights.
+    :param names: list of the names of the regions
+    :param rows: array of the row (latitude) indices of the cells
+    :param cols: array of the column (longitude) indices of the cells
+    :param weights: array of the covered areas of the cells in m2
+    :param offsets: array of the position of the first cell of each region, and
+                    the total number of cells at the end
+    :param shape: the shape (n_lat, n_lon) of the grid
+    """
+
+    def __init__(self, names, rows, cols, weights, offsets, shape):
+        self.names = list(names)
+        self.rows = rows
+        self.cols = cols
+        self.weights = weights
+        self.offsets = offsets
+        self.shape = tuple(shape)
+
+    def window(self):
+        """
+        Returns the smallest part of the grid holding all the regions.
+        :return: the latitude and longitude slices of the window
+        """
+        if len(self.rows) == 0:
+            return slice(0, 0), slice(0, 0)
+        return (slice(int(self.rows.min()), int(self.rows.max()) + 1),
+                slice(int(self.cols.min()), int(self.cols.max()) + 1))
+
+    def areas(self):
+        """
+        Returns the areas of the regions covered by the grid.
+        :return: array of areas in m2, one per region
+        """
+        return self._segment_sums(self.weights[None, :])[0]
+
+    def _segment_sums(self, values):
+        """
+        Sums the values of the cells of every region, for every row of a 2D array
+        of (n_rows, n_cells) values.
+        """
+        totals = np.zeros((values.shape[0], values.shape[1] + 1))
+        np.cumsum(values, axis=1, out=totals[:, 1:])
+        # Regions without any cells have equal offsets and so a sum of zero
+        return totals[:, self.offsets[1:]] - totals[:, self.offsets[:-1]]
+
+    def aggregate(self, block, how='mean'):
+        """
+        Computes the area-weighted means or sums of a field over all the regions.
+        Missing values (masked or NaN) are left out; a region without any valid
+        value is masked.
+        :param block: array of the field, with latitude and longitude as the last
+                      two axes (e.g. a block of time steps), covering either the
+                      whole grid or just the window (see window)
+        :param how: optional - "mean" for area-weighted means, or "sum" for the
+                    integrals over the regions (in the units of the field times m2)
+        :raise ValueError: if the field does not match the grid, or how is unknown
+        :return: masked array with the leading axes of the block and one more
+                 axis for the regions
+        """
+        if how not in ('mean', 'sum'):
+            raise ValueError("Unknown aggregation %r; use 'mean' or 'sum'" % how)
+        rows, cols = self.rows, self.cols
+        if tuple(block.shape[-2:]) != self.shape:
+            lat_slice, lon_slice = self.window()
+            window_shape = (lat_slice.stop - lat_slice.start, lon_slice.stop - lon_slice.start)
+            if tuple(block.shape[-2:]) != window_shape:
+                raise ValueError("The field has shape %s, but the grid is %s and the "
+                                 "window of the regions %s"
+                                 % (block.shape[-2:], self.shape, window_shape))
+            rows = rows - lat_slice.start
+            cols = cols - lon_slice.start
+        lead = block.shape[:-2]
+        block = block.reshape((-1,) + tuple(block.shape[-2:]))
+        values = np.ma.getdata(block)[:, rows, cols].astype(np.float64)
+        valid = ~np.ma.getmaskarray(block)[:, rows, cols] & np.isfinite(values)
+        w = np.where(valid, self.weights, 0.)
+        sums = self._segment_sums(np.where(valid, values, 0.) * w)
+        totals = self._segment_sums(w)
+        if how == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                sums /= totals
+        result = np.ma.MaskedArray(sums, mask=totals <= 0)
+        return result.reshape(lead + (len(self.names),))
+
+
+def _as_parts(polygons):
+    """
+    Returns the polygons of a region as a list, for regions given as one polygon
+    or as a list of polygons (e.g. a country with islands).
+    """
+    first = polygons[0]
+    if np.ndim(first) == 1 and len(first) == 2 and np.isscalar(first[0]):
+        return [polygons]
+    return list(polygons)
+
+
+def _masks_key(regions, lon_vals, lat_vals, subdivisions):
+    """
+    Builds the key of a set of masks from the grid and the region definitions.
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(lon_vals, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(lat_vals, dtype=np.float64).tobytes())
+    description = [subdivisions, [[name, [np.asarray(p, dtype=np.float64).tolist()
+                                          for p in _as_parts(polygons)]]
+                                  for name, polygons in regions.items()]]
+    digest.update(json.dumps(description).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_masks(regions, lon_vals, lat_vals, subdivisions=SUBDIVISIONS):
+    """
+    Rasterises regions onto a grid, or returns the masks from the cache if the
+    same regions have been rasterised onto the same grid before.
+    :param regions: dictionary (preferably an OrderedDict) mapping region names to
+                    polygons, each a sequence of (lon, lat) vertices, or to lists
+                    of polygons
+    :param lon_vals: 1D array of the longitudes of the grid
+    :param lat_vals: 1D array of the latitudes of the grid
+    :param subdivisions: optional - the number of sample points along each side
+                         of a cell
+    :return: RegionMasks object
+    """
+    lon_vals = np.asarray(lon_vals, dtype=np.float64)
+    lat_vals = np.asarray(lat_vals, dtype=np.float64)
+    key = _masks_key(regions, lon_vals, lat_vals, subdivisions)
+    names = list(regions)
+    shape = (len(lat_vals), len(lon_vals))
+    if key in _cached:
+        _cached[key] = _cached.pop(key)
+        return _cached[key]
+    stored = cache.load(key, None) if cache.CACHE_DIR is not None else None
+    if stored is not None:
+        masks = RegionMasks(names, *(np.asarray(a) for a in stored), shape=shape)
+    else:
+        areas = cell_areas(lon_vals, lat_vals)
+        rows, cols, weights, offsets = [], [], [], [0]
+        for name in names:
+            # Overlapping parts of a region count once
+            covered = np.zeros(0)
+            flat = np.zeros(0, dtype=np.int64)
+            for part in _as_parts(regions[name]):
+                r, c, f = coverage(part, lon_vals, lat_vals, subdivisions)
+                flat = np.concatenate([flat, r * shape[1] + c])
+                covered = np.concatenate([covered, f])
+            flat, inverse = np.unique(flat, return_inverse=True)
+            covered = np.minimum(np.bincount(inverse.ravel(), covered, len(flat)), 1.)
+            r, c = flat // shape[1], flat % shape[1]
+            rows.append(r)
+            cols.append(c)
+            weights.append(covered * areas[r, c])
+            offsets.append(offsets[-1] + len(flat))
+        masks = RegionMasks(names, np.concatenate(rows).astype(np.int64),
+                            np.concatenate(cols).astype(np.int64),
+                            np.concatenate(weights), np.array(offsets), shape)
+        if cache.CACHE_DIR is not None:
+            cache.store(key, (masks.rows, masks.cols, masks.weights, masks.offsets))
+    _cached[key] = masks
+    while len(_cached) > MAX_CACHED:
+        _cached.popitem(last=False)
+    return masks
+
+
+def aggregate_regions(nc, data_var, regions, z_index=0, how='mean', block_size=BLOCK_SIZE,
+                      subdivisions=SUBDIVISIONS):
+    """
+    Computes the area-weighted means (or sums) of a variable over several regions
+    for every time step.  Only the part of the grid holding the regions is read,
+    block_size time steps at a time, and every block is reduced for all regions
+    at once.
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object with latitude and longitude axes
+                     (and optionally time and vertical axes)
+    :param regions: dictionary mapping region names to polygons (see build_masks)
+    :param z_index: optional - the desired index along the z-axis (if present)
+    :param how: optional - "mean" or "sum" (see RegionMasks.aggregate)
+    :param block_size: optional - the number of time steps read at once
+    :param subdivisions: optional - the number of sample points along each side
+                         of a cell when rasterising
+    :raise ValueError: if the variable does not have latitude and longitude axes
+    :return: (n_times, n_regions) array (or (n_regions,) without a time axis) of
+             the means, masked (or NaN, see extract.set_nan_fill) for regions
+             without data; the names of the regions; and the time variable (or None)
+    """
+    roles = nu.find_axis_roles(nc, data_var)
+    if None in roles or not set('yx') <= set(roles):
+        raise ValueError("Cannot aggregate a variable with axes %s over regions; need "
+                         "latitude and longitude axes"
+                         % ''.join(role or '-' for role in roles))
+    lon_vals = nu.find_longitude_var(nc, data_var)[:]
+    lat_vals = nu.find_latitude_var(nc, data_var)[:]
+    masks = build_masks(regions, lon_vals, lat_vals, subdivisions)
+    lat_slice, lon_slice = masks.window()
+    # Order of the axes of a block, to put them in the order t, y, x
+    present = [role for role in roles if role != 'z']
+    to_tyx = [present.index(role) for role in 'tyx' if role in present]
+
+    n_times = data_var.shape[roles.index('t')] if 't' in roles else 1
+    result = np.ma.masked_all((n_times, len(masks.names)))
+    if len(masks.rows):
+        for start in range(0, n_times, block_size):
+            stop = min(start + block_size, n_times)
+            index = tuple({'t': slice(start, stop), 'z': z_index, 'y': lat_slice,
+                           'x': lon_slice}[role] for role in roles)
+            block = extract.read(data_var, index).transpose(to_tyx)
+            result[start:stop] = masks.aggregate(block, how)
+    if 't' not in roles:
+        result = result[0]
+    dtype = extract.COMPUTE_DTYPE or np.result_type(data_var.dtype, np.float32)
+    result = result.astype(dtype)
+    if extract.NAN_FILL:
+        result = np.ma.filled(result, np.nan)
+    return result, masks.names, nu.find_time_var(nc, data_var)
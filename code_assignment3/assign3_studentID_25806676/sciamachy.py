@@ -1,5 +1,19 @@
 import numpy as np
-import matplotlib.pyplot as plt
+
+def read_sciamachy(filename):
+    """
+    This function reads a SCIAMACHY CSV file into a record array, with one
+    field per column (e.g. lon, lat, o3_du), named after the lower-cased
+    column headings.
+    :param filename: the name of the SCIAMACHY file
+    :return: the record array of measurements
+    """
+    if hasattr(np, 'recfromcsv'):
+        return np.recfromcsv(filename)
+    # np.recfromcsv was removed in numpy 2.0; this is what it did
+    return np.genfromtxt(filename, delimiter=',', names=True, dtype=None,
+                         case_sensitive='lower', encoding=None).view(np.recarray)
+
 
 def plot_sciamachy(filename):
     """
@@ -8,8 +22,11 @@ def plot_sciamachy(filename):
     :param filename: the name of the SCIAMACHY file
     :return: no return
     """
+    # matplotlib is only imported when a plot is made, so that reading the data
+    # does not load it
+    import matplotlib.pyplot as plt
     # Reading the data from the csv files
-    r = np.recfromcsv(filename)
+    r = read_sciamachy(filename)
     
     # Plotting the scatter plot
     plt.figure()
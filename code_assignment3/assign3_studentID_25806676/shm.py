@@ -0,0 +1,243 @@
+""" Contains code for handing large arrays (e.g. extracted slices) to worker
+    processes through shared memory instead of pickling them.  The producer puts
+    an array into a block of a SharedArrayPool and passes only its descriptor
+    (block name, shape, data type) to the workers, which attach to the block and
+    use the array without copying it.  Blocks are reused for later arrays once
+    they are released, and are all removed when the pool is closed.
+
+    Usage:
+        with shm.SharedArrayPool() as pool:
+            desc = pool.put(extract.extract_map_data(nc, data_var, 0, 0))
+            future = executor.submit(worker_function, desc)
+            ...
+            pool.release(desc)
+
+        def worker_function(desc):
+            data = shm.attach(desc)
+            ...
+
+    or, for the common case of applying one function to several arrays,
+        results = shm.fan_out(np.nanmean, arrays, workers=4) """
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import threading
+import numpy as np
+
+try:
+    # Python 3.8 or later
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# Description of an array in a shared memory block.  mask_offset is the position
+# of the mask of a masked array in the block, or None for a plain array.
+SharedArray = namedtuple('SharedArray', ['name', 'shape', 'dtype', 'mask_offset'])
+
+# Smallest block allocated, in bytes; larger blocks are rounded up to a power of
+# two so that they can be reused for arrays of similar size
+MIN_BLOCK_BYTES = 64 * 1024
+
+# Blocks attached in this process, by name
+_attached = {}
+_attached_lock = threading.Lock()
+
+
+def _block_size(nbytes):
+    """
+    Returns the size of the block to allocate for an array of nbytes.
+    """
+    size = MIN_BLOCK_BYTES
+    while size < nbytes:
+        size *= 2
+    return size
+
+
+class SharedArrayPool(object):
+    """
+    A pool of shared memory blocks, owned by the process that creates it.
+    :param max_free_bytes: optional - the total size of released blocks kept for
+                           reuse; blocks released beyond this are removed
+    """
+
+    def __init__(self, max_free_bytes=1024 ** 3):
+        if shared_memory is None:
+            raise RuntimeError("Shared memory needs Python 3.8 or later")
+        self.max_free_bytes = max_free_bytes
+        self._in_use = {}
+        self._free = []
+        self._lock = threading.Lock()
+
+    def _allocate(self, nbytes):
+        """
+        Returns a free block of at least nbytes, reusing a released one if possible.
+        """
+        size = _block_size(nbytes)
+        with self._lock:
+            for i, block in enumerate(self._free):
+                if block.size >= size:
+                    del self._free[i]
+                    self._in_use[block.name] = block
+                    return block
+        block = shared_memory.SharedMemory(create=True, size=size)
+        with self._lock:
+            self._in_use[block.name] = block
+        return block
+
+    def empty(self, shape, dtype, masked=False):
+        """
+        Allocates an array in shared memory, to be filled in by the caller (e.g. by
+        reading a slice straight into it).
+        :param shape: the shape of the array
+        :param dtype: the data type of the array
+        :param masked: optional - whether to allocate a mask as well
+        :return: the descriptor and the array (a masked array if masked is True)
+        """
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        # Keep the mask aligned to 8 bytes after the data
+        mask_offset = (nbytes + 7) // 8 * 8 if masked else None
+        total = nbytes + (int(np.prod(shape, dtype=np.int64)) if masked else 0) + 8
+        block = self._allocate(total)
+        desc = SharedArray(block.name, tuple(shape), dtype.str, mask_offset)
+        return desc, _view(block, desc)
+
+    def put(self, array):
+        """
+        Copies an array into shared memory.
+        :param array: a numpy array or masked array
+        :return: the descriptor of the shared copy
+        """
+        masked = np.ma.isMaskedArray(array)
+        desc, view = self.empty(np.shape(array), np.asarray(array).dtype, masked)
+        if masked:
+            view.data[...] = np.ma.getdata(array)
+            view.mask[...] = np.ma.getmaskarray(array)
+        else:
+            view[...] = array
+        return desc
+
+    def release(self, desc):
+        """
+        Returns the block of an array to the pool for reuse.  The array must not be
+        used by any process after this.
+        :param desc: the descriptor of the array
+        :return: no return
+        """
+        with self._lock:
+            block = self._in_use.pop(desc.name, None)
+            if block is None:
+                return
+            self._free.append(block)
+            self._free.sort(key=lambda b: b.size)
+            # Remove the largest free blocks beyond the limit
+            while self._free and sum(b.size for b in self._free) > self.max_free_bytes:
+                _destroy(self._free.pop())
+
+    def close(self):
+        """
+        Removes all the blocks of the pool.  Arrays in the blocks must not be used
+        by any process after this: the memory is unmapped, and numpy does not
+        prevent that while arrays still refer to it.
+        :return: no return
+        """
+        with self._lock:
+            blocks = list(self._in_use.values()) + self._free
+            self._in_use.clear()
+            self._free = []
+        for block in blocks:
+            _destroy(block)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _destroy(block):
+    """
+    Closes and removes a shared memory block.
+    """
+    with _attached_lock:
+        _attached.pop(block.name, None)
+    block.close()
+    try:
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _view(block, desc):
+    """
+    Returns the array described by a descriptor as a view of its block.
+    """
+    shape = tuple(desc.shape)
+    data = np.ndarray(shape, dtype=np.dtype(desc.dtype), buffer=block.buf)
+    if desc.mask_offset is None:
+        return data
+    mask = np.ndarray(shape, dtype=bool, buffer=block.buf, offset=desc.mask_offset)
+    return np.ma.MaskedArray(data, mask=mask, copy=False)
+
+
+def attach(desc):
+    """
+    Returns the array described by a descriptor, as a view of the shared memory
+    (no data are copied).  Blocks stay attached in the process for reuse.
+    :param desc: the descriptor of the array
+    :return: numpy array, or masked array if the shared array has a mask
+    """
+    with _attached_lock:
+        block = _attached.get(desc.name)
+        if block is None:
+            # Worker processes share the resource tracker of the process that
+            # created the pool, so the block is still removed only once
+            block = shared_memory.SharedMemory(name=desc.name)
+            _attached[desc.name] = block
+    return _view(block, desc)
+
+
+def detach_all():
+    """
+    Closes all blocks attached in this process (without removing them).  The
+    arrays returned by attach must not be used after this.
+    :return: no return
+    """
+    with _attached_lock:
+        blocks = list(_attached.values())
+        _attached.clear()
+    for block in blocks:
+        block.close()
+
+
+def _apply(func, desc):
+    """
+    Calls a function on a shared array in a worker process.
+    """
+    return func(attach(desc))
+
+
+def fan_out(func, arrays, workers=None, pool=None):
+    """
+    Applies a function to several arrays in parallel worker processes, passing
+    the arrays through shared memory.  The function must be defined at the top
+    level of a module so that it can be sent to the workers, and should return a
+    small result (e.g. a statistic), which is pickled back.
+    :param func: function taking one array
+    :param arrays: list of arrays (e.g. extracted slices)
+    :param workers: optional - the number of worker processes
+    :param pool: optional - a SharedArrayPool to take the blocks from
+    :return: list of the results of func, in the order of the arrays
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = SharedArrayPool()
+    descs = [pool.put(array) for array in arrays]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_apply, [func] * len(descs), descs))
+    finally:
+        for desc in descs:
+            pool.release(desc)
+        if own_pool:
+            pool.close()
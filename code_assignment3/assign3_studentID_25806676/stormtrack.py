@@ -0,0 +1,318 @@
+""" Contains code for loading and searching storm tracks stored in the
+    "multistorms" schema (see assign1/storm.cdl): flat time, lat, lon, vort and p
+    arrays along a single "time" dimension, with the tracks of successive storms
+    one after another.  A new storm starts after a row of fill values, or where
+    the time goes backwards.
+
+    The tracks are held as array columns with the offset of each storm's first
+    point, and are indexed for queries such as "all track points in this box
+    during this week" or "storms whose minimum pressure falls below X":
+      * points are grouped into lat/lon grid cells, sorted by time within each
+        cell, so a box query only looks at the cells the box covers and a binary
+        search of each cell's times;
+      * a sorted time index answers time range queries by binary search;
+      * the minimum pressure of every storm is computed once and sorted.
+
+    Tracks are written in the same schema with write_tracks. """
+
+import datetime
+import netCDF4
+import numpy as np
+import netcdf_utils as nu
+
+# Size in degrees of the grid cells of the spatial index
+CELL_SIZE = 5.
+
+# Variables of the multistorms schema
+TRACK_VARIABLES = ('time', 'lat', 'lon', 'vort', 'p')
+
+
+def split_storms(time, lat, lon):
+    """
+    Works out where the storms in flat track arrays start and end.  Rows where
+    time, lat and lon are all missing separate storms and are dropped; a time
+    earlier than the one before also starts a new storm.
+    :param time: array of times, with NaN for missing values
+    :param lat: array of latitudes, with NaN for missing values
+    :param lon: array of longitudes, with NaN for missing values
+    :return: boolean array of the rows to keep, and integer array of the offsets
+             of the storms in the kept rows (with the number of kept rows last)
+    """
+    separator = np.isnan(time) & np.isnan(lat) & np.isnan(lon)
+    keep = ~separator
+    kept_time = time[keep]
+    # A storm starts at the first row, after a separator, or where time goes back
+    after_separator = np.concatenate([[True], separator[:-1]])[keep]
+    goes_back = np.concatenate([[False], np.diff(kept_time) < 0])
+    starts = np.flatnonzero(after_separator | goes_back)
+    offsets = np.concatenate([starts, [len(kept_time)]]).astype(np.int64)
+    return keep, offsets
+
+
+class TrackStore(object):
+    """
+    Storm tracks held as array columns, with a space-time index.
+    :param columns: dictionary of 1D arrays ("time", "lat", "lon", "vort", "p"),
+                    all storms one after another
+    :param offsets: integer array of the index of each storm's first point, with
+                    the total number of points last
+    :param time_units: optional - the CF units of the times, for queries by date
+    :param calendar: optional - the CF calendar of the times
+    :param cell_size: optional - the size in degrees of the spatial index cells
+    """
+
+    def __init__(self, columns, offsets, time_units=None, calendar='standard',
+                 cell_size=CELL_SIZE):
+        self.columns = dict((name, np.asarray(values)) for name, values in columns.items())
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.time_units = time_units
+        self.calendar = calendar
+        self.cell_size = float(cell_size)
+        self._build_index()
+
+    def _build_index(self):
+        """
+        Builds the spatial, time and pressure indexes.
+        """
+        time = self.columns['time']
+        lat = self.columns['lat']
+        lon = np.mod(self.columns['lon'], 360.)
+        self.n_lat_cells = int(np.ceil(180. / self.cell_size))
+        self.n_lon_cells = int(np.ceil(360. / self.cell_size))
+        n_cells = self.n_lat_cells * self.n_lon_cells
+
+        # Grid cell of every point; points without a position go in an extra cell
+        # that box queries never look at
+        with np.errstate(invalid='ignore'):
+            lat_cell = np.clip((lat + 90.) // self.cell_size, 0, self.n_lat_cells - 1)
+            lon_cell = np.clip(lon // self.cell_size, 0, self.n_lon_cells - 1)
+        cell = lat_cell * self.n_lon_cells + lon_cell
+        cell[np.isnan(cell)] = n_cells
+        cell = cell.astype(np.int64)
+
+        # Points sorted by cell, then by time within each cell
+        self._cell_order = np.lexsort((time, cell))
+        self._cell_times = time[self._cell_order]
+        self._cell_starts = np.searchsorted(cell[self._cell_order], np.arange(n_cells + 2))
+
+        # Points sorted by time
+        self._time_order = np.argsort(time, kind='mergesort')
+        self._sorted_times = time[self._time_order]
+
+        # Minimum pressure of each storm, ignoring missing values
+        p = self.columns.get('p')
+        if p is not None and len(p):
+            with np.errstate(invalid='ignore'):
+                self.min_pressure = np.fmin.reduceat(p, self.offsets[:-1])
+        else:
+            self.min_pressure = np.full(len(self), np.nan)
+        self._pressure_order = np.argsort(self.min_pressure, kind='mergesort')
+        self._sorted_pressure = self.min_pressure[self._pressure_order]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def n_points(self):
+        return int(self.offsets[-1])
+
+    def storm(self, storm_id):
+        """
+        Returns the track of one storm.
+        :param storm_id: the number of the storm (0 for the first in the file)
+        :return: dictionary of the storm's arrays, by variable name
+        """
+        first, last = self.offsets[storm_id], self.offsets[storm_id + 1]
+        return dict((name, values[first:last]) for name, values in self.columns.items())
+
+    def storm_ids(self, points):
+        """
+        Returns the storm that each of the given points belongs to.
+        :param points: integer array of point indices
+        :return: integer array of storm numbers
+        """
+        return np.searchsorted(self.offsets, points, side='right') - 1
+
+    def to_time_value(self, time):
+        """
+        Converts a query time to the units of the stored times.
+        :param time: a number in the stored units, or a datetime.datetime or
+                     datetime.date object
+        :return: the time as a number
+        """
+        if isinstance(time, datetime.date):
+            if not isinstance(time, datetime.datetime):
+                time = datetime.datetime(time.year, time.month, time.day)
+            if self.time_units is None:
+                raise ValueError("The tracks have no time units, so dates cannot be used")
+            return float(netCDF4.date2num(time, self.time_units, self.calendar))
+        return float(time)
+
+    def _time_bounds(self, start, end):
+        """
+        Returns the time range of a query as numbers, open ends being infinite.
+        """
+        start = -np.inf if start is None else self.to_time_value(start)
+        end = np.inf if end is None else self.to_time_value(end)
+        return start, end
+
+    def points_in_period(self, start=None, end=None):
+        """
+        Finds the track points in a time range.
+        :param start: optional - the start of the range (number or date), inclusive
+        :param end: optional - the end of the range (number or date), inclusive
+        :return: sorted integer array of point indices
+        """
+        start, end = self._time_bounds(start, end)
+        first = np.searchsorted(self._sorted_times, start, side='left')
+        last = np.searchsorted(self._sorted_times, end, side='right')
+        return np.sort(self._time_order[first:last])
+
+    def _lon_cells(self, lon_min, lon_max):
+        """
+        Returns the longitude cells covered by a longitude range, which may cross
+        the 0/360 meridian.
+        """
+        if lon_max - lon_min >= 360.:
+            return np.arange(self.n_lon_cells)
+        first = int((lon_min % 360.) // self.cell_size)
+        last = int((lon_max % 360.) // self.cell_size)
+        if first <= last:
+            return np.arange(first, last + 1)
+        return np.concatenate([np.arange(first, self.n_lon_cells), np.arange(0, last + 1)])
+
+    def points_in_box(self, lat_min, lat_max, lon_min, lon_max, start=None, end=None):
+        """
+        Finds the track points in a latitude/longitude box, optionally during a time
+        range.  A box with lon_min > lon_max crosses the 180 (or 0) meridian, e.g.
+        lon_min=170, lon_max=-170.
+        :param lat_min: the southern edge of the box in degrees
+        :param lat_max: the northern edge of the box in degrees
+        :param lon_min: the western edge of the box in degrees
+        :param lon_max: the eastern edge of the box in degrees
+        :param start: optional - the start of the time range (number or date)
+        :param end: optional - the end of the time range (number or date)
+        :return: sorted integer array of point indices
+        """
+        t_start, t_end = self._time_bounds(start, end)
+        lat_first = int(np.clip((lat_min + 90.) // self.cell_size, 0, self.n_lat_cells - 1))
+        lat_last = int(np.clip((lat_max + 90.) // self.cell_size, 0, self.n_lat_cells - 1))
+        lon_cells = self._lon_cells(lon_min, lon_max)
+
+        pieces = []
+        for lat_cell in range(lat_first, lat_last + 1):
+            for cell in lat_cell * self.n_lon_cells + lon_cells:
+                first, last = self._cell_starts[cell], self._cell_starts[cell + 1]
+                if first == last:
+                    continue
+                # Binary search of the times within the cell
+                times = self._cell_times[first:last]
+                lo = first + np.searchsorted(times, t_start, side='left')
+                hi = first + np.searchsorted(times, t_end, side='right')
+                if lo < hi:
+                    pieces.append(self._cell_order[lo:hi])
+        if not pieces:
+            return np.zeros(0, dtype=np.int64)
+        points = np.concatenate(pieces)
+
+        # The cells on the edges of the box are only partly inside it
+        lat = self.columns['lat'][points]
+        lon = self.columns['lon'][points]
+        width = 360. if lon_max - lon_min >= 360. else (lon_max - lon_min) % 360.
+        inside = (lat >= lat_min) & (lat <= lat_max) & ((lon - lon_min) % 360. <= width)
+        return np.sort(points[inside])
+
+    def storms_in_box(self, lat_min, lat_max, lon_min, lon_max, start=None, end=None):
+        """
+        Finds the storms with at least one track point in a box (and time range).
+        Takes the same arguments as points_in_box.
+        :return: sorted integer array of storm numbers
+        """
+        points = self.points_in_box(lat_min, lat_max, lon_min, lon_max, start, end)
+        return np.unique(self.storm_ids(points))
+
+    def storms_below_pressure(self, threshold):
+        """
+        Finds the storms whose minimum pressure falls below a threshold.
+        :param threshold: the pressure, in the units of the "p" variable (Pa)
+        :return: sorted integer array of storm numbers
+        """
+        n = np.searchsorted(self._sorted_pressure, threshold, side='left')
+        return np.sort(self._pressure_order[:n])
+
+
+def load_tracks(filename, cell_size=CELL_SIZE):
+    """
+    Loads the storm tracks from a file in the multistorms schema.  Missing values
+    become NaN.
+    :param filename: location of the NetCDF file
+    :param cell_size: optional - the size in degrees of the spatial index cells
+    :raise ValueError: if the file does not have the time, lat and lon variables
+    :return: TrackStore object
+    """
+    nc = nu.open_dataset(filename)
+    try:
+        missing = [name for name in ('time', 'lat', 'lon') if name not in nc.variables]
+        if missing:
+            raise ValueError("%s is not a storm track file: no %s variable"
+                             % (filename, ', '.join(missing)))
+        raw = {}
+        for name in TRACK_VARIABLES:
+            if name in nc.variables:
+                # Times are kept in double precision, the rest as stored
+                dtype = np.float64 if name == 'time' else None
+                raw[name] = nu.read_plain(nc.variables[name], (slice(None),), dtype)
+        time_var = nc.variables['time']
+        time_units = nu.get_attribute(time_var, 'units')
+        calendar = nu.get_attribute(time_var, 'calendar', 'standard')
+    finally:
+        nc.close()
+
+    keep, offsets = split_storms(raw['time'], raw['lat'], raw['lon'])
+    columns = dict((name, values[keep]) for name, values in raw.items())
+    return TrackStore(columns, offsets, time_units, calendar, cell_size)
+
+
+def write_tracks(filename, tracks, time_units='seconds since 1970-01-01 0:0:0',
+                 data_manager=None, fill_value=-999.):
+    """
+    Writes storm tracks to a new file in the multistorms schema.  The storms are
+    written one after another, separated by a row of fill values.
+    :param filename: location of the new NetCDF file
+    :param tracks: list of dictionaries of 1D arrays, one per storm, with the keys
+                   "time" (in time_units), "lat", "lon", "vort" and "p" (the last
+                   two may be missing)
+    :param time_units: optional - the CF units of the times
+    :param data_manager: optional - the value of the data_manager global attribute
+    :param fill_value: optional - the fill value of all variables
+    :return: no return
+    """
+    n_rows = sum(len(track['time']) for track in tracks) + max(len(tracks) - 1, 0)
+    rows = dict((name, np.full(n_rows, fill_value, dtype=np.float32))
+                for name in TRACK_VARIABLES)
+    row = 0
+    for track in tracks:
+        n = len(track['time'])
+        for name in TRACK_VARIABLES:
+            if name in track:
+                rows[name][row:row + n] = np.ma.filled(np.ma.masked_invalid(track[name]),
+                                                       fill_value)
+        # Leave one row of fill values between storms
+        row += n + 1
+
+    attributes = {'time': {'units': time_units, 'standard_name': 'time'},
+                  'lat': {'units': 'degrees_north', 'standard_name': 'latitude'},
+                  'lon': {'units': 'degrees_east', 'standard_name': 'longitude'},
+                  'vort': {'units': 's-1', 'standard_name': 'atmosphere_absolute_vorticity'},
+                  'p': {'units': 'Pa', 'standard_name': 'air_pressure'}}
+    nc = netCDF4.Dataset(filename, 'w')
+    try:
+        nc.createDimension('time', n_rows)
+        for name in TRACK_VARIABLES:
+            var = nc.createVariable(name, 'f4', ('time',), fill_value=fill_value)
+            var.setncatts(attributes[name])
+            var[:] = rows[name]
+        if data_manager is not None:
+            nc.data_manager = data_manager
+    finally:
+        nc.close()
@@ -0,0 +1,224 @@
+""" Contains code for exporting a subset of a NetCDF file (a region, a period and
+    a range of levels of some of its variables) to a new compressed NetCDF-4 file,
+    so that colleagues can be given just the part of a large file they need.
+
+    The selection is made by coordinate values, as in the extract functions.  The
+    data are copied block by block (see rechunk.iter_blocks), as raw packed values
+    without masking or unpacking, so at most max_bytes of data are held in memory
+    whatever the size of the subset.
+
+    Usage:
+        subset.write_subset('ostia.nc', ['analysed_sst', 'sea_ice_fraction'],
+                            'north_sea.nc', lon_range=(-5, 10), lat_range=(50, 62),
+                            time_range=(datetime(2010, 1, 1), datetime(2010, 2, 1))) """
+
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import netCDF4
+import numpy as np
+import netcdf_utils as nu
+import rechunk
+
+
+def _value_range(vals, value_range, period=None):
+    """
+    Returns the indices of the coordinate values within a range, in the order of
+    the output.  On a cyclic axis the values are taken from the start of the
+    range round to its end, so a range may cross the end of the axis (e.g. 170 to
+    190 on an axis from -180 to 180, or 340 to 20 on an axis from 0 to 360).
+    :return: index array, and the coordinate values shifted to be continuous (or
+             None if they need no change)
+    """
+    vals = np.asarray(vals, dtype=np.float64)
+    if period is None:
+        low, high = min(value_range), max(value_range)
+        return np.flatnonzero((vals >= low) & (vals <= high)), None
+    # Cyclic ranges go from west to east, whichever number is larger
+    low, high = value_range
+    if high < low:
+        high += period
+    shifted = low + np.mod(vals - low, period)
+    chosen = np.flatnonzero(shifted <= high)
+    chosen = chosen[np.argsort(shifted[chosen], kind='mergesort')]
+    if np.array_equal(shifted[chosen], vals[chosen]):
+        return chosen, None
+    return chosen, shifted[chosen]
+
+
+def select(nc, data_var, lon_range=None, lat_range=None, time_range=None, z_range=None):
+    """
+    Works out which part of every dimension of a variable is in a subset.
+    Dimensions without a range are taken whole.
+    :param nc: a NetCDF Dataset object
+    :param data_var: a NetCDF Variable object
+    :param lon_range: optional - (west, east) longitudes in degrees
+    :param lat_range: optional - (south, north) latitudes in degrees
+    :param time_range: optional - (start, end) times, as dates or as numbers in the
+                       units of the time variable
+    :param z_range: optional - (low, high) values of the vertical coordinate
+    :raise ValueError: if a range holds no coordinate values
+    :return: dictionary mapping dimension names to (index array, new coordinate
+             values or None) pairs
+    """
+    ranges = {'x': lon_range, 'y': lat_range, 't': time_range, 'z': z_range}
+    selection = {}
+    for dim, role in zip(data_var.dimensions, nu.find_axis_roles(nc, data_var)):
+        value_range = ranges.get(role)
+        if value_range is None:
+            selection[dim] = (np.arange(len(nc.dimensions[dim])), None)
+            continue
+        vals = nc.variables[dim][:]
+        if role == 't' and not np.asarray(value_range).dtype.kind in 'iuf':
+            value_range = netCDF4.date2num(list(value_range), nc.variables[dim].units,
+                                           nu.get_attribute(nc.variables[dim], 'calendar',
+                                                            'standard'))
+        indices, new_vals = _value_range(vals, value_range, 360. if role == 'x' else None)
+        if len(indices) == 0:
+            raise ValueError("No %s values of %s are within %s"
+                             % (dim, data_var._name, tuple(value_range)))
+        selection[dim] = (indices, new_vals)
+    return selection
+
+
+def _runs(indices):
+    """
+    Splits an index array into runs of consecutive indices.
+    :return: list of (input slice, output slice) pairs
+    """
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(indices)]])
+    return [(slice(int(indices[a]), int(indices[b - 1]) + 1), slice(int(a), int(b)))
+            for a, b in zip(starts, stops)]
+
+
+def _read_raw(data_var, index):
+    """
+    Reads part of a variable as stored in the file: without masking fill values
+    or unpacking scale_factor/add_offset.
+    """
+    if hasattr(data_var, 'raw'):
+        # classic.ClassicVariable: a view of the file, in its byte order
+        return np.asarray(data_var.raw()[index], dtype=data_var.dtype)
+    data_var.set_auto_maskandscale(False)
+    return data_var[index]
+
+
+def _copy_variable(filename, varname, out_var, selection, chunks, max_bytes):
+    """
+    Copies the selected part of a variable into an output variable, block by
+    block.  The input file is opened again, so that every thread has its own
+    handle; writes to the output file take turns (see netcdf_utils.NETCDF_LOCK).
+    """
+    file_lock = nu.thread_lock(filename)
+    with file_lock:
+        nc = nu.open_dataset(filename)
+    try:
+        data_var = nc.variables[varname]
+        runs = [_runs(selection[dim][0]) for dim in data_var.dimensions]
+        # Each combination of runs is a box of the variable copied to a box of
+        # the output (there is more than one only for longitudes crossing the end
+        # of a cyclic axis)
+        for box in itertools.product(*runs):
+            shape = [o.stop - o.start for i, o in box]
+            for block in rechunk.iter_blocks(shape, chunks, data_var.dtype.itemsize, max_bytes):
+                in_index = tuple(slice(i.start + b.start, i.start + b.stop)
+                                 for (i, o), b in zip(box, block))
+                out_index = tuple(slice(o.start + b.start, o.start + b.stop)
+                                  for (i, o), b in zip(box, block))
+                with file_lock:
+                    data = _read_raw(data_var, in_index)
+                with nu.NETCDF_LOCK:
+                    out_var[out_index] = data
+    finally:
+        with file_lock:
+            nc.close()
+
+
+def write_subset(filename, varnames, out_filename, lon_range=None, lat_range=None,
+                 time_range=None, z_range=None, complevel=4, shuffle=True, chunks=None,
+                 max_bytes=rechunk.MEMORY_LIMIT, workers=1):
+    """
+    Writes a subset of one or more variables, with their coordinate variables and
+    all attributes, to a new NetCDF-4 file.  The output is chunked for reading
+    maps (see rechunk.choose_chunks) and compressed with deflate.  Variables must
+    agree on the dimensions they share.
+    With workers > 1, the variables are copied by several threads at once.  The
+    HDF5 library is not thread-safe, so writes (and reads of NetCDF-4 input files)
+    take turns; reading NetCDF-3 input files runs in parallel with
+    them.
+    :param filename: location of the input NetCDF file
+    :param varnames: list of the identifiers of the variables (or a single one)
+    :param out_filename: location of the new NetCDF file
+    :param lon_range: optional - (west, east) longitudes in degrees
+    :param lat_range: optional - (south, north) latitudes in degrees
+    :param time_range: optional - (start, end) times, as dates or numbers
+    :param z_range: optional - (low, high) values of the vertical coordinate
+    :param complevel: optional - the deflate level (0 switches compression off)
+    :param shuffle: optional - whether to apply the HDF5 shuffle filter
+    :param chunks: optional - dictionary mapping variable identifiers to explicit
+                   chunk sizes
+    :param max_bytes: optional - the maximum amount of data held in memory by
+                      each thread
+    :param workers: optional - the number of threads copying variables
+    :raise ValueError: if a range holds no coordinate values
+    :return: dictionary mapping the variable identifiers to their shapes in the
+             new file
+    """
+    if isinstance(varnames, str):
+        varnames = [varnames]
+    chunks = chunks or {}
+    nc = nu.open_dataset(filename)
+    try:
+        out = netCDF4.Dataset(out_filename, 'w', format='NETCDF4')
+        try:
+            nu.copy_attributes(nc, out)
+            jobs = []
+            shapes = {}
+            for varname in varnames:
+                data_var = nc.variables[varname]
+                selection = select(nc, data_var, lon_range, lat_range, time_range, z_range)
+                for dim in data_var.dimensions:
+                    indices, new_vals = selection[dim]
+                    coord_out = nu.copy_dimension(nc, out, dim, indices)
+                    if len(out.dimensions[dim]) != len(indices):
+                        raise ValueError("%s selects %d values of %s, but another "
+                                         "variable selected %d" % (varname, len(indices),
+                                                                   dim, len(out.dimensions[dim])))
+                    if coord_out is not None and new_vals is not None:
+                        coord_out[:] = new_vals
+                shape = [len(selection[dim][0]) for dim in data_var.dimensions]
+                shapes[varname] = tuple(shape)
+                var_chunks = chunks.get(varname)
+                if var_chunks is None:
+                    var_chunks = rechunk.choose_chunks(nc, data_var, 'map')
+                var_chunks = [max(1, min(c, n)) for c, n in zip(var_chunks, shape)]
+                out_var = out.createVariable(varname, data_var.dtype, data_var.dimensions,
+                                             zlib=complevel > 0, complevel=complevel,
+                                             shuffle=shuffle, chunksizes=var_chunks,
+                                             fill_value=nu.get_attribute(data_var, '_FillValue'))
+                nu.copy_attributes(data_var, out_var)
+                # The raw values are written, so the output must not pack them again
+                out_var.set_auto_maskandscale(False)
+                jobs.append((varname, out_var, selection, var_chunks))
+        except Exception:
+            out.close()
+            raise
+    finally:
+        nc.close()
+
+    try:
+        if workers <= 1 or len(jobs) <= 1:
+            for varname, out_var, selection, var_chunks in jobs:
+                _copy_variable(filename, varname, out_var, selection, var_chunks, max_bytes)
+        else:
+            with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+                futures = [pool.submit(_copy_variable, filename, varname, out_var,
+                                       selection, var_chunks, max_bytes)
+                           for varname, out_var, selection, var_chunks in jobs]
+                for future in futures:
+                    future.result()
+    finally:
+        with nu.NETCDF_LOCK:
+            out.close()
+    return shapes
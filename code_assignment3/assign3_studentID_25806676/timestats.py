@@ -0,0 +1,376 @@
+""" Contains code for computing statistics along the time axis of NetCDF variables
+    that are too large to be read into memory at once.  The data are read one block
+    of time steps at a time and reduced into "accumulators", which can be merged,
+    so that blocks can be processed by several worker processes in parallel. """
+
+from concurrent.futures import ProcessPoolExecutor
+import netCDF4
+import numpy as np
+import netcdf_utils as nu
+
+# Default number of time steps read at once
+BLOCK_SIZE = 12
+
+# Names of the statistics in CF cell_methods attributes
+CELL_METHODS = {'mean': 'mean', 'min': 'minimum', 'max': 'maximum', 'std': 'standard_deviation'}
+
+# Attributes describing how the source data are packed and which values are
+# valid; they do not apply to the unpacked float64 statistics
+PACKING_ATTRIBUTES = ('scale_factor', 'add_offset', 'valid_range', 'valid_min', 'valid_max',
+                      'missing_value')
+
+
+def new_accumulator(shape):
+    """
+    Creates an empty accumulator for statistics over a field of the given shape.
+    The accumulator holds the number of valid values, their mean, the sum of
+    squared deviations from the mean (for the standard deviation), the minimum
+    and the maximum for every point of the field.
+    :param shape: shape of one time step of the variable
+    :return: the accumulator as a dictionary of arrays
+    """
+    return {'count': np.zeros(shape, dtype=np.int64),
+            'mean': np.zeros(shape),
+            'm2': np.zeros(shape),
+            'min': np.full(shape, np.inf),
+            'max': np.full(shape, -np.inf)}
+
+
+def merge(acc, other):
+    """
+    Merges the statistics of the accumulator "other" into "acc".  The mean and the
+    sum of squared deviations are combined with the pairwise formulae of Chan et al.,
+    so the result is the same as if all values had been accumulated together.
+    :param acc: the accumulator to be updated
+    :param other: the accumulator to be merged in
+    :return: the updated accumulator acc
+    """
+    n_a = acc['count']
+    n_b = other['count']
+    n = n_a + n_b
+    # Avoid dividing by zero where neither accumulator has seen a valid value
+    safe_n = np.where(n > 0, n, 1)
+    delta = other['mean'] - acc['mean']
+    acc['mean'] += delta * n_b / safe_n
+    acc['m2'] += other['m2'] + delta ** 2 * n_a * n_b / safe_n
+    acc['count'] = n
+    np.minimum(acc['min'], other['min'], out=acc['min'])
+    np.maximum(acc['max'], other['max'], out=acc['max'])
+    return acc
+
+
+def accumulate(acc, block):
+    """
+    Adds a block of time steps to an accumulator.  Masked values and NaNs are ignored.
+    :param acc: the accumulator to be updated
+    :param block: array of data with time as the first axis
+    :return: the updated accumulator acc
+    """
+    values = np.ma.getdata(block).astype(np.float64)
+    valid = ~np.ma.getmaskarray(block) & ~np.isnan(values)
+    count = valid.sum(axis=0)
+    safe_count = np.where(count > 0, count, 1)
+    mean = np.where(valid, values, 0.).sum(axis=0) / safe_count
+    block_acc = {'count': count,
+                 'mean': mean,
+                 'm2': np.where(valid, (values - mean) ** 2, 0.).sum(axis=0),
+                 'min': np.where(valid, values, np.inf).min(axis=0),
+                 'max': np.where(valid, values, -np.inf).max(axis=0)}
+    return merge(acc, block_acc)
+
+
+def finalize(acc):
+    """
+    Converts an accumulator into the final statistics.  Points that have no valid
+    values at all are masked.
+    :param acc: the accumulator
+    :return: dictionary of masked arrays "mean", "min", "max", "std" and the
+             array "count" of valid values
+    """
+    empty = acc['count'] == 0
+    safe_count = np.where(empty, 1, acc['count'])
+    return {'count': acc['count'],
+            'mean': np.ma.masked_where(empty, acc['mean']),
+            'min': np.ma.masked_where(empty, acc['min']),
+            'max': np.ma.masked_where(empty, acc['max']),
+            'std': np.ma.masked_where(empty, np.sqrt(acc['m2'] / safe_count))}
+
+
+def _time_axis(nc, data_var):
+    """
+    Finds the position of the time dimension among the dimensions of a variable.
+    :param nc: NetCDF Dataset object
+    :param data_var: NetCDF Variable object
+    :raise ValueError: if the variable has no time axis
+    :return: the time coordinate variable and the index of its dimension
+    """
+    t_var = nu.find_time_var(nc, data_var)
+    if t_var is None:
+        raise ValueError("The data does not have time dimension")
+    return t_var, data_var.dimensions.index(t_var._name)
+
+
+def _read_block(data_var, t_axis, start, stop):
+    """
+    Reads the time steps start:stop of a variable, with time moved to the first axis.
+    :param data_var: NetCDF Variable object
+    :param t_axis: the index of the time dimension
+    :param start: the first time index of the block
+    :param stop: the time index after the last one of the block
+    :return: the block of data with time as the first axis
+    """
+    index = [slice(None)] * len(data_var.dimensions)
+    index[t_axis] = slice(start, stop)
+    return _move_axis(data_var[tuple(index)], t_axis, 0)
+
+
+def _move_axis(data, source, destination):
+    """
+    Moves an axis of a masked array, as np.moveaxis does for plain arrays (numpy
+    has no masked version).
+    :return: the masked array with the axis moved
+    """
+    data = np.ma.asarray(data)
+    if source == destination:
+        return data
+    return np.ma.MaskedArray(np.moveaxis(np.ma.getdata(data), source, destination),
+                             mask=np.moveaxis(np.ma.getmaskarray(data), source, destination),
+                             fill_value=data.fill_value)
+
+
+def _field_shape(data_var, t_axis):
+    """
+    Returns the shape of one time step of a variable.
+    """
+    return tuple(n for i, n in enumerate(data_var.shape) if i != t_axis)
+
+
+def _block_starts(n_times, block_size, workers):
+    """
+    Splits the time axis into blocks, and the blocks into one contiguous group
+    per worker.
+    :param n_times: the length of the time axis
+    :param block_size: the number of time steps per block
+    :param workers: the number of workers
+    :return: list of lists of block start indices
+    """
+    starts = list(range(0, n_times, block_size))
+    n_groups = max(1, min(workers, len(starts)))
+    return [list(group) for group in np.array_split(starts, n_groups) if len(group) > 0]
+
+
+def _reduce_blocks(filename, varname, starts, block_size, by_month):
+    """
+    Worker function: reduces the given blocks of a variable into accumulators.
+    Only one block of data is held in memory at a time.
+    :param filename: location of a NetCDF file as a string (in file system)
+    :param varname: the identifier of the variable
+    :param starts: list of the start indices of the blocks to be reduced
+    :param block_size: the number of time steps per block
+    :param by_month: if True, keep a separate accumulator for each calendar month
+    :return: a single accumulator, or a dictionary of accumulators keyed by month
+    """
+    nc = nu.open_dataset(filename)
+    try:
+        data_var = nc.variables[varname]
+        t_var, t_axis = _time_axis(nc, data_var)
+        shape = _field_shape(data_var, t_axis)
+        accs = {}
+        for start in starts:
+            stop = min(start + block_size, len(t_var))
+            block = _read_block(data_var, t_axis, start, stop)
+            if not by_month:
+                if None not in accs:
+                    accs[None] = new_accumulator(shape)
+                accumulate(accs[None], block)
+                continue
+            dates = netCDF4.num2date(t_var[start:stop], t_var.units,
+                                     nu.get_attribute(t_var, 'calendar', 'standard'))
+            months = np.array([d.month for d in dates])
+            for month in np.unique(months):
+                month = int(month)
+                if month not in accs:
+                    accs[month] = new_accumulator(shape)
+                accumulate(accs[month], block[months == month])
+        return accs if by_month else accs.get(None, new_accumulator(shape))
+    finally:
+        nc.close()
+
+
+def _run(filename, varname, block_size, workers, by_month):
+    """
+    Reduces a whole variable, using a pool of worker processes if workers > 1.
+    Each worker reads its own blocks through its own Dataset, so memory use is
+    bounded by one block (plus the accumulators) per worker.
+    """
+    nc = nu.open_dataset(filename)
+    try:
+        data_var = nc.variables[varname]
+        t_var, t_axis = _time_axis(nc, data_var)
+        n_times = len(t_var)
+    finally:
+        nc.close()
+    if n_times == 0:
+        raise ValueError("The time axis of %s is empty" % varname)
+    groups = _block_starts(n_times, block_size, workers)
+    if workers <= 1:
+        return [_reduce_blocks(filename, varname, g, block_size, by_month) for g in groups]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_reduce_blocks, filename, varname, g, block_size, by_month)
+                   for g in groups]
+        return [f.result() for f in futures]
+
+
+def time_statistics(filename, varname, block_size=BLOCK_SIZE, workers=1):
+    """
+    Computes the mean, minimum, maximum and standard deviation over the time
+    axis of a variable, without reading the whole variable into memory.
+    :param filename: location of a NetCDF file as a string (in file system)
+    :param varname: the identifier of the variable
+    :param block_size: optional - the number of time steps read at once
+    :param workers: optional - the number of worker processes
+    :raise ValueError: if the variable has no time axis, or it is empty
+    :return: dictionary of the statistics (see finalize)
+    """
+    partial = _run(filename, varname, block_size, workers, False)
+    acc = partial[0]
+    for other in partial[1:]:
+        merge(acc, other)
+    return finalize(acc)
+
+
+def monthly_climatology(filename, varname, block_size=BLOCK_SIZE, workers=1):
+    """
+    Computes the monthly climatology of a variable, i.e. the statistics over all
+    time steps falling in each calendar month, without reading the whole variable
+    into memory.
+    :param filename: location of a NetCDF file as a string (in file system)
+    :param varname: the identifier of the variable
+    :param block_size: optional - the number of time steps read at once
+    :param workers: optional - the number of worker processes
+    :raise ValueError: if the variable has no time axis, or it is empty
+    :return: dictionary of the statistics (see finalize), each with an extra
+             first axis of length 12 for the months January to December
+    """
+    partial = _run(filename, varname, block_size, workers, True)
+    accs = {}
+    for part in partial:
+        for month, acc in part.items():
+            if month in accs:
+                merge(accs[month], acc)
+            else:
+                accs[month] = acc
+
+    # Stack the months; months without any data are completely masked
+    shape = next(iter(accs.values()))['count'].shape if accs else ()
+    months = [finalize(accs.get(m, new_accumulator(shape))) for m in range(1, 13)]
+    return {'count': np.stack([m['count'] for m in months]),
+            'mean': np.ma.stack([m['mean'] for m in months]),
+            'min': np.ma.stack([m['min'] for m in months]),
+            'max': np.ma.stack([m['max'] for m in months]),
+            'std': np.ma.stack([m['std'] for m in months])}
+
+
+def _create_output(nc, data_var, t_axis, out_filename):
+    """
+    Creates an output file with the non-time dimensions and coordinates of a variable.
+    :return: the output Dataset and the names of the non-time dimensions
+    """
+    out = netCDF4.Dataset(out_filename, 'w')
+    nu.copy_attributes(nc, out)
+    dims = [d for i, d in enumerate(data_var.dimensions) if i != t_axis]
+    for dim in dims:
+        nu.copy_dimension(nc, out, dim)
+    return out, dims
+
+
+def write_statistics(filename, varname, out_filename, stats, climatology=None):
+    """
+    Writes time statistics (and optionally a monthly climatology) of a variable
+    to a new NetCDF file.  The statistics are stored as variables named e.g.
+    "ta_mean", with a CF cell_methods attribute describing them.
+    :param filename: location of the NetCDF file the statistics were computed from
+    :param varname: the identifier of the variable
+    :param out_filename: location of the new NetCDF file
+    :param stats: the result of time_statistics, or None
+    :param climatology: optional - the result of monthly_climatology
+    :return: no return
+    """
+    nc = nu.open_dataset(filename)
+    try:
+        data_var = nc.variables[varname]
+        t_axis = _time_axis(nc, data_var)[1]
+        out, dims = _create_output(nc, data_var, t_axis, out_filename)
+        try:
+            if climatology is not None:
+                out.createDimension('month', 12)
+                month_var = out.createVariable('month', 'i4', ('month',))
+                month_var.long_name = 'calendar month'
+                month_var[:] = np.arange(1, 13)
+            for results, prefix_dims, method in ((stats, (), 'time: %s'),
+                                                  (climatology, ('month',), 'time: %s within years')):
+                if results is None:
+                    continue
+                suffix = '_clim' if prefix_dims else ''
+                for stat in ('mean', 'min', 'max', 'std'):
+                    name = '%s_%s%s' % (varname, stat, suffix)
+                    out_var = out.createVariable(name, 'f8', prefix_dims + tuple(dims),
+                                                 fill_value=netCDF4.default_fillvals['f8'])
+                    nu.copy_attributes(data_var, out_var, skip=PACKING_ATTRIBUTES)
+                    out_var.cell_methods = method % CELL_METHODS[stat]
+                    out_var[:] = results[stat]
+        finally:
+            out.close()
+    finally:
+        nc.close()
+
+
+def write_anomalies(filename, varname, out_filename, climatology=None, block_size=BLOCK_SIZE):
+    """
+    Writes the anomalies of a variable from its monthly climatology mean to a new
+    NetCDF file.  The anomalies are computed and written one block of time steps
+    at a time.
+    :param filename: location of a NetCDF file as a string (in file system)
+    :param varname: the identifier of the variable
+    :param out_filename: location of the new NetCDF file
+    :param climatology: optional - the result of monthly_climatology (computed here
+                        if not given)
+    :param block_size: optional - the number of time steps read at once
+    :return: no return
+    """
+    if climatology is None:
+        climatology = monthly_climatology(filename, varname, block_size)
+    clim_mean = climatology['mean']
+
+    nc = nu.open_dataset(filename)
+    try:
+        data_var = nc.variables[varname]
+        t_var, t_axis = _time_axis(nc, data_var)
+        calendar = nu.get_attribute(t_var, 'calendar', 'standard')
+        out = netCDF4.Dataset(out_filename, 'w')
+        try:
+            nu.copy_attributes(nc, out)
+            for dim in data_var.dimensions:
+                nu.copy_dimension(nc, out, dim)
+            # The anomalies are unpacked values, so they are written as floats
+            # without the packing attributes of the source variable
+            dtype = np.result_type(data_var.dtype, np.float32)
+            out_var = out.createVariable(varname + '_anomaly', dtype, data_var.dimensions,
+                                         fill_value=netCDF4.default_fillvals[dtype.str[1:]])
+            nu.copy_attributes(data_var, out_var, skip=PACKING_ATTRIBUTES)
+            out_var.cell_methods = 'time: anomaly with respect to monthly climatology'
+
+            for start in range(0, len(t_var), block_size):
+                stop = min(start + block_size, len(t_var))
+                block = _read_block(data_var, t_axis, start, stop)
+                dates = netCDF4.num2date(t_var[start:stop], t_var.units, calendar)
+                months = np.array([d.month for d in dates])
+                anomaly = block - clim_mean[months - 1]
+                anomaly = _move_axis(anomaly, 0, t_axis)
+                index = [slice(None)] * len(data_var.dimensions)
+                index[t_axis] = slice(start, stop)
+                out_var[tuple(index)] = anomaly
+        finally:
+            out.close()
+    finally:
+        nc.close()
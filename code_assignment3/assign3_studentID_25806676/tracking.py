@@ -0,0 +1,230 @@
+""" Contains code for detecting and tracking storms in gridded vorticity fields,
+    producing track files in the multistorms schema (see stormtrack).
+
+    Tracking runs in two passes:
+      1. detection: on every time step, the local vorticity maxima above a
+         threshold are found with vectorised comparisons against all neighbours
+         within a radius.  Time steps are independent, so they are processed in
+         parallel worker processes, each reading its own maps;
+      2. linking: the detections are joined into tracks in time order, each track
+         continuing to the nearest detection of the next time step within a
+         maximum distance.  This pass is sequential but only handles points.
+
+    Usage:
+        tracks = tracking.track_storms(filename, 'vo', threshold=1e-4,
+                                       pressure_varname='msl', workers=4)
+        stormtrack.write_tracks('tracks.nc', tracks) """
+
+from concurrent.futures import ProcessPoolExecutor
+import netCDF4
+import numpy as np
+import extract
+import netcdf_utils as nu
+
+# Mean radius of the Earth in km
+EARTH_RADIUS = 6371.
+# Default largest distance in km a storm may move between two time steps
+MAX_DISTANCE = 500.
+# Default number of grid points either side within which a maximum must be largest
+RADIUS = 2
+# Default smallest number of time steps of a track that is kept
+MIN_LENGTH = 4
+
+
+def find_maxima(field, threshold, radius=RADIUS, wrap=False):
+    """
+    Finds the local maxima of a 2D field: the points that are at least the
+    threshold and not smaller than any other point within radius grid points in
+    both directions.  Missing values (masked or NaN) are never maxima.
+    :param field: 2D array (latitude, longitude)
+    :param threshold: the smallest value of a maximum
+    :param radius: optional - the size in grid points of the neighbourhood
+    :param wrap: optional - True if the longitudes go all the way round, so that
+                 the first and last columns are neighbours
+    :return: arrays of the row and column indices of the maxima
+    """
+    values = np.ma.filled(np.ma.masked_invalid(field).astype(np.float64), -np.inf)
+    n_rows, n_cols = values.shape
+    # Pad with -inf above and below, and with wrapped columns or -inf at the sides
+    padded = np.pad(values, ((radius, radius), (0, 0)), mode='constant',
+                    constant_values=-np.inf)
+    if wrap:
+        padded = np.pad(padded, ((0, 0), (radius, radius)), mode='wrap')
+    else:
+        padded = np.pad(padded, ((0, 0), (radius, radius)), mode='constant',
+                        constant_values=-np.inf)
+
+    is_max = values >= threshold
+    for di in range(-radius, radius + 1):
+        for dj in range(-radius, radius + 1):
+            if di == 0 and dj == 0:
+                continue
+            neighbour = padded[radius + di:radius + di + n_rows, radius + dj:radius + dj + n_cols]
+            is_max &= values >= neighbour
+    return np.nonzero(is_max)
+
+
+def _is_global(lon_vals):
+    """
+    Returns True if regularly spaced longitudes go all the way round.
+    """
+    lon_vals = np.asarray(lon_vals, dtype=np.float64)
+    if len(lon_vals) < 2:
+        return False
+    step = abs(lon_vals[1] - lon_vals[0])
+    return abs(abs(lon_vals[-1] - lon_vals[0]) + step - 360.) < 0.5 * step
+
+
+def detect_step(filename, varname, t_index, z_index=0, threshold=0., radius=RADIUS,
+                sign=1, pressure_varname=None):
+    """
+    Worker function: finds the storms on one time step of a vorticity variable.
+    :param filename: location of a NetCDF file as a string (in file system)
+    :param varname: the identifier of the vorticity variable
+    :param t_index: the index along the time axis
+    :param z_index: optional - the index along the vertical axis (if present)
+    :param threshold: optional - the smallest vorticity of a storm (after
+                      multiplying by sign)
+    :param radius: optional - the size in grid points of the neighbourhood
+    :param sign: optional - 1 to find maxima, -1 to find minima (e.g. cyclones in
+                 the southern hemisphere)
+    :param pressure_varname: optional - the identifier of a pressure variable on
+                             the same grid, sampled at the storm centres
+    :return: dictionary of arrays "lat", "lon", "vort" and "p" of the storms found
+    """
+    nc = nu.open_dataset(filename)
+    try:
+        data_var = nc.variables[varname]
+        lat_vals = np.asarray(nu.find_latitude_var(nc, data_var)[:], dtype=np.float64)
+        lon_vals = np.asarray(nu.find_longitude_var(nc, data_var)[:], dtype=np.float64)
+        field = extract.extract_map_data(nc, data_var, t_index, z_index)
+        rows, cols = find_maxima(sign * field, threshold, radius, _is_global(lon_vals))
+        found = {'lat': lat_vals[rows], 'lon': lon_vals[cols],
+                 'vort': np.ma.filled(np.ma.asarray(field, dtype=np.float64)[rows, cols], np.nan)}
+        if pressure_varname is not None:
+            pressure_var = nc.variables[pressure_varname]
+            pressure = extract.extract_map_data(nc, pressure_var, t_index, z_index)
+            found['p'] = np.ma.filled(np.ma.asarray(pressure, dtype=np.float64)[rows, cols],
+                                      np.nan)
+        else:
+            found['p'] = np.full(len(rows), np.nan)
+        return found
+    finally:
+        nc.close()
+
+
+def great_circle_distance(lat1, lon1, lat2, lon2):
+    """
+    Returns the great circle distances in km between points (with numpy
+    broadcasting, e.g. between every track end and every new detection).
+    :param lat1: latitudes of the first points in degrees
+    :param lon1: longitudes of the first points in degrees
+    :param lat2: latitudes of the second points in degrees
+    :param lon2: longitudes of the second points in degrees
+    :return: array of distances in km
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(a) for a in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2.) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2
+    return 2. * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0., 1.)))
+
+
+def link_tracks(times, detections, max_distance=MAX_DISTANCE, min_length=MIN_LENGTH):
+    """
+    Joins the storms found on successive time steps into tracks.  On every time
+    step, the pairs of (track end, new detection) are taken in order of distance,
+    closest first, so each track continues to its nearest free detection within
+    max_distance; detections left over start new tracks, and tracks left over end.
+    :param times: list of the times of the time steps
+    :param detections: list of dictionaries of arrays (see detect_step), one per
+                       time step
+    :param max_distance: optional - the largest distance in km a storm may move
+                         between two time steps
+    :param min_length: optional - the smallest number of time steps of a track
+    :return: list of tracks, each a dictionary of arrays "time", "lat", "lon",
+             "vort" and "p"
+    """
+    finished = []
+    # Each active track is a list of (time step, detection index) pairs
+    active = []
+    for step, found in enumerate(detections):
+        n_new = len(found['lat'])
+        continued = []
+        taken = np.zeros(n_new, dtype=bool)
+        if active and n_new:
+            ends = np.array([track[-1] for track in active])
+            end_lat = np.array([detections[s]['lat'][i] for s, i in ends])
+            end_lon = np.array([detections[s]['lon'][i] for s, i in ends])
+            distance = great_circle_distance(end_lat[:, None], end_lon[:, None],
+                                             found['lat'][None, :], found['lon'][None, :])
+            ended = np.zeros(len(active), dtype=bool)
+            for pair in np.argsort(distance, axis=None, kind='mergesort'):
+                t, d = np.unravel_index(pair, distance.shape)
+                if distance[t, d] > max_distance:
+                    break
+                if ended[t] or taken[d]:
+                    continue
+                ended[t] = taken[d] = True
+                active[t].append((step, d))
+                continued.append(active[t])
+            finished.extend(track for track, done in zip(active, ended) if not done)
+        else:
+            finished.extend(active)
+        active = continued + [[(step, d)] for d in np.flatnonzero(~taken)]
+    finished.extend(active)
+
+    tracks = []
+    for track in sorted(finished, key=lambda tr: tr[0]):
+        if len(track) < min_length:
+            continue
+        result = {'time': np.array([times[s] for s, i in track], dtype=np.float64)}
+        for name in ('lat', 'lon', 'vort', 'p'):
+            result[name] = np.array([detections[s][name][i] for s, i in track])
+        tracks.append(result)
+    return tracks
+
+
+def track_storms(filename, varname, threshold, z_index=0, radius=RADIUS, sign=1,
+                 pressure_varname=None, max_distance=MAX_DISTANCE, min_length=MIN_LENGTH,
+                 time_units='seconds since 1970-01-01 0:0:0', workers=1):
+    """
+    Detects and tracks the storms in a vorticity variable.  Time steps are
+    searched for storms in parallel (if workers > 1), then linked into tracks.
+    :param filename: location of a NetCDF file as a string (in file system)
+    :param varname: the identifier of the vorticity variable
+    :param threshold: the smallest vorticity of a storm (after multiplying by sign)
+    :param z_index: optional - the index along the vertical axis (if present)
+    :param radius: optional - the size in grid points of the neighbourhood in
+                   which a storm centre must be the largest value
+    :param sign: optional - 1 to find maxima, -1 to find minima
+    :param pressure_varname: optional - the identifier of a pressure variable on
+                             the same grid, sampled at the storm centres
+    :param max_distance: optional - the largest distance in km a storm may move
+                         between two time steps
+    :param min_length: optional - the smallest number of time steps of a track
+    :param time_units: optional - the CF units of the times of the tracks
+    :param workers: optional - the number of worker processes
+    :raise ValueError: if the variable has no time axis
+    :return: list of tracks, each a dictionary of arrays (see stormtrack.write_tracks)
+    """
+    nc = nu.open_dataset(filename)
+    try:
+        t_var = nu.find_time_var(nc, nc.variables[varname])
+        if t_var is None:
+            raise ValueError("The data does not have time dimension")
+        dates = netCDF4.num2date(t_var[:], t_var.units,
+                                 nu.get_attribute(t_var, 'calendar', 'standard'))
+        times = netCDF4.date2num(dates, time_units,
+                                 nu.get_attribute(t_var, 'calendar', 'standard'))
+    finally:
+        nc.close()
+
+    args = (z_index, threshold, radius, sign, pressure_varname)
+    if workers <= 1:
+        detections = [detect_step(filename, varname, t, *args) for t in range(len(times))]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(detect_step, filename, varname, t, *args)
+                       for t in range(len(times))]
+            detections = [f.result() for f in futures]
+    return link_tracks(list(times), detections, max_distance, min_length)
@@ -16,6 +16,44 @@ def find_nearest_index(vals, target):
     # find index of minimum
     return (np.abs(np.array(vals) - float(target))).argmin()
     
+def find_nearest_indices(vals, targets, period=None):
+    """
+    Vectorised version of find_nearest_index: for each value in targets, returns
+    the index of the value in vals that is closest to it.  The values are sorted
+    once and the targets looked up by binary search, so this is fast for many
+    targets.  If a period is given (e.g. 360 for longitudes), distances are
+    measured around the circle, so that 359 is close to 0.
+    :param vals: an array/list of values
+    :param targets: an array/list of values for which to search the array
+    :param period: optional - the period of cyclic values
+    :return: integer array of indices in vals, with the shape of targets
+    """
+    vals = np.asarray(vals, dtype=np.float64).ravel()
+    targets = np.asarray(targets, dtype=np.float64)
+    if period is not None:
+        vals = np.mod(vals, period)
+        targets = np.mod(targets, period)
+    n = len(vals)
+    order = np.argsort(vals, kind='mergesort')
+    sorted_vals = vals[order]
+
+    # The nearest value is one of the two sorted values either side of the target
+    right = np.searchsorted(sorted_vals, targets)
+    left = right - 1
+    if period is None:
+        left = np.clip(left, 0, n - 1)
+        right = np.clip(right, 0, n - 1)
+    else:
+        # Either side wraps round to the other end
+        left %= n
+        right %= n
+    d_left = np.abs(sorted_vals[left] - targets)
+    d_right = np.abs(sorted_vals[right] - targets)
+    if period is not None:
+        d_left = np.minimum(d_left, period - d_left)
+        d_right = np.minimum(d_right, period - d_right)
+    return order[np.where(d_left <= d_right, left, right)]
+
 # Test functions for find_nearest_index
 # Simply run this script to run the tests
 # Note that these tests are very basic.  A full set of tests would be much
@@ -24,14 +62,18 @@ if __name__ == '__main__':
     # create a set of values from 0 to 99 inclusive
     arr = range(0,100)
     ni = find_nearest_index(arr, -0.1)
-    print "ni = %s, should be 0" % ni
+    print("ni = %s, should be 0" % ni)
     ni = find_nearest_index(arr, 0.1)
-    print "ni = %s, should be 0" % ni
+    print("ni = %s, should be 0" % ni)
     ni = find_nearest_index(arr, 23.1)
-    print "ni = %s, should be 23" % ni
+    print("ni = %s, should be 23" % ni)
     ni = find_nearest_index(arr, 23.8)
-    print "ni = %s, should be 24" % ni
+    print("ni = %s, should be 24" % ni)
     ni = find_nearest_index(arr, 98.9)
-    print "ni = %s, should be 99" % ni
+    print("ni = %s, should be 99" % ni)
     ni = find_nearest_index(arr, 100)
-    print "ni = %s, should be 99" % ni
+    print("ni = %s, should be 99" % ni)
+    nis = find_nearest_indices(arr, [-0.1, 23.8, 100])
+    print("nis = %s, should be [0 24 99]" % nis)
+    nis = find_nearest_indices(np.arange(0, 360, 10), [359, -14, 184], 360)
+    print("nis = %s, should be [0 35 18]" % nis)
@@ -0,0 +1,320 @@
+""" Contains code for watching a landing directory for new model and satellite
+    files, and refreshing the artifacts derived from them as they arrive.  Only
+    new or changed files are processed; the rest of the archive is not rescanned.
+
+    For each NetCDF file the catalog entry is updated, and the axis descriptors
+    (axis roles and coordinate values) and decoded time indexes are written to the
+    artifact directory.  For each SCIAMACHY CSV file the observation columns are
+    cached as .npy files and, if a GlobModel file is given, the running statistics
+    of the SCIAMACHY - GlobModel ozone differences are updated.
+
+    Cached extraction results (see the cache module) do not need refreshing:
+    their keys include the file's size and modification time, so results for an
+    old version of a file are never used again and are evicted in time. """
+
+import hashlib
+import json
+import logging
+import os
+import time
+import netCDF4
+import numpy as np
+import catalog
+import globmodel
+import netcdf_utils as nu
+import sciamachy
+import timestats
+
+try:
+    # inotify is only available on Linux, and is optional: without it the
+    # landing directory is polled
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# Seconds a file must have been left unchanged before it is processed, so that
+# files still being copied into the landing directory are not read
+SETTLE_TIME = 5.
+# Name of the file recording the files already processed
+STATE_FILE = 'watcher_state.json'
+# Name of the file holding the combined ozone difference statistics
+VALIDATION_FILE = 'ozone_validation.json'
+
+CSV_EXTENSIONS = ('.csv',)
+
+logger = logging.getLogger(__name__)
+
+
+def artifact_path(artifact_dir, path, name):
+    """
+    Returns the location of one of the artifacts derived from a file.  Each
+    input file has its own subdirectory, named after a hash of its path, which
+    is created when its artifacts are written.
+    :param artifact_dir: the directory holding all artifacts
+    :param path: location of the input file
+    :param name: the name of the artifact
+    :return: location of the artifact
+    """
+    return os.path.join(_file_dir(artifact_dir, path), name)
+
+
+def _file_dir(artifact_dir, path):
+    """
+    Returns the subdirectory holding the artifacts derived from a file.
+    """
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(artifact_dir, digest)
+
+
+def _make_file_dir(artifact_dir, path):
+    """
+    Creates the subdirectory holding the artifacts derived from a file, before
+    they are written.
+    """
+    file_dir = _file_dir(artifact_dir, path)
+    if not os.path.isdir(file_dir):
+        os.makedirs(file_dir)
+
+
+def load_state(artifact_dir):
+    """
+    Loads the record of the files already processed.
+    :param artifact_dir: the directory holding all artifacts
+    :return: dictionary mapping file paths to [size, mtime]
+    """
+    try:
+        with open(os.path.join(artifact_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_state(artifact_dir, state):
+    """
+    Saves the record of the files already processed.
+    :param artifact_dir: the directory holding all artifacts
+    :param state: dictionary mapping file paths to [size, mtime]
+    :return: no return
+    """
+    path = os.path.join(artifact_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def poll(landing_dir, state, settle_time=SETTLE_TIME):
+    """
+    Lists the NetCDF and CSV files in the landing directory that are new or have
+    changed since they were last processed, and the files that have disappeared.
+    :param landing_dir: the directory to be watched
+    :param state: dictionary mapping file paths to [size, mtime] when processed
+    :param settle_time: optional - seconds a file must be unchanged before it is
+                        reported
+    :return: list of (path, os.stat result) of changed files, list of removed paths
+    """
+    now = time.time()
+    changed = []
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(landing_dir):
+        for filename in filenames:
+            if not filename.lower().endswith(catalog.NETCDF_EXTENSIONS + CSV_EXTENSIONS):
+                continue
+            path = os.path.abspath(os.path.join(dirpath, filename))
+            seen.add(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if state.get(path) == [st.st_size, st.st_mtime]:
+                continue
+            if now - st.st_mtime < settle_time:
+                # Still being written - pick it up on a later poll
+                continue
+            changed.append((path, st))
+    removed = [path for path in state if path not in seen]
+    return changed, removed
+
+
+def refresh_netcdf(path, artifact_dir, conn=None):
+    """
+    Refreshes the artifacts derived from a NetCDF file: the catalog entry, the
+    axis descriptors and the decoded time indexes.
+    :param path: location of the NetCDF file
+    :param artifact_dir: the directory holding all artifacts
+    :param conn: optional - catalog Connection object
+    :return: no return
+    """
+    if conn is not None:
+        catalog.update_file(conn, path)
+    nc = nu.open_dataset(path)
+    try:
+        _make_file_dir(artifact_dir, path)
+        axes = {}
+        written = set()
+        for name, var in nc.variables.items():
+            if name in var.dimensions:
+                continue
+            roles = nu.find_axis_roles(nc, var)
+            axes[name] = {'dimensions': list(var.dimensions), 'axes': roles}
+            for role, dim in zip(roles, var.dimensions):
+                if role is None or dim in written:
+                    continue
+                # Coordinates shared by several variables are written once
+                written.add(dim)
+                coord_var = nc.variables[dim]
+                np.save(artifact_path(artifact_dir, path, 'coords_%s.npy' % dim),
+                        np.ma.filled(np.ma.asarray(coord_var[:], dtype=float), np.nan))
+                if role == 't':
+                    # Decoded times, as ISO strings so that any calendar works
+                    dates = netCDF4.num2date(coord_var[:], coord_var.units,
+                                             nu.get_attribute(coord_var, 'calendar', 'standard'))
+                    np.save(artifact_path(artifact_dir, path, 'times_%s.npy' % dim),
+                            np.array([catalog.format_time(d) for d in dates]))
+        with open(artifact_path(artifact_dir, path, 'axes.json'), 'w') as f:
+            json.dump(axes, f, indent=1)
+    finally:
+        nc.close()
+
+
+def refresh_observations(path, artifact_dir, globmodel_file=None):
+    """
+    Refreshes the artifacts derived from a SCIAMACHY CSV file: one .npy file per
+    column, and (if a GlobModel file is given) the statistics of the
+    differences between the SCIAMACHY and GlobModel ozone columns.
+    :param path: location of the CSV file
+    :param artifact_dir: the directory holding all artifacts
+    :param globmodel_file: optional - the name of the NetCDF file containing
+                           GlobModel data
+    :return: no return
+    """
+    r = sciamachy.read_sciamachy(path)
+    _make_file_dir(artifact_dir, path)
+    for column in r.dtype.names:
+        np.save(artifact_path(artifact_dir, path, 'column_%s.npy' % column), r[column])
+    if globmodel_file is None:
+        return
+    ozone_diff = r.o3_du - globmodel.read_globmodel(globmodel_file, r.lon, r.lat)
+    acc = timestats.accumulate(timestats.new_accumulator(()), np.ma.masked_invalid(ozone_diff))
+    with open(artifact_path(artifact_dir, path, 'ozone_diff_stats.json'), 'w') as f:
+        json.dump(dict((k, float(v)) for k, v in acc.items()), f)
+
+
+def update_validation(artifact_dir, state):
+    """
+    Combines the ozone difference statistics of all processed CSV files.  Each
+    file keeps its own accumulator, so a file that changes is not counted twice.
+    :param artifact_dir: the directory holding all artifacts
+    :param state: dictionary of the processed files
+    :return: dictionary of the combined statistics (see timestats.finalize)
+    """
+    total = timestats.new_accumulator(())
+    for path in state:
+        stats_file = artifact_path(artifact_dir, path, 'ozone_diff_stats.json')
+        if not os.path.exists(stats_file):
+            continue
+        with open(stats_file) as f:
+            acc = dict((k, np.array(v)) for k, v in json.load(f).items())
+        timestats.merge(total, acc)
+    result = dict((k, float(v)) for k, v in timestats.finalize(total).items())
+    with open(os.path.join(artifact_dir, VALIDATION_FILE), 'w') as f:
+        json.dump(result, f, indent=1)
+    return result
+
+
+def process_changes(landing_dir, artifact_dir, state, conn=None, globmodel_file=None,
+                    settle_time=SETTLE_TIME):
+    """
+    Runs one round of the watcher: finds the new or changed files and refreshes
+    their artifacts.  Files that cannot be read are logged as warnings (see the
+    logging module) and retried when they change again.
+    :param landing_dir: the directory to be watched
+    :param artifact_dir: the directory holding all artifacts
+    :param state: dictionary of the processed files (updated in place)
+    :param conn: optional - catalog Connection object
+    :param globmodel_file: optional - GlobModel file for the ozone validation
+    :param settle_time: optional - seconds a file must be unchanged before it is read
+    :return: list of the paths processed
+    """
+    changed, removed = poll(landing_dir, state, settle_time)
+    observations_changed = False
+    for path, st in changed:
+        try:
+            if path.lower().endswith(CSV_EXTENSIONS):
+                refresh_observations(path, artifact_dir, globmodel_file)
+                observations_changed = True
+            else:
+                refresh_netcdf(path, artifact_dir, conn)
+        except catalog.READ_ERRORS as e:
+            logger.warning("Could not process %s: %s", path, e)
+        state[path] = [st.st_size, st.st_mtime]
+    for path in removed:
+        del state[path]
+        if conn is not None:
+            catalog.remove_file(conn, path)
+    if observations_changed or any(p.lower().endswith(CSV_EXTENSIONS) for p in removed):
+        update_validation(artifact_dir, state)
+    if changed or removed:
+        save_state(artifact_dir, state)
+    return [path for path, st in changed]
+
+
+def _add_watches(notifier, landing_dir, mask):
+    """
+    Adds inotify watches for the landing directory and all its subdirectories,
+    as poll lists files in the whole tree.  Watching a directory again only
+    updates its watch, so this is called every round to pick up new
+    subdirectories.
+    :param notifier: inotify_simple.INotify object
+    :param landing_dir: the directory to be watched
+    :param mask: the inotify events to watch for
+    :return: no return
+    """
+    for dirpath, dirnames, filenames in os.walk(landing_dir):
+        try:
+            notifier.add_watch(dirpath, mask)
+        except OSError:
+            # Removed since it was listed
+            continue
+
+
+def watch(landing_dir, artifact_dir, catalog_db=None, globmodel_file=None, interval=10.,
+          max_rounds=None):
+    """
+    Watches a landing directory, refreshing the artifacts of new or changed files
+    as they arrive.  Uses inotify to wake up as soon as something changes in the
+    landing directory or its subdirectories if the inotify_simple package is
+    installed, and otherwise polls every interval seconds.
+    :param landing_dir: the directory to be watched
+    :param artifact_dir: the directory holding all artifacts
+    :param catalog_db: optional - location of the catalog database to keep up to date
+    :param globmodel_file: optional - GlobModel file for the ozone validation
+    :param interval: optional - seconds between polls
+    :param max_rounds: optional - stop after this many rounds (runs forever if None)
+    :return: no return
+    """
+    if not os.path.isdir(artifact_dir):
+        os.makedirs(artifact_dir)
+    state = load_state(artifact_dir)
+    conn = catalog.open_catalog(catalog_db) if catalog_db else None
+    notifier = None
+    if inotify_simple is not None:
+        flags = inotify_simple.flags
+        notifier = inotify_simple.INotify()
+        # CREATE wakes the watcher when a subdirectory is added, so that it is
+        # watched from the next round on
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE | flags.CREATE
+
+    rounds = 0
+    while max_rounds is None or rounds < max_rounds:
+        if notifier is not None:
+            _add_watches(notifier, landing_dir, mask)
+        process_changes(landing_dir, artifact_dir, state, conn, globmodel_file)
+        rounds += 1
+        if max_rounds is not None and rounds >= max_rounds:
+            break
+        if notifier is not None:
+            # Wait for an event, but poll anyway after interval seconds in case
+            # files were not settled yet
+            notifier.read(timeout=int(interval * 1000))
+        else:
+            time.sleep(interval)